@@ -0,0 +1,102 @@
+from argparse import ArgumentParser
+from statistics import median
+from tempfile import TemporaryDirectory
+import json
+import os
+import subprocess
+import sys
+
+
+CHAT_ID = -100
+
+# runs in a fresh interpreter, so every measurement starts with no modules imported
+COLD_START_SCRIPT = """
+from time import perf_counter
+import json
+import sys
+
+started_at = perf_counter()
+import handler
+import_elapsed = perf_counter() - started_at
+
+started_at = perf_counter()
+bot_service = handler.get_bot_service()
+init_elapsed = perf_counter() - started_at
+
+started_at = perf_counter()
+handler.loop.run_until_complete(bot_service.tenant_service.get_tenant(%(chat_id)d))
+tenant_elapsed = perf_counter() - started_at
+
+from services import startup_profiler
+top_modules = startup_profiler.profiler.get_top_modules(%(top_count)d) if startup_profiler.profiler else []
+
+print(json.dumps({
+    "import": import_elapsed,
+    "init": init_elapsed,
+    "tenant": tenant_elapsed,
+    "modules_count": len(sys.modules),
+    "top_modules": top_modules
+}))
+"""
+
+def _get_env(directory, profile):
+    env = dict(os.environ)
+    env.update({
+        # makes the config skip `.env`, so the local settings don't affect the measurement
+        "AWS_LAMBDA_FUNCTION_NAME": "cold-start-benchmark",
+        "TELEGRAM_BOT_TOKEN": "123456:benchmark",
+        "TELEGRAM_CHAT_ID": str(CHAT_ID),
+        "TELEGRAM_USERS": json.dumps({"1": "user1", "2": "user2"}),
+        "SELECT_USER_SESSION_TTL": "60",
+        "CONFIRM_REQUEST_SESSION_TTL": "600",
+        # the spreadsheet backend connects to Google while loading the tenant, so it is not measured
+        "STORAGE_BACKEND": "sqlite",
+        "SQLITE_LEDGER_PATH": os.path.join(directory, "karma.sqlite3"),
+        "SESSION_STORE": "sqlite",
+        "SESSION_STORE_PATH": os.path.join(directory, "sessions.sqlite3"),
+        "STARTUP_PROFILE": "true" if profile else "false"
+    })
+    return env
+
+def _measure(profile, top_count):
+    with TemporaryDirectory() as directory:
+        script = COLD_START_SCRIPT % {"chat_id": CHAT_ID, "top_count": top_count}
+        output = subprocess.run(
+            [sys.executable, "-c", script],
+            env=_get_env(directory, profile),
+            check=True,
+            stdout=subprocess.PIPE
+        ).stdout
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+def run(runs_count, top_count, output_path):
+    results = [_measure(False, top_count) for _ in range(runs_count)]
+
+    summary = {"runs_count": runs_count}
+    print(f"{'phase':<10}{'median, ms':>12}{'min, ms':>10}")
+    for phase in ("import", "init", "tenant"):
+        elapsed = [result[phase] for result in results]
+        summary[phase] = {"median": median(elapsed), "min": min(elapsed)}
+        print(f"{phase:<10}{median(elapsed) * 1000:>12.1f}{min(elapsed) * 1000:>10.1f}")
+    summary["modules_count"] = results[0]["modules_count"]
+    print(f"modules imported: {summary['modules_count']}")
+
+    # the profiler slows the imports down, so it runs separately from the timed runs
+    if top_count:
+        summary["top_modules"] = _measure(True, top_count)["top_modules"]
+        print(f"\n{'module':<50}{'self, ms':>10}{'total, ms':>11}")
+        for (name, inclusive, self_elapsed) in summary["top_modules"]:
+            print(f"{name:<50}{self_elapsed * 1000:>10.1f}{inclusive * 1000:>11.1f}")
+
+    if output_path:
+        with open(output_path, "w") as output_file:
+            json.dump(summary, output_file, indent=2)
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Measures the cold start of the Lambda handler in fresh interpreters")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--top", type=int, default=15, help="number of the slowest modules to show, 0 disables profiling")
+    parser.add_argument("--output", help="path of a JSON file to save the results to")
+    args = parser.parse_args()
+
+    run(args.runs, args.top, args.output)
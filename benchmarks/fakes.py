@@ -0,0 +1,168 @@
+from itertools import count
+from threading import Lock
+import json
+import re
+
+from gspread.exceptions import WorksheetNotFound
+from telegram.request import BaseRequest
+
+from services.google_spreadsheet import GoogleSpreadsheetService
+
+
+# the grid of a new worksheet of the API
+DEFAULT_ROWS_COUNT = 1000
+DEFAULT_COLS_COUNT = 26
+BOT_USER = {"id": 999, "is_bot": True, "first_name": "Karma Bot", "username": "karma_bot"}
+
+def _parse_range(data_range):
+    (column_from, first_row, column_to, last_row) = re.match(r"^([A-Z]+)(\d+):([A-Z]+)(\d*)$", data_range).groups()
+    return (column_from, int(first_row), column_to, int(last_row) if last_row else None)
+
+def _get_columns(column_from, column_to):
+    return [chr(code) for code in range(ord(column_from), ord(column_to) + 1)]
+
+
+def _get_column_number(column):
+    return ord(column) - ord("A") + 1
+
+
+class FakeWorksheet:
+    # keeps the columns as lists of values, which is the way the bot reads and appends them
+    def __init__(self, title, rows, cols):
+        self.title = title
+        self.row_count = rows
+        self.col_count = cols
+        self.columns = {}
+
+    def _get_column(self, column, first_row, last_row=None):
+        values = self.columns.get(column, [])
+        return values[first_row - 1:last_row]
+
+    def get(self, data_range):
+        (column_from, first_row, column_to, last_row) = _parse_range(data_range)
+        columns = [self._get_column(column, first_row, last_row) for column in _get_columns(column_from, column_to)]
+        rows_count = max(len(values) for values in columns)
+        rows = [[values[index] if index < len(values) else "" for values in columns] for index in range(rows_count)]
+
+        # the API leaves out trailing empty cells of a row and trailing empty rows of a range
+        rows = [row[:max([index + 1 for (index, value) in enumerate(row) if value != ""] or [0])] for row in rows]
+        while rows and not rows[-1]:
+            rows.pop()
+        return rows
+
+    def batch_get(self, data_ranges):
+        return [self.get(data_range) for data_range in data_ranges]
+
+    def resize(self, rows=None, cols=None):
+        if rows is not None:
+            self.row_count = rows
+        if cols is not None:
+            self.col_count = cols
+
+    def _write(self, data_range, rows):
+        (column_from, first_row, column_to, _) = _parse_range(data_range)
+        for (offset, column) in enumerate(_get_columns(column_from, column_to)):
+            values = self.columns.setdefault(column, [])
+            for (index, row) in enumerate(rows):
+                row_index = first_row - 1 + index
+                values.extend([""] * (row_index + 1 - len(values)))
+                # as the API, a null value leaves the cell empty
+                values[row_index] = "" if row[offset] is None else str(row[offset])
+
+    def update(self, data_range, rows):
+        # as the API, writes outside of the grid are rejected, the grid is only extended by appends
+        (_, first_row, column_to, _) = _parse_range(data_range)
+        if first_row + len(rows) - 1 > self.row_count or _get_column_number(column_to) > self.col_count:
+            raise ValueError(f"Range ({self.title}!{data_range}) exceeds grid limits. Max rows: {self.row_count}, max columns: {self.col_count}")
+
+        self._write(data_range, rows)
+
+    def append_rows(self, rows, value_input_option=None, insert_data_option=None, table_range=None):
+        (column_from, first_row, column_to, _) = _parse_range(table_range)
+        columns = _get_columns(column_from, column_to)
+        next_row = max([first_row] + [len(self.columns.get(column, [])) + 1 for column in columns])
+
+        self._write(f"{column_from}{next_row}:{column_to}{next_row + len(rows) - 1}", rows)
+        self.row_count = max(self.row_count, next_row + len(rows) - 1)
+        return {"updates": {"updatedRange": f"{self.title}!{column_from}{next_row}:{column_to}{next_row + len(rows) - 1}"}}
+
+
+class FakeSpreadsheet:
+    def __init__(self):
+        self.worksheets = {}
+
+    def worksheet(self, title):
+        if title not in self.worksheets:
+            raise WorksheetNotFound(title)
+        return self.worksheets[title]
+
+    def add_worksheet(self, title, rows, cols):
+        self.worksheets[title] = FakeWorksheet(title, rows, cols)
+        return self.worksheets[title]
+
+
+class MemorySpreadsheetService(GoogleSpreadsheetService):
+    # the spreadsheet service with the API replaced by in-memory worksheets, the rest of its code is the real one
+    def connect(self):
+        if not hasattr(self, "spreadsheet"):
+            self.spreadsheet = FakeSpreadsheet()
+            self.worksheet = self.spreadsheet.add_worksheet(self.worksheet_title or "Sheet1", DEFAULT_ROWS_COUNT, DEFAULT_COLS_COUNT)
+        self.checkpoints_worksheet = None
+        self.checkpoints_rows_count = 0
+        self.checkpoints = None
+        self.connected_at = 0
+        self.stale = False
+
+    def is_stale(self):
+        return False
+
+
+class FakeBotApi:
+    # answers the Bot API methods in memory, sent messages get sequential ids
+    def __init__(self):
+        self.lock = Lock()
+        self.message_ids = count(1000000)
+        self.calls_count = 0
+        # the latest message with a keyboard in every chat, which is the one the replayed users press buttons of
+        self.keyboard_message_ids = {}
+
+    def call(self, api_method, parameters):
+        with self.lock:
+            self.calls_count += 1
+
+            if api_method == "getMe":
+                return BOT_USER
+
+            if api_method == "sendMessage":
+                message = {
+                    "message_id": next(self.message_ids),
+                    "date": 0,
+                    "chat": {"id": int(parameters["chat_id"]), "type": "group"},
+                    "from": BOT_USER,
+                    "text": parameters["text"]
+                }
+                if "reply_markup" in parameters:
+                    self.keyboard_message_ids[message["chat"]["id"]] = message["message_id"]
+                return message
+
+            if api_method == "getChatMember":
+                user_id = int(parameters["user_id"])
+                return {"status": "member", "user": {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"}}
+
+            return True
+
+
+class StubRequest(BaseRequest):
+    def __init__(self):
+        self.bot_api = FakeBotApi()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        parameters = request_data.parameters if request_data is not None else {}
+        result = self.bot_api.call(url.rsplit("/", 1)[-1], parameters)
+        return (200, json.dumps({"ok": True, "result": result}).encode())
@@ -0,0 +1,228 @@
+from argparse import ArgumentParser
+from collections import Counter
+from queue import Empty
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from urllib.request import urlopen
+import json
+import logging
+import multiprocessing
+import os
+
+import rsa
+
+from benchmarks.mock_apis import HARNESS_PATH_PREFIX, start_sheets_api, start_telegram_api
+from benchmarks.replay import USERS_COUNT, SyntheticStream
+
+
+TELEGRAM_BOT_TOKEN = "123456:load"
+FIRST_CHAT_ID = -1000
+
+def _get_worker_chat_ids(worker_index, chats_per_worker):
+    # every worker serves its own chats, as sessions of the memory store are not shared by Lambda containers
+    return [FIRST_CHAT_ID - worker_index * chats_per_worker - index for index in range(chats_per_worker)]
+
+def _write_tenants_config(tenants_config_dir, chat_ids):
+    users = {str(user_id): f"User {user_id}" for user_id in range(1, USERS_COUNT + 1)}
+    tenant_config = {
+        "users": users,
+        "spreadsheet_user_columns": {user_id: [chr(ord("A") + index * 2), chr(ord("B") + index * 2)] for (index, user_id) in enumerate(users)}
+    }
+
+    for chat_id in chat_ids:
+        with open(os.path.join(tenants_config_dir, f"{chat_id}.json"), "w") as tenant_config_file:
+            json.dump(tenant_config, tenant_config_file)
+
+def _get_env(args, telegram_api, sheets_api, tenants_config_dir):
+    # the service account is signed by a throwaway key, the mock token endpoint accepts any assertion
+    (_, private_key) = rsa.newkeys(1024)
+
+    return {
+        # the workers behave as Lambda containers, e.g. `.env` is not read
+        "AWS_LAMBDA_FUNCTION_NAME": "karma-bot-load",
+        "TELEGRAM_BOT_TOKEN": TELEGRAM_BOT_TOKEN,
+        "TELEGRAM_API_BASE_URL": f"{telegram_api.url}/bot",
+        "TELEGRAM_CHAT_MESSAGES_PER_MINUTE": str(args.chat_messages_per_minute),
+        "TELEGRAM_MESSAGES_PER_SECOND": str(args.messages_per_second),
+        "TENANTS_CONFIG_DIR": tenants_config_dir,
+        "SELECT_USER_SESSION_TTL": "3600",
+        "CONFIRM_REQUEST_SESSION_TTL": "3600",
+        "STORAGE_BACKEND": "google_spreadsheet",
+        "GOOGLE_SPREADSHEET_ID": "load",
+        "GOOGLE_SPREADSHEET_FIRST_DATA_ROW": "2",
+        "GOOGLE_SHEETS_API_URL": sheets_api.url,
+        "GOOGLE_API_ACCOUNT_TYPE": "service_account",
+        "GOOGLE_API_ACCOUNT_PRIVATE_KEY_ID": "load",
+        "GOOGLE_API_ACCOUNT_PRIVATE_KEY": private_key.save_pkcs1().decode(),
+        "GOOGLE_API_ACCOUNT_CLIENT_EMAIL": "load@karma-bot.iam.gserviceaccount.com",
+        "GOOGLE_API_ACCOUNT_TOKEN_URI": f"{sheets_api.url}/token",
+        "METRICS_ENABLED": "true"
+    }
+
+def _get_percentile(sorted_values, percentile):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(int(percentile * len(sorted_values)), len(sorted_values) - 1)]
+
+def run_worker(worker_index, args, telegram_api_url, results):
+    # the records are still created and filtered as in production, but not written out
+    logging.basicConfig(handlers=[logging.NullHandler()])
+
+    started_at = perf_counter()
+    import handler
+    import_elapsed = perf_counter() - started_at
+
+    def get_keyboard_message_id(chat_id):
+        with urlopen(f"{telegram_api_url}{HARNESS_PATH_PREFIX}keyboard_message_ids/{chat_id}") as response:
+            return json.load(response)["message_id"]
+
+    stream = SyntheticStream(
+        args.seed + worker_index,
+        args.updates_per_worker,
+        get_keyboard_message_id,
+        chat_ids=_get_worker_chat_ids(worker_index, args.chats_per_worker)
+    )
+
+    latencies = []
+    status_codes = Counter()
+    for update_json in stream:
+        # API Gateway passes the update as the body of the event
+        started_at = perf_counter()
+        response = handler.webhook({"body": json.dumps(update_json)}, None)
+        latencies.append(perf_counter() - started_at)
+        status_codes[response["statusCode"]] += 1
+
+    bot_service = handler.bot_service
+    results.put({
+        "import_elapsed": import_elapsed,
+        "latencies": latencies,
+        "status_codes": dict(status_codes),
+        "metrics": bot_service.metrics_service.get_metrics() if bot_service and bot_service.metrics_service else {}
+    })
+
+def _collect_results(workers, results):
+    workers_results = []
+    while len(workers_results) < len(workers):
+        try:
+            workers_results.append(results.get(timeout=1))
+        except Empty:
+            # a worker which crashed never reports, so the step fails instead of waiting for it
+            if any(worker.exitcode not in (None, 0) for worker in workers):
+                raise Exception("Load worker failed, see its traceback above")
+    return workers_results
+
+def run_step(args, workers_count, telegram_api, sheets_api):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+
+    # the workers are fresh interpreters, like new Lambda containers, and send the updates of their chats concurrently
+    started_at = perf_counter()
+    workers = [
+        context.Process(target=run_worker, args=(worker_index, args, telegram_api.url, results))
+        for worker_index in range(workers_count)
+    ]
+    for worker in workers:
+        worker.start()
+    workers_results = _collect_results(workers, results)
+    for worker in workers:
+        worker.join()
+    elapsed = perf_counter() - started_at
+
+    # the first invocation of a worker initializes the bot, so it's reported apart from the warm ones
+    cold_latencies = [worker_result["latencies"][0] for worker_result in workers_results if worker_result["latencies"]]
+    warm_latencies = sorted(latency for worker_result in workers_results for latency in worker_result["latencies"][1:])
+
+    bot_counters = Counter()
+    status_codes = Counter()
+    for worker_result in workers_results:
+        bot_counters.update(worker_result["metrics"].get("counters", {}))
+        status_codes.update(worker_result["status_codes"])
+
+    updates_count = sum(len(worker_result["latencies"]) for worker_result in workers_results)
+    return {
+        "workers": workers_count,
+        "updates_count": updates_count,
+        "updates_per_second": updates_count / elapsed,
+        "cold_ms": sum(cold_latencies) / len(cold_latencies) * 1000 if cold_latencies else 0,
+        "p50_ms": _get_percentile(warm_latencies, 0.5) * 1000,
+        "p99_ms": _get_percentile(warm_latencies, 0.99) * 1000,
+        "webhook_status_codes": dict(status_codes),
+        "telegram_api": telegram_api.pop_counters(),
+        "sheets_api": sheets_api.pop_counters(),
+        "bot_counters": {name: value for (name, value) in sorted(bot_counters.items()) if not name.endswith("bytes_sent") and not name.endswith("bytes_received")}
+    }
+
+def print_step(result):
+    print(f"{result['workers']:>8}{result['updates_count']:>9}{result['updates_per_second']:>10.1f}{result['cold_ms']:>10.1f}{result['p50_ms']:>9.1f}{result['p99_ms']:>9.1f}")
+
+def print_details(result):
+    telegram_api = result["telegram_api"]
+    sheets_api = result["sheets_api"]
+
+    # requests per connection shows whether the clients keep their connections alive
+    for (name, counters) in (("telegram", telegram_api), ("sheets", sheets_api)):
+        connections = counters.get("connections", 0)
+        requests_per_connection = counters.get("requests", 0) / connections if connections else 0
+        served = {name: value for (name, value) in counters.items() if name.startswith("status_")}
+        print(f"  {name} api: requests={counters.get('requests', 0)}, connections={connections}, requests/connection={requests_per_connection:.1f}, served={served}")
+
+    print(f"  webhook responses: {result['webhook_status_codes']}")
+    print(f"  bot counters: {result['bot_counters']}")
+
+def run(args):
+    chat_ids = [chat_id for worker_index in range(max(args.workers)) for chat_id in _get_worker_chat_ids(worker_index, args.chats_per_worker)]
+
+    telegram_api = start_telegram_api(
+        latency=args.telegram_latency_ms / 1000,
+        error_rate=args.telegram_error_rate,
+        quota_rate=args.telegram_quota_rate,
+        retry_after=args.retry_after,
+        seed=args.seed
+    )
+    sheets_api = start_sheets_api(
+        [str(chat_id) for chat_id in chat_ids],
+        latency=args.sheets_latency_ms / 1000,
+        error_rate=args.sheets_error_rate,
+        quota_rate=args.sheets_quota_rate,
+        retry_after=args.retry_after,
+        seed=args.seed
+    )
+
+    with TemporaryDirectory() as tenants_config_dir:
+        _write_tenants_config(tenants_config_dir, chat_ids)
+        # the spawned workers inherit the environment of the harness
+        os.environ.update(_get_env(args, telegram_api, sheets_api, tenants_config_dir))
+
+        results = []
+        print(f"{'workers':>8}{'updates':>9}{'updates/s':>10}{'cold, ms':>10}{'p50, ms':>9}{'p99, ms':>9}")
+        for workers_count in args.workers:
+            result = run_step(args, workers_count, telegram_api, sheets_api)
+            print_step(result)
+            if args.verbose:
+                print_details(result)
+            results.append(result)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Sends webhook traffic through `handler.webhook` in worker processes, with the Bot API and the Sheets API served by local mock servers")
+    parser.add_argument("--workers", nargs="+", type=int, default=[1, 2, 4], help="numbers of concurrent workers, one step each")
+    parser.add_argument("--updates-per-worker", type=int, default=300)
+    parser.add_argument("--chats-per-worker", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--telegram-latency-ms", type=float, default=20)
+    parser.add_argument("--telegram-error-rate", type=float, default=0)
+    parser.add_argument("--telegram-quota-rate", type=float, default=0, help="share of Bot API requests answered with 429")
+    parser.add_argument("--sheets-latency-ms", type=float, default=80)
+    parser.add_argument("--sheets-error-rate", type=float, default=0)
+    parser.add_argument("--sheets-quota-rate", type=float, default=0, help="share of Sheets API requests answered with 429")
+    parser.add_argument("--chat-messages-per-minute", type=int, default=20, help="limit of the send queue per chat, as in production, so bursts in a chat show up in the latencies (0 disables it)")
+    parser.add_argument("--messages-per-second", type=int, default=30, help="limit of the send queue of every worker")
+    parser.add_argument("--retry-after", type=int, default=1, help="`retry_after` of the Bot API 429 responses")
+    parser.add_argument("--output", help="saves the results of the steps as JSON")
+    parser.add_argument("-v", "--verbose", action="store_true", help="prints the requests, connections and failures of every step")
+    args = parser.parse_args()
+
+    run(args)
@@ -0,0 +1,107 @@
+from argparse import ArgumentParser
+from io import StringIO
+from time import process_time
+import json
+import logging
+
+from telegram import Bot, Update
+
+from config import get_config
+from services.logs import JsonFormatter, LazyJson, LazyUpdate, get_logger
+
+
+COMMAND_UPDATE = {
+    "update_id": 1,
+    "message": {
+        "message_id": 1000,
+        "date": 0,
+        "chat": {"id": -100, "type": "group", "title": "Karma"},
+        "from": {"id": 1, "is_bot": False, "first_name": "Alice", "username": "alice"},
+        "text": "/up for the great talk about performance",
+        "entities": [{"type": "bot_command", "offset": 0, "length": 3}]
+    }
+}
+CALLBACK_UPDATE = {
+    "update_id": 2,
+    "callback_query": {
+        "id": "42",
+        "from": {"id": 3, "is_bot": False, "first_name": "Carol"},
+        "chat_instance": "1",
+        "data": "CONFIRM",
+        "message": {
+            "message_id": 1002,
+            "date": 0,
+            "chat": {"id": -100, "type": "group", "title": "Karma"},
+            "from": {"id": 999, "is_bot": True, "first_name": "Karma Bot"},
+            "text": "Alice requests +1 for Bob"
+        }
+    }
+}
+SESSION = {"id": "68edc720", "type": 2, "user_id": 3, "data": {"reason": "for the great talk about performance", "selected_user_id": 2}}
+
+def _log_previous(logger, event, update):
+    # mirrors the logging of an update before the structured logging: objects were rendered into f-strings
+    logger.info(event)
+    logger.info(f"Started process_update: {update}")
+    logger.info(f"Update received: {update}")
+    if update.callback_query:
+        logger.info(f"Found active session (session_id={SESSION['id']}): {SESSION}")
+        logger.info(f"Received option from user (user_id=3): {update.callback_query.message}")
+        logger.info(f"Confirm request message was deleted: {update.callback_query.message}")
+    logger.info("Finished process_update")
+
+def _log_current(logger, event, update):
+    logger.debug("Event received: %s", LazyJson(event))
+    logger.debug("Started process_update (%s)", LazyUpdate(update))
+    logger.info("Update received (%s)", LazyUpdate(update), extra={"event": "update_received"})
+    if update.callback_query:
+        logger.info("Found active session (session_id=%s)", SESSION['id'])
+        logger.info("Received option from user (user_id=%s, message_id=%s)", 3, update.callback_query.message.message_id)
+        logger.info("Confirm request message was deleted (message_id=%s)", update.callback_query.message.message_id)
+    logger.debug("Finished process_update")
+
+def _measure(log, level, updates_count):
+    output = StringIO()
+    handler = logging.StreamHandler(output)
+    if get_config().log_format == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    # the logger of the bot's modules, with the sampling filter and the redaction configured by `LOG_*` variables,
+    # only its level is overridden to compare emitted and suppressed records
+    logger = get_logger(f"benchmarks.logging_overhead.{log.__name__}")
+    logger.handlers = [handler]
+    logger.propagate = False
+    logger.setLevel(level)
+
+    bot = Bot("123456:benchmark")
+    samples = [
+        ({"body": json.dumps(update_json)}, Update.de_json(update_json, bot))
+        for update_json in (COMMAND_UPDATE, CALLBACK_UPDATE)
+    ]
+
+    started_at = process_time()
+    for index in range(updates_count):
+        (event, update) = samples[index % len(samples)]
+        log(logger, event, update)
+    elapsed = process_time() - started_at
+
+    return {"cpu_per_update_us": elapsed / updates_count * 1e6, "bytes_per_update": len(output.getvalue()) / updates_count}
+
+def run(updates_count):
+    config = get_config()
+    print(f"sample rates: {config.log_sample_rates}, redact texts: {config.log_redact_texts}, format: {config.log_format}")
+    print(f"{'logging':<12}{'level':>9}{'cpu/update, us':>16}{'bytes/update':>14}")
+
+    for level in (logging.INFO, logging.WARNING):
+        for (name, log) in [("previous", _log_previous), ("structured", _log_current)]:
+            result = _measure(log, level, updates_count)
+            print(f"{name:<12}{logging.getLevelName(level):>9}{result['cpu_per_update_us']:>16.1f}{result['bytes_per_update']:>14.0f}")
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Compares CPU time spent on logging an update: f-string rendering vs. lazy structured records")
+    parser.add_argument("updates_count", nargs="?", type=int, default=20000)
+    args = parser.parse_args()
+
+    run(args.updates_count)
@@ -0,0 +1,263 @@
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from random import Random
+from threading import Lock, Thread
+from urllib.parse import parse_qs, parse_qsl, unquote, urlparse
+import json
+import re
+import time
+
+from benchmarks.fakes import DEFAULT_COLS_COUNT, DEFAULT_ROWS_COUNT, FakeBotApi, FakeSpreadsheet
+
+
+# requests of the harness itself, which are not delayed, failed or counted
+HARNESS_PATH_PREFIX = "/harness/"
+
+def _parse_absolute_range(absolute_range):
+    # gspread sends ranges as `'title'!A1:B`
+    (title, _, data_range) = unquote(absolute_range).rpartition("!")
+    if title.startswith("'") and title.endswith("'"):
+        title = title[1:-1].replace("''", "'")
+    return (title, data_range)
+
+
+class MockApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler_class, latency=0, error_rate=0, quota_rate=0, retry_after=1, seed=1):
+        super().__init__(("127.0.0.1", 0), handler_class)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.quota_rate = quota_rate
+        self.retry_after = retry_after
+        self.random = Random(seed)
+        self.lock = Lock()
+        self.counters = Counter()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def pop_counters(self):
+        with self.lock:
+            (counters, self.counters) = (self.counters, Counter())
+        return dict(counters)
+
+    def roll_fault(self):
+        with self.lock:
+            value = self.random.random()
+
+        if value < self.quota_rate:
+            return 429
+        if value < self.quota_rate + self.error_rate:
+            return 500
+        return None
+
+    def start(self):
+        Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class MockApiHandler(BaseHTTPRequestHandler):
+    # keep-alive is supported, so the connections reused by the clients can be counted
+    protocol_version = "HTTP/1.1"
+    # the headers and the body are written separately, which would otherwise wait for delayed ACKs of the clients
+    disable_nagle_algorithm = True
+    connection_counted = False
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, status_code, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _handle(self, method):
+        url = urlparse(self.path)
+        body = self._read_body()
+
+        if url.path.startswith(HARNESS_PATH_PREFIX):
+            self._send_json(200, self.handle_harness(url.path[len(HARNESS_PATH_PREFIX):]))
+            return
+
+        server = self.server
+        if not self.connection_counted:
+            self.connection_counted = True
+            server.count("connections")
+        server.count("requests")
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        fault = self.roll_fault(url.path)
+        if fault is not None:
+            server.count(f"status_{fault}")
+            self._send_json(fault, self.get_fault_payload(fault))
+            return
+
+        try:
+            (status_code, payload) = self.handle_api(method, url, body)
+        except Exception as err:
+            (status_code, payload) = (400, self.get_fault_payload(400, str(err)))
+
+        server.count(f"status_{status_code}")
+        self._send_json(status_code, payload)
+
+    def roll_fault(self, path):
+        return self.server.roll_fault()
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+
+class TelegramApiHandler(MockApiHandler):
+    def _parse_parameters(self, body):
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            return json.loads(body or b"{}")
+        return dict(parse_qsl(body.decode()))
+
+    def handle_harness(self, path):
+        # e.g. `keyboard_message_ids/-100`, the message the users of the chat press buttons of
+        chat_id = int(path.rsplit("/", 1)[-1])
+        return {"message_id": self.server.bot_api.keyboard_message_ids.get(chat_id, 0)}
+
+    def get_fault_payload(self, status_code, description=None):
+        if status_code == 429:
+            retry_after = self.server.retry_after
+            return {"ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {retry_after}", "parameters": {"retry_after": retry_after}}
+        return {"ok": False, "error_code": status_code, "description": description or "Internal Server Error"}
+
+    def handle_api(self, method, url, body):
+        # `/bot<token>/<method>`
+        api_method = url.path.rsplit("/", 1)[-1]
+        return (200, {"ok": True, "result": self.server.bot_api.call(api_method, self._parse_parameters(body))})
+
+
+class SheetsApiHandler(MockApiHandler):
+    def handle_harness(self, path):
+        return {}
+
+    def roll_fault(self, path):
+        # the token endpoint belongs to the OAuth server, which has no Sheets quota
+        if path == "/token":
+            return None
+        return self.server.roll_fault()
+
+    def get_fault_payload(self, status_code, description=None):
+        statuses = {429: "RESOURCE_EXHAUSTED", 400: "INVALID_ARGUMENT"}
+        message = "Quota exceeded for quota metric 'Requests'" if status_code == 429 else description or "Internal error encountered."
+        return {"error": {"code": status_code, "message": message, "status": statuses.get(status_code, "INTERNAL")}}
+
+    def _get_sheet_properties(self, title):
+        titles = list(self.server.spreadsheet.worksheets)
+        worksheet = self.server.spreadsheet.worksheet(title)
+        return {
+            "sheetId": titles.index(title),
+            "title": title,
+            "index": titles.index(title),
+            "sheetType": "GRID",
+            "gridProperties": {"rowCount": worksheet.row_count, "columnCount": worksheet.col_count}
+        }
+
+    def _get_metadata(self):
+        return {
+            "spreadsheetId": "load",
+            "properties": {"title": "Karma"},
+            "sheets": [{"properties": self._get_sheet_properties(title)} for title in self.server.spreadsheet.worksheets]
+        }
+
+    def _get_values(self, absolute_range):
+        (title, data_range) = _parse_absolute_range(absolute_range)
+        return {"range": absolute_range, "majorDimension": "ROWS", "values": self.server.spreadsheet.worksheet(title).get(data_range)}
+
+    def _batch_update(self, body):
+        spreadsheet = self.server.spreadsheet
+        replies = []
+        for request in body["requests"]:
+            if "updateSheetProperties" in request:
+                # e.g. `Worksheet.resize`, sheets are addressed by their index
+                properties = request["updateSheetProperties"]["properties"]
+                worksheet = list(spreadsheet.worksheets.values())[properties["sheetId"]]
+                worksheet.resize(rows=properties["gridProperties"].get("rowCount"), cols=properties["gridProperties"].get("columnCount"))
+                replies.append({})
+                continue
+
+            properties = request["addSheet"]["properties"]
+            grid_properties = properties.get("gridProperties", {})
+            spreadsheet.add_worksheet(
+                properties["title"],
+                grid_properties.get("rowCount", DEFAULT_ROWS_COUNT),
+                grid_properties.get("columnCount", DEFAULT_COLS_COUNT)
+            )
+            replies.append({"addSheet": {"properties": self._get_sheet_properties(properties["title"])}})
+        return {"spreadsheetId": "load", "replies": replies}
+
+    def handle_api(self, method, url, body):
+        if url.path == "/token":
+            return (200, {"access_token": "load", "expires_in": 3600, "token_type": "Bearer"})
+
+        # `/v4/spreadsheets/<id>[/values/<range>[:append] | /values:batchGet | :batchUpdate]`
+        (_, _, path) = url.path.partition("/v4/spreadsheets/")
+        (_, _, path) = path.partition("/") if "/" in path else path.partition(":")
+        body = json.loads(body or b"{}")
+        spreadsheet = self.server.spreadsheet
+
+        with self.server.spreadsheet_lock:
+            if path == "":
+                return (200, self._get_metadata())
+
+            if path == "batchUpdate":
+                return (200, self._batch_update(body))
+
+            if path == "values:batchGet":
+                ranges = parse_qs(url.query)["ranges"]
+                return (200, {"spreadsheetId": "load", "valueRanges": [self._get_values(absolute_range) for absolute_range in ranges]})
+
+            match = re.match(r"^values/(.+?)(:append)?$", path)
+            if match is None:
+                return (404, self.get_fault_payload(404, f"Unknown path: {url.path}"))
+
+            (absolute_range, append) = match.groups()
+            (title, data_range) = _parse_absolute_range(absolute_range)
+
+            if method == "GET":
+                return (200, self._get_values(absolute_range))
+
+            if append:
+                response = spreadsheet.worksheet(title).append_rows(body["values"], table_range=data_range)
+                return (200, {"spreadsheetId": "load", **response})
+
+            spreadsheet.worksheet(title).update(data_range, body["values"])
+            return (200, {"spreadsheetId": "load", "updatedRange": absolute_range})
+
+
+def start_telegram_api(**kwargs):
+    server = MockApiServer(TelegramApiHandler, **kwargs)
+    server.bot_api = FakeBotApi()
+    return server.start()
+
+def start_sheets_api(worksheet_titles, **kwargs):
+    server = MockApiServer(SheetsApiHandler, **kwargs)
+    server.spreadsheet = FakeSpreadsheet()
+    server.spreadsheet_lock = Lock()
+    for title in worksheet_titles:
+        server.spreadsheet.add_worksheet(title, DEFAULT_ROWS_COUNT, DEFAULT_COLS_COUNT)
+    return server.start()
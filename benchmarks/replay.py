@@ -0,0 +1,293 @@
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from random import Random
+from time import perf_counter
+import asyncio
+import json
+import logging
+import sys
+import tracemalloc
+
+from benchmarks.fakes import MemorySpreadsheetService, StubRequest
+from services.bot import BotService
+from services.dedup import UpdateDedupService
+from services.karma import KarmaService
+from services.leaderboard import LeaderboardService
+from services.metrics import MetricsService
+from services.session import SessionService, SessionType
+from services.session_store import MemorySessionStore
+from services.storage import STORAGE_IO_METHODS
+from services.tenant import Tenant, TenantService
+from services.user_profiles import UserProfilesService
+from services.users import UsersService
+
+
+CHAT_IDS = (-100, -200, -300)
+FOREIGN_CHAT_ID = -999
+USERS_COUNT = 6
+SESSION_TTL = 3600
+# the results worse than the baseline by more than the tolerance are reported as regressions
+DEFAULT_TOLERANCE = 0.2
+
+def _get_users():
+    return {str(user_id): f"User {user_id}" for user_id in range(1, USERS_COUNT + 1)}
+
+def _load_tenant(chat_id, metrics_service):
+    if chat_id not in CHAT_IDS:
+        return None
+
+    users = _get_users()
+    # every user gets a reason and an amount column, as in the spreadsheet of the bot
+    storage_service = MemorySpreadsheetService(
+        account_dict=None,
+        spreadsheet_id=None,
+        spreadsheet_user_columns={user_id: [chr(ord("A") + index * 2), chr(ord("B") + index * 2)] for (index, user_id) in enumerate(users)},
+        spreadsheet_first_data_row=2
+    )
+    metrics_service.instrument(storage_service, "storage", STORAGE_IO_METHODS)
+
+    karma_service = KarmaService(
+        storage_service=storage_service,
+        executor=ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"storage-{chat_id}"),
+        leaderboard_service=LeaderboardService()
+    )
+    return Tenant(chat_id=chat_id, users_service=UsersService(users=users), karma_service=karma_service)
+
+def build_bot_service():
+    # the bot is built as in `main.init`, with Telegram and the spreadsheet replaced by in-memory fakes
+    request = StubRequest()
+    metrics_service = MetricsService()
+
+    bot_service = BotService(
+        token="123456:benchmark",
+        tenant_service=TenantService(load_tenant=lambda chat_id: _load_tenant(chat_id, metrics_service)),
+        session_service=SessionService(
+            session_ttls={SessionType.SELECT_USER: SESSION_TTL, SessionType.CONFIRM_REQUEST: SESSION_TTL},
+            store=MemorySessionStore()
+        ),
+        user_profiles_service=UserProfilesService(max_size=1000, ttl=3600, refresh_after=600),
+        dedup_service=UpdateDedupService(max_size=10000, ttl=86400),
+        metrics_service=metrics_service,
+        request=request
+    )
+    return (bot_service, request)
+
+
+class SyntheticStream:
+    # a seeded mix of group traffic: ordinary messages, /show, voting flows, foreign chats and redeliveries;
+    # buttons are pressed on the messages the bot has actually sent, so the stream is generated while it's replayed
+    def __init__(self, seed, updates_count, get_keyboard_message_id, chat_ids=CHAT_IDS):
+        self.random = Random(seed)
+        self.updates_count = updates_count
+        self.get_keyboard_message_id = get_keyboard_message_id
+        self.chat_ids = chat_ids
+        self.update_ids = count(1)
+        self.message_ids = count(1)
+        self.callback_query_ids = count(1)
+        self.pending_steps = []
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"}
+
+    def _message(self, chat_id, user_id, text):
+        message = {
+            "message_id": next(self.message_ids),
+            "date": 0,
+            "chat": {"id": chat_id, "type": "group"},
+            "from": self._user(user_id),
+            "text": text
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": next(self.update_ids), "message": message}
+
+    def _callback_query(self, chat_id, user_id, data):
+        return {
+            "update_id": next(self.update_ids),
+            "callback_query": {
+                "id": str(next(self.callback_query_ids)),
+                "from": self._user(user_id),
+                "chat_instance": str(chat_id),
+                "data": data,
+                "message": {
+                    "message_id": self.get_keyboard_message_id(chat_id),
+                    "date": 0,
+                    "chat": {"id": chat_id, "type": "group"}
+                }
+            }
+        }
+
+    def _start_vote(self, chat_id):
+        (requesting_user_id, selected_user_id, confirming_user_id) = self.random.sample(range(1, USERS_COUNT + 1), 3)
+        command = self.random.choice(["/up", "/down"])
+
+        # the follow-up presses come right after the command, as the users of a chat answer the keyboards in order
+        self.pending_steps = [
+            lambda: self._callback_query(chat_id, requesting_user_id, str(selected_user_id)),
+            lambda: self._callback_query(chat_id, confirming_user_id, self.random.choice(["CONFIRM", "CONFIRM", "DECLINE"]))
+        ]
+        return self._message(chat_id, requesting_user_id, f"{command} for the benchmark")
+
+    def _next_update(self, previous_update):
+        if self.pending_steps:
+            return self.pending_steps.pop(0)()
+
+        chat_id = self.random.choice(self.chat_ids)
+        user_id = self.random.randint(1, USERS_COUNT)
+        kind = self.random.random()
+
+        if kind < 0.55:
+            return self._message(chat_id, user_id, "just chatting " * self.random.randint(1, 20))
+        if kind < 0.7:
+            return self._message(chat_id, user_id, "/show")
+        if kind < 0.85:
+            return self._start_vote(chat_id)
+        if kind < 0.95:
+            return self._message(FOREIGN_CHAT_ID, user_id, "/show")
+        if previous_update is not None:
+            return previous_update
+        return self._message(chat_id, user_id, "/help")
+
+    def __iter__(self):
+        previous_update = None
+        for _ in range(self.updates_count):
+            previous_update = self._next_update(previous_update)
+            yield previous_update
+
+
+def load_updates(path):
+    with open(path) as updates_file:
+        return [json.loads(line) for line in updates_file if line.strip()]
+
+def save_updates(path, updates):
+    with open(path, "w") as updates_file:
+        for update_json in updates:
+            updates_file.write(json.dumps(update_json) + "\n")
+
+def _get_percentile(sorted_values, percentile):
+    return sorted_values[min(int(percentile * len(sorted_values)), len(sorted_values) - 1)]
+
+async def measure_latency(create_updates):
+    (bot_service, request) = build_bot_service()
+    updates = create_updates(request)
+
+    latencies = []
+    replayed_updates = []
+    started_at = perf_counter()
+    for update_json in updates:
+        update_started_at = perf_counter()
+        await bot_service.process_update(update_json)
+        latencies.append(perf_counter() - update_started_at)
+        replayed_updates.append(update_json)
+    elapsed = perf_counter() - started_at
+
+    latencies.sort()
+    result = {
+        "updates_count": len(latencies),
+        "updates_per_second": len(latencies) / elapsed,
+        "p50_ms": _get_percentile(latencies, 0.5) * 1000,
+        "p99_ms": _get_percentile(latencies, 0.99) * 1000,
+        "max_ms": latencies[-1] * 1000,
+        "telegram_calls_per_update": request.bot_api.calls_count / len(latencies),
+        "dropped_updates": dict(bot_service.dropped_updates)
+    }
+    return (result, replayed_updates)
+
+async def measure_memory(updates):
+    # a separate pass, tracing slows every allocation down and would distort the latencies
+    (bot_service, _) = build_bot_service()
+
+    peaks = []
+    retained = []
+    for update_json in updates:
+        tracemalloc.start()
+        await bot_service.process_update(update_json)
+        # the callbacks of the finished tasks run on the next iteration of the loop and release their results
+        await asyncio.sleep(0)
+        (current, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peaks.append(peak)
+        retained.append(current)
+
+    peaks.sort()
+    return {
+        "peak_bytes_p50": _get_percentile(peaks, 0.5),
+        "peak_bytes_max": peaks[-1],
+        "retained_bytes_per_update": sum(retained) / len(retained)
+    }
+
+def find_regressions(result, baseline, tolerance):
+    regressions = []
+
+    if result["updates_per_second"] < baseline["updates_per_second"] * (1 - tolerance):
+        regressions.append("updates_per_second")
+    for name in ("p50_ms", "p99_ms", "peak_bytes_p50", "retained_bytes_per_update"):
+        if name in result and name in baseline and result[name] > baseline[name] * (1 + tolerance):
+            regressions.append(name)
+
+    return regressions
+
+def print_result(result, baseline=None):
+    print(f"{'metric':<28}{'result':>14}{'baseline':>14}")
+    for name in ("updates_count", "updates_per_second", "p50_ms", "p99_ms", "max_ms", "telegram_calls_per_update",
+                 "peak_bytes_p50", "peak_bytes_max", "retained_bytes_per_update"):
+        if name not in result:
+            continue
+        baseline_value = f"{baseline[name]:>14.2f}" if baseline and name in baseline else f"{'-':>14}"
+        print(f"{name:<28}{result[name]:>14.2f}{baseline_value}")
+    print(f"dropped_updates: {result['dropped_updates']}")
+
+async def run(args):
+    if args.replay:
+        recorded_updates = load_updates(args.replay)
+        create_updates = lambda request: recorded_updates
+    else:
+        create_updates = lambda request: SyntheticStream(
+            args.seed,
+            args.updates_count,
+            lambda chat_id: request.bot_api.keyboard_message_ids.get(chat_id, 0)
+        )
+
+    (result, updates) = await measure_latency(create_updates)
+    if args.record:
+        save_updates(args.record, updates)
+
+    if not args.skip_memory:
+        result.update(await measure_memory(updates))
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    print_result(result, baseline)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as baseline_file:
+            json.dump(result, baseline_file, indent=2)
+
+    if baseline:
+        regressions = find_regressions(result, baseline, args.tolerance)
+        if regressions:
+            print(f"Regressions over {args.tolerance:.0%} tolerance: {', '.join(regressions)}")
+            return 1
+
+    return 0
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Replays updates through BotService with in-memory Telegram and spreadsheet fakes and reports throughput, latency and memory")
+    parser.add_argument("--updates-count", type=int, default=5000, help="size of the synthetic stream")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--record", help="saves the replayed updates as JSON lines")
+    parser.add_argument("--replay", help="replays updates saved by --record instead of the synthetic stream")
+    parser.add_argument("--skip-memory", action="store_true", help="skips the tracemalloc pass")
+    parser.add_argument("--save-baseline", help="saves the results as a baseline")
+    parser.add_argument("--baseline", help="compares the results with a baseline and exits with 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    # the records are still created and filtered as in production, but not written out
+    logging.basicConfig(handlers=[logging.NullHandler()])
+
+    sys.exit(asyncio.get_event_loop().run_until_complete(run(args)))
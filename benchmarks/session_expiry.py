@@ -0,0 +1,67 @@
+from argparse import ArgumentParser
+from time import perf_counter, time
+import asyncio
+import tracemalloc
+
+from services.scheduler import ExpiryScheduler
+
+
+SESSION_TTL = 36000
+
+async def _noop_callback(*_):
+    pass
+
+async def _per_task_expiry(session_ttl):
+    # mirrors the previous SessionService implementation: one sleeping task per session
+    await asyncio.sleep(session_ttl)
+    await _noop_callback()
+
+def _create_per_task_timers(sessions_count):
+    tasks = [asyncio.ensure_future(_per_task_expiry(SESSION_TTL)) for _ in range(sessions_count)]
+    return lambda index: tasks[index].cancel()
+
+def _create_scheduler_timers(sessions_count):
+    scheduler = ExpiryScheduler(_noop_callback)
+    now = time()
+    for index in range(sessions_count):
+        scheduler.schedule(index, now + SESSION_TTL)
+    return scheduler.cancel
+
+async def _measure(create_timers, sessions_count):
+    tracemalloc.start()
+    started_at = perf_counter()
+
+    cancel = create_timers(sessions_count)
+    # lets the tasks start, so their coroutine frames are accounted as well
+    await asyncio.sleep(0)
+
+    elapsed = perf_counter() - started_at
+    (memory, _) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    started_at = perf_counter()
+    for index in range(sessions_count):
+        cancel(index)
+    await asyncio.sleep(0)
+    cancel_elapsed = perf_counter() - started_at
+
+    return {
+        "creation_rate": sessions_count / elapsed,
+        "cancel_rate": sessions_count / cancel_elapsed,
+        "memory_per_session": memory / sessions_count
+    }
+
+async def run(sessions_counts):
+    print(f"{'approach':<12}{'sessions':>10}{'created/s':>14}{'canceled/s':>14}{'bytes/session':>15}")
+
+    for sessions_count in sessions_counts:
+        for (name, create_timers) in [("per-task", _create_per_task_timers), ("scheduler", _create_scheduler_timers)]:
+            result = await _measure(create_timers, sessions_count)
+            print(f"{name:<12}{sessions_count:>10}{result['creation_rate']:>14.0f}{result['cancel_rate']:>14.0f}{result['memory_per_session']:>15.0f}")
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Compares session expiry timers: one asyncio task per session vs. ExpiryScheduler")
+    parser.add_argument("sessions_counts", nargs="*", type=int, default=[10000, 100000])
+    args = parser.parse_args()
+
+    asyncio.get_event_loop().run_until_complete(run(args.sessions_counts))
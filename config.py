@@ -1,28 +1,248 @@
-from os import environ as env
-from dotenv import load_dotenv
+from functools import cached_property, lru_cache
 from json import loads
+from os import environ as env
+from typing import Dict, List, Optional
+
+
+def load_env_file():
+    # Lambda gets the settings from the function configuration (`.env` is not packaged), so dotenv isn't imported there
+    if 'AWS_LAMBDA_FUNCTION_NAME' in env:
+        return
+
+    from dotenv import load_dotenv
+    load_dotenv()
+
+def get_default_data_path(file_name):
+    # the task root of Lambda is read-only and `/tmp` is the only writable directory there,
+    # it's not shared by containers though, so shared data should be put on a mounted volume (e.g. EFS)
+    if 'AWS_LAMBDA_FUNCTION_NAME' in env:
+        return f"/tmp/{file_name}"
+    return file_name
+
+
+class Config:
+    # every setting is parsed on first access, so only the settings used by the current code path are parsed
+
+    @cached_property
+    def telegram_bot_token(self) -> str:
+        return env['TELEGRAM_BOT_TOKEN']
+
+    # the chat and the users of the default tenant, other chats are configured in `tenants_config_dir`
+    @cached_property
+    def telegram_users(self) -> Dict[str, str]:
+        return loads(env.get('TELEGRAM_USERS', '{}'))
+
+    @cached_property
+    def telegram_chat_id(self) -> Optional[int]:
+        return int(env['TELEGRAM_CHAT_ID']) if 'TELEGRAM_CHAT_ID' in env else None
+
+    @cached_property
+    def tenants_config_dir(self) -> Optional[str]:
+        return env.get('TENANTS_CONFIG_DIR')
+
+    @cached_property
+    def tenants_missing_config_ttl(self) -> int:
+        return int(env.get('TENANTS_MISSING_CONFIG_TTL', '300'))
+
+    @cached_property
+    def telegram_admin_users(self) -> List[int]:
+        return loads(env.get('TELEGRAM_ADMIN_USERS', '[]'))
+
+    @cached_property
+    def telegram_concurrent_updates(self) -> int:
+        return int(env.get('TELEGRAM_CONCURRENT_UPDATES', '8'))
+
+    # Telegram allows about 20 messages per minute in a group and 30 messages per second in total
+    @cached_property
+    def telegram_chat_messages_per_minute(self) -> int:
+        return int(env.get('TELEGRAM_CHAT_MESSAGES_PER_MINUTE', '20'))
+
+    @cached_property
+    def telegram_messages_per_second(self) -> int:
+        return int(env.get('TELEGRAM_MESSAGES_PER_SECOND', '30'))
+
+    @cached_property
+    def telegram_send_max_retries(self) -> int:
+        return int(env.get('TELEGRAM_SEND_MAX_RETRIES', '3'))
+
+    # time to send the queued messages on shutdown of the long-running mode
+    @cached_property
+    def telegram_send_shutdown_timeout(self) -> float:
+        return float(env.get('TELEGRAM_SEND_SHUTDOWN_TIMEOUT', '10'))
+
+    # e.g. a local Bot API server, or a mock server in load tests
+    @cached_property
+    def telegram_api_base_url(self) -> Optional[str]:
+        return env.get('TELEGRAM_API_BASE_URL')
+
+    @cached_property
+    def user_profiles_cache_size(self) -> int:
+        return int(env.get('USER_PROFILES_CACHE_SIZE', '1000'))
+
+    @cached_property
+    def user_profiles_cache_ttl(self) -> int:
+        return int(env.get('USER_PROFILES_CACHE_TTL', '86400'))
+
+    @cached_property
+    def user_profiles_cache_refresh_after(self) -> int:
+        return int(env.get('USER_PROFILES_CACHE_REFRESH_AFTER', '3600'))
+
+    @cached_property
+    def storage_backend(self) -> str:
+        return env.get('STORAGE_BACKEND', 'google_spreadsheet')
+
+    @cached_property
+    def sqlite_ledger_path(self) -> str:
+        return env.get('SQLITE_LEDGER_PATH', get_default_data_path('karma.sqlite3'))
+
+    @cached_property
+    def storage_max_workers(self) -> int:
+        return int(env.get('STORAGE_MAX_WORKERS', '4'))
+
+    # Google settings are only required by the `google_spreadsheet` storage backend
+
+    @cached_property
+    def google_spreadsheet_id(self) -> Optional[str]:
+        return env.get('GOOGLE_SPREADSHEET_ID')
+
+    @cached_property
+    def google_spreadsheet_user_columns(self) -> Dict[str, List[str]]:
+        return loads(env.get('GOOGLE_SPREADSHEET_USER_COLUMNS', '{}'))
+
+    @cached_property
+    def google_spreadsheet_first_data_row(self) -> int:
+        return int(env.get('GOOGLE_SPREADSHEET_FIRST_DATA_ROW', '1'))
+
+    @cached_property
+    def google_spreadsheet_handle_ttl(self) -> int:
+        return int(env.get('GOOGLE_SPREADSHEET_HANDLE_TTL', '3000'))
+
+    @cached_property
+    def google_spreadsheet_checkpoints_worksheet(self) -> str:
+        return env.get('GOOGLE_SPREADSHEET_CHECKPOINTS_WORKSHEET', 'checkpoints')
+
+    @cached_property
+    def google_spreadsheet_checkpoint_interval(self) -> int:
+        return int(env.get('GOOGLE_SPREADSHEET_CHECKPOINT_INTERVAL', '500'))
+
+    @cached_property
+    def google_sheets_api_url(self) -> Optional[str]:
+        return env.get('GOOGLE_SHEETS_API_URL')
+
+    @cached_property
+    def google_api_account(self) -> Dict[str, Optional[str]]:
+        return {
+            "type": env.get('GOOGLE_API_ACCOUNT_TYPE'),
+            "project_id": env.get('GOOGLE_API_ACCOUNT_PROJECT_ID'),
+            "private_key_id": env.get('GOOGLE_API_ACCOUNT_PRIVATE_KEY_ID'),
+            "private_key": env.get('GOOGLE_API_ACCOUNT_PRIVATE_KEY'),
+            "client_email": env.get('GOOGLE_API_ACCOUNT_CLIENT_EMAIL'),
+            "client_id": env.get('GOOGLE_API_ACCOUNT_CLIENT_ID'),
+            "auth_uri": env.get('GOOGLE_API_ACCOUNT_AUTH_URI'),
+            "token_uri": env.get('GOOGLE_API_ACCOUNT_TOKEN_URI'),
+            "auth_provider_x509_cert_url": env.get('GOOGLE_API_ACCOUNT_AUTH_PROVIDER_X509_CERT_URL'),
+            "client_x509_cert_url": env.get('GOOGLE_API_ACCOUNT_CLIENT_X509_CERT_URL')
+        }
+
+    @cached_property
+    def select_user_session_ttl(self) -> int:
+        return int(env['SELECT_USER_SESSION_TTL'])
+
+    @cached_property
+    def confirm_request_session_ttl(self) -> int:
+        return int(env['CONFIRM_REQUEST_SESSION_TTL'])
+
+    @cached_property
+    def session_store(self) -> str:
+        return env.get('SESSION_STORE', 'memory')
+
+    @cached_property
+    def session_store_path(self) -> str:
+        return env.get('SESSION_STORE_PATH', get_default_data_path('sessions.sqlite3'))
+
+    @cached_property
+    def karma_totals_cache_ttl(self) -> int:
+        return int(env.get('KARMA_TOTALS_CACHE_TTL', '300'))
+
+    @cached_property
+    def karma_journal_path(self) -> Optional[str]:
+        return env.get('KARMA_JOURNAL_PATH')
+
+    @cached_property
+    def karma_journal_flush_interval(self) -> float:
+        return float(env.get('KARMA_JOURNAL_FLUSH_INTERVAL', '1'))
+
+    @cached_property
+    def karma_journal_flush_batch_size(self) -> int:
+        return int(env.get('KARMA_JOURNAL_FLUSH_BATCH_SIZE', '100'))
+
+    # levels of loggers by their names (e.g. `{"services.bot": "WARNING", "telegram": "ERROR"}`), `default` applies to the rest of the bot's loggers
+    @cached_property
+    def log_levels(self) -> Dict[str, str]:
+        return loads(env.get('LOG_LEVELS', '{}'))
+
+    # shares of high-volume records which are logged by their event (e.g. `{"update_received": 0.1}`)
+    @cached_property
+    def log_sample_rates(self) -> Dict[str, float]:
+        return loads(env.get('LOG_SAMPLE_RATES', '{}'))
+
+    @cached_property
+    def log_redact_texts(self) -> bool:
+        return env.get('LOG_REDACT_TEXTS', 'true').lower() == 'true'
+
+    @cached_property
+    def log_format(self) -> str:
+        return env.get('LOG_FORMAT', 'text')
+
+    @cached_property
+    def metrics_enabled(self) -> bool:
+        return env.get('METRICS_ENABLED', 'true').lower() == 'true'
+
+    @cached_property
+    def update_dedup_cache_size(self) -> int:
+        return int(env.get('UPDATE_DEDUP_CACHE_SIZE', '10000'))
+
+    @cached_property
+    def update_dedup_ttl(self) -> int:
+        return int(env.get('UPDATE_DEDUP_TTL', '86400'))
+
+    # the dedup store is shared by the workers which use the same path (e.g. on EFS), only the in-memory cache is used if not set
+    @cached_property
+    def update_dedup_store_path(self) -> Optional[str]:
+        return env.get('UPDATE_DEDUP_STORE_PATH')
+
+    # settings of the long-running mode (`python3 main.py polling|webhook`)
+
+    @cached_property
+    def session_sweep_interval(self) -> int:
+        return int(env.get('SESSION_SWEEP_INTERVAL', '60'))
+
+    @cached_property
+    def webhook_listen(self) -> str:
+        return env.get('WEBHOOK_LISTEN', '0.0.0.0')
+
+    @cached_property
+    def webhook_port(self) -> int:
+        return int(env.get('WEBHOOK_PORT', '8443'))
+
+    @cached_property
+    def webhook_url(self) -> Optional[str]:
+        return env.get('WEBHOOK_URL')
+
+    @cached_property
+    def webhook_url_path(self) -> str:
+        return env.get('WEBHOOK_URL_PATH', '')
+
+    @cached_property
+    def webhook_secret_token(self) -> Optional[str]:
+        return env.get('WEBHOOK_SECRET_TOKEN')
+
+    @cached_property
+    def bot_service_eager_init(self) -> bool:
+        return env.get('BOT_SERVICE_EAGER_INIT', 'false').lower() == 'true'
+
 
-load_dotenv()
-
-TELEGRAM_BOT_TOKEN = env['TELEGRAM_BOT_TOKEN']
-TELEGRAM_USERS = loads(env['TELEGRAM_USERS'])
-TELEGRAM_CHAT_ID = int(env['TELEGRAM_CHAT_ID'])
-
-GOOGLE_SPREADSHEET_ID = env['GOOGLE_SPREADSHEET_ID']
-GOOGLE_SPREADSHEET_USER_COLUMNS = loads(env['GOOGLE_SPREADSHEET_USER_COLUMNS'])
-GOOGLE_SPREADSHEET_FIRST_DATA_ROW = int(env['GOOGLE_SPREADSHEET_FIRST_DATA_ROW'])
-GOOGLE_API_ACCOUNT={
-  "type": env['GOOGLE_API_ACCOUNT_TYPE'],
-  "project_id": env['GOOGLE_API_ACCOUNT_PROJECT_ID'],
-  "private_key_id": env['GOOGLE_API_ACCOUNT_PRIVATE_KEY_ID'],
-  "private_key": env['GOOGLE_API_ACCOUNT_PRIVATE_KEY'],
-  "client_email": env['GOOGLE_API_ACCOUNT_CLIENT_EMAIL'],
-  "client_id": env['GOOGLE_API_ACCOUNT_CLIENT_ID'],
-  "auth_uri": env['GOOGLE_API_ACCOUNT_AUTH_URI'],
-  "token_uri": env['GOOGLE_API_ACCOUNT_TOKEN_URI'],
-  "auth_provider_x509_cert_url": env['GOOGLE_API_ACCOUNT_AUTH_PROVIDER_X509_CERT_URL'],
-  "client_x509_cert_url": env['GOOGLE_API_ACCOUNT_CLIENT_X509_CERT_URL']
-}
-
-SELECT_USER_SESSION_TTL = int(env['SELECT_USER_SESSION_TTL'])
-CONFIRM_REQUEST_SESSION_TTL = int(env['CONFIRM_REQUEST_SESSION_TTL'])
+@lru_cache(maxsize=None)
+def get_config() -> Config:
+    load_env_file()
+    return Config()
@@ -1,26 +1,120 @@
+from services import startup_profiler
+
+# installed first, so the imports below are profiled as well (see `STARTUP_PROFILE`)
+startup_profiler.install_if_enabled()
+
+from time import perf_counter
 import asyncio
 import json
-import logging
 
-from main import init
+from config import get_config
+from services.logs import configure_logging, get_logger, LazyJson
 
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
+logger = get_logger(__name__)
+configure_logging()
 
 loop = asyncio.get_event_loop()
 
+bot_service = None
+
+def get_bot_service():
+    global bot_service
+
+    # the bot and its dependencies are imported on the first use, so the import of the handler stays cheap
+    if bot_service is None:
+        from main import get_bot_service as init_bot_service
+        bot_service = init_bot_service()
+    return bot_service
+
+if get_config().bot_service_eager_init:
+    # tenants are loaded lazily, so the default one is loaded here to connect to its storage before the first update
+    loop.run_until_complete(get_bot_service().tenant_service.get_tenant(get_config().telegram_chat_id))
+
+invocations_count = 0
+
+def flush_pending_writes(bot_service):
+    # the container might be frozen right after the response, so journaled votes are written before it
+    try:
+        loop.run_until_complete(bot_service.flush_pending_writes())
+    except Exception as e:
+        logger.error("Error flushing pending writes, they will be retried by the next invocation: %s", e)
+
+def process_records(records):
+    updates = []
+    updates_records = []
+    failed_records = []
+
+    for record in records:
+        try:
+            updates.append(json.loads(record["body"]))
+            updates_records.append(record)
+        except Exception as e:
+            logger.error("Error parsing record (message_id=%s): %s", record.get('messageId'), e)
+            failed_records.append(record)
+
+    bot_service = get_bot_service()
+    failed_indexes = loop.run_until_complete(bot_service.process_updates(updates))
+    failed_records += [updates_records[index] for index in failed_indexes]
+    flush_pending_writes(bot_service)
+
+    # only the failed records are returned to the queue (requires `ReportBatchItemFailures` on the event source)
+    return { "batchItemFailures": [{ "itemIdentifier": record["messageId"] } for record in failed_records] }
+
+def process_body(body):
+    bot_service = get_bot_service()
+
+    if isinstance(body, list):
+        failed_indexes = loop.run_until_complete(bot_service.process_updates(body))
+        flush_pending_writes(bot_service)
+
+        failed_update_ids = [body[index].get("update_id") for index in failed_indexes]
+        return { "statusCode": 200, "body": json.dumps({ "failed_update_ids": failed_update_ids }) }
+
+    # dropped updates don't write anything, so they return without waiting for the storage
+    if loop.run_until_complete(bot_service.process_update(body)):
+        flush_pending_writes(bot_service)
+
+    return { "statusCode": 200 }
+
+def log_invocation_metrics(elapsed):
+    if bot_service is None or bot_service.metrics_service is None:
+        return
+
+    # one JSON line per invocation, so the metrics can be extracted by CloudWatch metric filters or Logs Insights
+    metrics = bot_service.metrics_service.pop_invocation_metrics()
+    metrics["invocation"] = { "warm": invocations_count > 1, "elapsed_ms": round(elapsed * 1000, 2) }
+    logger.info("Invocation metrics: %s", LazyJson(metrics))
+
 def webhook(event, _):
+    global invocations_count
+
+    started_at = perf_counter()
+    invocations_count += 1
+
     try:
-        logger.info(event)
-        update = json.loads(event["body"])
+        logger.debug("Event received: %s", LazyJson(event))
+
+        # SQS batches come as records, while API Gateway passes either a single update or a list of them
+        if "Records" in event:
+            return process_records(event["Records"])
 
-        bot_service = init()
-        loop.run_until_complete(bot_service.process_update(update))
+        return process_body(json.loads(event["body"]))
 
-        return { "statusCode": 200 }
-                
     except Exception as e:
         logger.error(e)
 
+        if "Records" in event:
+            return { "batchItemFailures": [{ "itemIdentifier": record["messageId"] } for record in event["Records"]] }
+
         return { "statusCode": 500 }
 
+    finally:
+        logger.info(
+            "Invocation finished (warm=%s, eager_init=%s, dropped_updates=%s, elapsed=%.3fs)",
+            invocations_count > 1,
+            get_config().bot_service_eager_init,
+            dict(bot_service.dropped_updates) if bot_service else {},
+            perf_counter() - started_at
+        )
+        log_invocation_metrics(perf_counter() - started_at)
+        startup_profiler.report_first_update()
@@ -1,44 +1,231 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from time import perf_counter
+import json
 import logging
+import os
+import sys
 
-from config import TELEGRAM_BOT_TOKEN, TELEGRAM_USERS, TELEGRAM_CHAT_ID, GOOGLE_API_ACCOUNT, GOOGLE_SPREADSHEET_ID, SELECT_USER_SESSION_TTL
-from config import CONFIRM_REQUEST_SESSION_TTL, GOOGLE_SPREADSHEET_USER_COLUMNS, GOOGLE_SPREADSHEET_FIRST_DATA_ROW
+from config import get_config
 
-from services.google_spreadsheet import GoogleSpreadsheetService
 from services.karma import KarmaService
-from services.bot import BotService
+from services.leaderboard import LeaderboardService
+from services.metrics import MetricsService
+from services.dedup import UpdateDedupService
 from services.session import SessionService, SessionType
+from services.session_store import MemorySessionStore
+from services.tenant import Tenant, TenantService
+from services.storage import STORAGE_IO_METHODS
 from services.users import UsersService
+from services.user_profiles import UserProfilesService
+from services.logs import configure_logging, get_logger
 
 
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
+logger = get_logger(__name__)
 
-def init():
-    google_spreadsheet_service = GoogleSpreadsheetService(
-        account_dict=GOOGLE_API_ACCOUNT,
-        spreadsheet_id=GOOGLE_SPREADSHEET_ID,
-        spreadsheet_user_columns=GOOGLE_SPREADSHEET_USER_COLUMNS,
-        spreadsheet_first_data_row=GOOGLE_SPREADSHEET_FIRST_DATA_ROW
+def get_partition_path(path, chat_id):
+    # every tenant but the default one gets its own database file, so tenants never share a lock
+    if chat_id == get_config().telegram_chat_id:
+        return path
+
+    (root, extension) = os.path.splitext(path)
+    return f"{root}-{chat_id}{extension}"
+
+def load_tenant_config(chat_id):
+    config = get_config()
+
+    if chat_id == config.telegram_chat_id:
+        return {
+            "users": config.telegram_users,
+            "spreadsheet_user_columns": config.google_spreadsheet_user_columns,
+            "spreadsheet_worksheet": None,
+            "spreadsheet_checkpoints_worksheet": config.google_spreadsheet_checkpoints_worksheet,
+            "admin_users": config.telegram_admin_users
+        }
+
+    if not config.tenants_config_dir:
+        return None
+
+    tenant_config_path = os.path.join(config.tenants_config_dir, f"{chat_id}.json")
+    if not os.path.exists(tenant_config_path):
+        return None
+
+    with open(tenant_config_path) as tenant_config_file:
+        return json.load(tenant_config_file)
+
+def init_storage_service(chat_id, tenant_config, metrics_service=None):
+    config = get_config()
+
+    # storage clients are imported only by the backend in use, gspread and google-auth take most of the import time
+    if config.storage_backend == 'google_spreadsheet':
+        from services.google_spreadsheet import GoogleSpreadsheetService
+
+        return GoogleSpreadsheetService(
+            account_dict=config.google_api_account,
+            spreadsheet_id=tenant_config.get("spreadsheet_id", config.google_spreadsheet_id),
+            spreadsheet_user_columns=tenant_config["spreadsheet_user_columns"],
+            spreadsheet_first_data_row=tenant_config.get("spreadsheet_first_data_row", config.google_spreadsheet_first_data_row),
+            handle_ttl=config.google_spreadsheet_handle_ttl,
+            worksheet_title=tenant_config.get("spreadsheet_worksheet", str(chat_id)),
+            checkpoints_worksheet_title=tenant_config.get(
+                "spreadsheet_checkpoints_worksheet",
+                f"{config.google_spreadsheet_checkpoints_worksheet}-{chat_id}"
+            ),
+            checkpoint_interval=config.google_spreadsheet_checkpoint_interval,
+            metrics_service=metrics_service,
+            api_url=config.google_sheets_api_url
+        )
+
+    if config.storage_backend == 'sqlite':
+        from services.sqlite_ledger import SQLiteLedgerService
+
+        return SQLiteLedgerService(database_path=get_partition_path(config.sqlite_ledger_path, chat_id), users=tenant_config["users"])
+
+    raise Exception(f"Unknown storage backend: {config.storage_backend}")
+
+def init_tenant(chat_id, metrics_service=None):
+    tenant_config = load_tenant_config(chat_id)
+    if tenant_config is None:
+        return None
+
+    config = get_config()
+
+    journal_service = None
+    if config.karma_journal_path:
+        from services.journal import JournalService
+
+        journal_service = JournalService(database_path=get_partition_path(config.karma_journal_path, chat_id))
+
+    storage_service = init_storage_service(chat_id, tenant_config, metrics_service)
+
+    if metrics_service:
+        metrics_service.instrument(storage_service, "storage", STORAGE_IO_METHODS)
+        if journal_service:
+            metrics_service.instrument(journal_service, "journal", ("append", "get_pending", "remove"))
+
+    # every tenant has its own storage threads, so a slow storage of one tenant doesn't delay the others
+    karma_service = KarmaService(
+        storage_service=storage_service,
+        executor=ThreadPoolExecutor(max_workers=config.storage_max_workers, thread_name_prefix=f"storage-{chat_id}"),
+        leaderboard_service=LeaderboardService(),
+        totals_ttl=config.karma_totals_cache_ttl,
+        journal_service=journal_service,
+        journal_flush_interval=config.karma_journal_flush_interval,
+        journal_flush_batch_size=config.karma_journal_flush_batch_size
+    )
+
+    return Tenant(
+        chat_id=chat_id,
+        users_service=UsersService(users=tenant_config["users"]),
+        karma_service=karma_service,
+        admin_users=tenant_config.get("admin_users", [])
     )
 
-    session_service = SessionService(session_ttls={
-        SessionType.SELECT_USER: SELECT_USER_SESSION_TTL,
-        SessionType.CONFIRM_REQUEST: CONFIRM_REQUEST_SESSION_TTL
-    })
+def init_session_store():
+    config = get_config()
+
+    if config.session_store == 'memory':
+        return MemorySessionStore()
 
-    karma_service = KarmaService(google_spreadsheet_service=google_spreadsheet_service)
-    users_service = UsersService(users=TELEGRAM_USERS)
+    if config.session_store == 'sqlite':
+        from services.session_store import SQLiteSessionStore
+
+        return SQLiteSessionStore(database_path=config.session_store_path)
+
+    raise Exception(f"Unknown session store: {config.session_store}")
+
+def init_dedup_service():
+    config = get_config()
+
+    store = None
+    if config.update_dedup_store_path:
+        from services.dedup import SQLiteDedupStore
+
+        store = SQLiteDedupStore(database_path=config.update_dedup_store_path)
+
+    return UpdateDedupService(max_size=config.update_dedup_cache_size, ttl=config.update_dedup_ttl, store=store)
+
+def init():
+    # python-telegram-bot is the largest import of the bot, so it's imported only when the bot is created
+    from services.bot import BotService
+
+    config = get_config()
+
+    metrics_service = MetricsService() if config.metrics_enabled else None
+
+    session_service = SessionService(
+        session_ttls={
+            SessionType.SELECT_USER: config.select_user_session_ttl,
+            SessionType.CONFIRM_REQUEST: config.confirm_request_session_ttl
+        },
+        store=init_session_store()
+    )
+    tenant_service = TenantService(
+        load_tenant=partial(init_tenant, metrics_service=metrics_service),
+        missing_tenant_ttl=config.tenants_missing_config_ttl
+    )
+    user_profiles_service = UserProfilesService(
+        max_size=config.user_profiles_cache_size,
+        ttl=config.user_profiles_cache_ttl,
+        refresh_after=config.user_profiles_cache_refresh_after
+    )
 
     bot_service = BotService(
-        token=TELEGRAM_BOT_TOKEN,
-        karma_service=karma_service,
+        token=config.telegram_bot_token,
+        tenant_service=tenant_service,
         session_service=session_service,
-        users_service=users_service,
-        chat_id=TELEGRAM_CHAT_ID
+        user_profiles_service=user_profiles_service,
+        concurrent_updates=config.telegram_concurrent_updates,
+        base_url=config.telegram_api_base_url,
+        chat_messages_per_minute=config.telegram_chat_messages_per_minute or None,
+        messages_per_second=config.telegram_messages_per_second or None,
+        send_max_retries=config.telegram_send_max_retries,
+        send_shutdown_timeout=config.telegram_send_shutdown_timeout,
+        dedup_service=init_dedup_service(),
+        metrics_service=metrics_service
     )
 
     return bot_service
 
+# process-wide instance which is reused by warm Lambda containers
+bot_service_instance = None
+
+def get_bot_service():
+    global bot_service_instance
+
+    if bot_service_instance is None:
+        started_at = perf_counter()
+        bot_service_instance = init()
+        logger.info("BotService was created (elapsed=%.3fs)", perf_counter() - started_at)
+
+    return bot_service_instance
+
+def run(mode):
+    config = get_config()
+
+    if mode == 'polling':
+        bot_service = init()
+        bot_service.run_polling(sweep_interval=config.session_sweep_interval)
+        return
+
+    if mode == 'webhook':
+        if not config.webhook_url:
+            raise Exception("WEBHOOK_URL is required to run the bot in webhook mode")
+
+        bot_service = init()
+        bot_service.run_webhook(
+            listen=config.webhook_listen,
+            port=config.webhook_port,
+            webhook_url=config.webhook_url,
+            url_path=config.webhook_url_path,
+            secret_token=config.webhook_secret_token,
+            sweep_interval=config.session_sweep_interval
+        )
+        return
+
+    raise Exception(f"Unknown run mode: {mode}")
+
 if __name__ == '__main__':
-    bot_service = init()
-    bot_service.run()
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    configure_logging()
+    run(sys.argv[1] if len(sys.argv) > 1 else 'polling')
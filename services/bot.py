@@ -1,12 +1,16 @@
-from telegram import Update, MessageEntity, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import filters, ApplicationBuilder, ContextTypes
-from telegram.ext import CommandHandler, MessageHandler, CallbackQueryHandler
-from telegram.constants import ParseMode
+from telegram import Chat, Update, User, MessageEntity, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import filters, Application, ApplicationBuilder, ContextTypes
+from telegram.ext import CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler
+from telegram.request import BaseRequest, HTTPXRequest
+from collections import Counter
+from datetime import datetime
 from enum import Enum
+from time import perf_counter
 import asyncio
-import logging
 
 from services.session import SessionType
+from services.send_queue import SendQueueService
+from services.logs import get_logger, redact_text, LazyUpdate
 
 
 class ConfirmOptions(str, Enum):
@@ -18,6 +22,90 @@ class RequestType(str, Enum):
     DOWN = 'DOWN'
 
 
+# periods of `/top` command mapped with their length in days and their title
+TOP_PERIODS = {
+    'day': (1, 'за сегодня'),
+    'week': (7, 'за неделю'),
+    'month': (30, 'за месяц')
+}
+DEFAULT_TOP_PERIOD = 'week'
+HISTORY_LIMIT = 10
+# `/stats` is sent as one message, which is limited to 4096 characters
+STATS_TEXT_MAX_LENGTH = 3500
+TELEGRAM_CONNECTION_POOL_SIZE = 128
+# the notice about a stale request, the ones queued in a chat at the same time are sent as one message
+REQUEST_EXPIRED_TEXT = "\uE252 _Запрос более не актуален_"
+REQUEST_EXPIRED_COALESCED_TEXT = "\uE252 _Запросы более не актуальны: {count}_"
+
+# update fields which carry a message, in the order they are looked up for the chat of the update
+MESSAGE_UPDATE_FIELDS = ('message', 'edited_message', 'channel_post', 'edited_channel_post')
+
+
+# reasons of dropping raw updates before they are deserialized, they are counted in `BotService.dropped_updates`
+class DropReason(str, Enum):
+    NO_CHAT = 'no_chat'
+    NOT_COMMAND = 'not_command'
+    FOREIGN_CHAT = 'foreign_chat'
+    DUPLICATE = 'duplicate'
+
+
+def get_update_message(update_json):
+    for field in MESSAGE_UPDATE_FIELDS:
+        if field in update_json:
+            return update_json[field]
+
+    return update_json.get('callback_query', {}).get('message')
+
+def get_update_chat_id(update_json):
+    message = get_update_message(update_json)
+    return None if not message else message['chat']['id']
+
+def is_command_message(message_json):
+    # mirrors `CommandHandler`, which handles only messages starting with a command
+    entities = message_json.get('entities')
+    return bool(entities) and entities[0]['type'] == MessageEntity.BOT_COMMAND and entities[0]['offset'] == 0
+
+
+class MetricsRequest(BaseRequest):
+    # wraps the request object of the bot to count calls, bytes and latency of every Bot API method
+    def __init__(self, metrics_service, request):
+        self.metrics_service = metrics_service
+        self.request = request
+
+    async def initialize(self):
+        await self.request.initialize()
+
+    async def shutdown(self):
+        await self.request.shutdown()
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        started_at = perf_counter()
+
+        try:
+            (status_code, payload) = await self.request.do_request(url, method, request_data, *args, **kwargs)
+        except Exception:
+            self.metrics_service.increment(f"telegram.{api_method}.errors")
+            raise
+        finally:
+            self.metrics_service.observe(f"telegram.{api_method}", perf_counter() - started_at)
+
+        if request_data is not None and not request_data.contains_files:
+            self.metrics_service.increment("telegram.bytes_sent", len(request_data.json_payload))
+        self.metrics_service.increment("telegram.bytes_received", len(payload))
+        return (status_code, payload)
+
+
+class BotApplication(Application):
+    # `before_shutdown` runs while the bot can still make calls, e.g. on SIGTERM in long-running mode
+    before_shutdown = None
+
+    async def shutdown(self):
+        if self.before_shutdown is not None and self._initialized:
+            await self.before_shutdown()
+        await super().shutdown()
+
+
 def restrict_public_access(inherited_self=None):
     def _restrict_public_access(command):
         async def _restricted_command(*args):
@@ -30,58 +118,142 @@ def restrict_public_access(inherited_self=None):
             from_chat_id = None if not message.chat else message.chat.id
             from_user = message["from"]
 
-            if from_chat_id != self.chat_id:
-                logger.error(f"Received update from prohibited chat (chat_id={from_chat_id}, user={from_user})")
+            tenant = await self.tenant_service.get_tenant(from_chat_id)
+            if tenant is None:
+                logger.error("Received update from prohibited chat (chat_id=%s, user=%s)", from_chat_id, from_user)
 
                 reply_text = f"\uE252 _Бот не может быть использован в этом чате_"
-                await message.reply_text(text=reply_text, parse_mode=ParseMode.MARKDOWN)
+                await self._reply(message, reply_text)
                 return
 
-            await command(*args)
+            await command(*args, tenant)
 
         return _restricted_command
     return _restrict_public_access
 
 
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
+def restrict_admin_access(command):
+    async def _restricted_command(self, update, context, tenant):
+        from_user = update.message["from"]
+
+        # admins are set per tenant, so an admin of one chat can't run admin commands in the others
+        if from_user.id not in tenant.admin_users:
+            logger.error("Received admin command from non-admin user (chat_id=%s, user=%s)", tenant.chat_id, from_user)
+
+            reply_text = f"\uE252 _Команда доступна только администраторам_"
+            await self._reply(update.message, reply_text)
+            return
+
+        await command(self, update, context, tenant)
+
+    return _restricted_command
+
+
+logger = get_logger(__name__)
 
 class BotService:
-    def __init__(self, token, karma_service, session_service, users_service, chat_id):
-        self.application = ApplicationBuilder().token(token).build()
-        self.karma_service = karma_service
+    def __init__(
+        self,
+        token,
+        tenant_service,
+        session_service,
+        user_profiles_service,
+        concurrent_updates=False,
+        base_url=None,
+        dedup_service=None,
+        metrics_service=None,
+        request=None,
+        chat_messages_per_minute=None,
+        messages_per_second=None,
+        send_max_retries=3,
+        send_shutdown_timeout=None
+    ):
+        # the request object of the Bot API calls can be replaced, e.g. by a stub in benchmarks
+        request = request or HTTPXRequest(connection_pool_size=TELEGRAM_CONNECTION_POOL_SIZE)
+        if metrics_service:
+            request = MetricsRequest(metrics_service, request)
+
+        application_builder = ApplicationBuilder().application_class(BotApplication).token(token).concurrent_updates(concurrent_updates).request(request)
+        if base_url:
+            application_builder.base_url(base_url)
+        self.application = application_builder.build()
+        self.metrics_service = metrics_service
+        # messages are sent through the queue, so bursts of replies and deletes don't run into the flood control
+        self.send_queue_service = SendQueueService(
+            bot=self.application.bot,
+            chat_messages_per_minute=chat_messages_per_minute,
+            messages_per_second=messages_per_second,
+            max_retries=send_max_retries,
+            metrics_service=metrics_service
+        )
+        self.send_shutdown_timeout = send_shutdown_timeout
+        self.application.before_shutdown = self._drain_send_queue
+        self.tenant_service = tenant_service
         self.session_service = session_service
-        self.users_service = users_service
-        self.chat_id = chat_id
+        self.user_profiles_service = user_profiles_service
+        self.dedup_service = dedup_service
+        # ids of updates whose handlers raised, they are reported as failed by `process_updates`
+        self.failed_updates = set()
+        # numbers of updates dropped by `_filter_update` per `DropReason`
+        self.dropped_updates = Counter()
+
+        self.session_service.register_expired_callback(SessionType.SELECT_USER, self._select_user_expired_callback)
+        self.session_service.register_expired_callback(SessionType.CONFIRM_REQUEST, self._confirm_request_expired_callback)
 
         self.confirm_request_reply_markup = self._build_reply_markup({
             ConfirmOptions.CONFIRM: 'Разрешить',
             ConfirmOptions.DECLINE: 'Отклонить'
         })
 
-        start_handler = CommandHandler('help', self.help)
+        # runs before the other handlers, so every update keeps the profile of its sender up to date
+        remember_user_handler = TypeHandler(Update, self.remember_user)
+        self.application.add_handler(remember_user_handler, group=-1)
+
+        start_handler = CommandHandler('help', self._timed('help', self.help))
         self.application.add_handler(start_handler)
         
-        up_handler = CommandHandler('up', self._create_request_command(RequestType.UP))
+        up_handler = CommandHandler('up', self._timed('up', self._create_request_command(RequestType.UP)))
         self.application.add_handler(up_handler)
 
-        down_handler = CommandHandler('down', self._create_request_command(RequestType.DOWN))
+        down_handler = CommandHandler('down', self._timed('down', self._create_request_command(RequestType.DOWN)))
         self.application.add_handler(down_handler)
 
-        show_handler = CommandHandler('show', self.show)
+        show_handler = CommandHandler('show', self._timed('show', self.show))
         self.application.add_handler(show_handler)
 
+        top_handler = CommandHandler('top', self._timed('top', self.top))
+        self.application.add_handler(top_handler)
+
+        history_handler = CommandHandler('history', self._timed('history', self.history))
+        self.application.add_handler(history_handler)
+
+        compact_handler = CommandHandler('compact', self._timed('compact', self.compact))
+        self.application.add_handler(compact_handler)
+
+        stats_handler = CommandHandler('stats', self.stats)
+        self.application.add_handler(stats_handler)
+
         unknown_handler = MessageHandler(filters.COMMAND, self.unknown)
         self.application.add_handler(unknown_handler)
 
-        select_user_callback_query_handler = CallbackQueryHandler(self.select_user, pattern=r"^\d+$")
+        select_user_callback_query_handler = CallbackQueryHandler(self._timed('select_user', self.select_user), pattern=r"^\d+$")
         self.application.add_handler(select_user_callback_query_handler)
 
-        confirm_request_callback_query_handler = CallbackQueryHandler(self.confirm_request, pattern=rf"^(?:{ConfirmOptions.CONFIRM}|{ConfirmOptions.DECLINE})$")
+        confirm_request_callback_query_handler = CallbackQueryHandler(
+            self._timed('confirm_request', self.confirm_request),
+            pattern=rf"^(?:{ConfirmOptions.CONFIRM}|{ConfirmOptions.DECLINE})$"
+        )
         self.application.add_handler(confirm_request_callback_query_handler)
 
+        self.application.add_error_handler(self.handler_error)
+
         logger.info('BotService initialized')
 
+    def _timed(self, name, handler):
+        if not self.metrics_service:
+            return handler
+        return self.metrics_service.timed(f"handler.{name}", handler)
+
     def _get_user_markup(self, user):
         user_name = user.id
         if user.first_name:
@@ -112,33 +284,47 @@ class BotService:
             resize_keyboard=True
         )
 
-    async def _get_user_data(self, update: Update, user_id):
+    async def _get_user_data(self, chat_id, user_id):
         try:
-            user_data = await update.message.chat.get_member(user_id)
-            logger.info(f"Received user data from API (user_id={user_id}): {user_data}")
+            user_data = await self.application.bot.get_chat_member(chat_id=chat_id, user_id=user_id)
+            logger.info("Received user data from API (user_id=%s): %s", user_id, user_data)
             return user_data.user
         except Exception as err:
-            logger.error(f"Error fetching user data from API (user_id={user_id}): {err}")
+            logger.error("Error fetching user data from API (user_id=%s): %s", user_id, err)
             return None
 
+    def _delete_message(self, chat_id, message_id):
+        self.send_queue_service.delete_message(chat_id, message_id)
+
+    async def _reply_to_message(self, chat_id, message_id, text, reply_markup=None):
+        return await self.send_queue_service.send_message(chat_id, text, reply_to_message_id=message_id, reply_markup=reply_markup)
+
+    async def _reply(self, message, text, reply_markup=None):
+        # the message is quoted outside of private chats, as `Message.reply_text` does
+        reply_to_message_id = None if message.chat.type == Chat.PRIVATE else message.message_id
+        return await self._reply_to_message(message.chat_id, reply_to_message_id, text, reply_markup=reply_markup)
+
+    def _send_request_expired_notice(self, chat_id, request_message_id):
+        self.send_queue_service.send_notice(chat_id, REQUEST_EXPIRED_TEXT, request_message_id, REQUEST_EXPIRED_COALESCED_TEXT)
+
     async def _select_user_expired_callback(self, session):
-        logger.info(f"Expired callback was triggered for session (session_id={session['id']}, session_type=SessionType.SELECT_USER)")
-        logger.warning(f"Select user message will be deleted (message_id={session['data']['select_user_message'].message_id})")
+        logger.info("Expired callback was triggered for session (session_id=%s, session_type=SessionType.SELECT_USER)", session.id)
+        logger.warning("Select user message will be deleted (message_id=%s)", session.message_id)
 
-        await session["data"]["select_user_message"].delete()
-        await session["data"]["request_message"].reply_text(text=f"\uE252 _Запрос более не актуален_", parse_mode=ParseMode.MARKDOWN)
+        self._delete_message(session.chat_id, session.message_id)
+        self._send_request_expired_notice(session.chat_id, session.data["request_message_id"])
 
     async def _confirm_request_expired_callback(self, session):
-        logger.info(f"Expired callback was triggered for session (session_id={session['id']}, session_type=SessionType.CONFIRM_REQUEST)")
-        logger.warning(f"Confirm request message will be deleted (message_id={session['data']['confirm_request_message'].message_id})")
+        logger.info("Expired callback was triggered for session (session_id=%s, session_type=SessionType.CONFIRM_REQUEST)", session.id)
+        logger.warning("Confirm request message will be deleted (message_id=%s)", session.message_id)
 
-        await session["data"]["confirm_request_message"].delete()
-        await session["data"]["request_message"].reply_text(text=f"\uE252 _Запрос более не актуален_", parse_mode=ParseMode.MARKDOWN)
+        self._delete_message(session.chat_id, session.message_id)
+        self._send_request_expired_notice(session.chat_id, session.data["request_message_id"])
 
     def _create_request_command(self, request_type):
         @restrict_public_access(self)
-        async def request_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-            logger.info(f"Update received: {update}")
+        async def request_command(update: Update, context: ContextTypes.DEFAULT_TYPE, tenant):
+            logger.info("Update received (%s)", LazyUpdate(update), extra={"event": "update_received"})
 
             command_entity = update.message.entities[0]
             reason = update.message.text[command_entity.offset+command_entity.length:].strip()
@@ -147,50 +333,53 @@ class BotService:
             request_message = update.message
             requesting_user = update.message['from']
 
-            if self.session_service.user_has_session(requesting_user.id, filter_by_type=SessionType.SELECT_USER):
-                logger.error(f"User already has an active session (user_id={requesting_user.id}, session_type=SessionType.SELECT_USER)")
+            if self.session_service.user_has_session(request_message.chat_id, requesting_user.id, filter_by_type=SessionType.SELECT_USER):
+                logger.error("User already has an active session (user_id=%s, session_type=SessionType.SELECT_USER)", requesting_user.id)
 
                 reply_text = f"\uE252 _Активная сессия выбора участника уже была инициирована_"
-                await request_message.reply_text(text=reply_text, parse_mode=ParseMode.MARKDOWN)
+                await self._reply(request_message, reply_text)
                 return
 
             reply_text = f"\U0001F464 Выберите участника:"
-            reply_markup = self._build_reply_markup(self.users_service.get_all_users(except_user=requesting_user.id))
-            select_user_message = await request_message.reply_text(text=reply_text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
+            reply_markup = self._build_reply_markup(tenant.users_service.get_all_users(except_user=requesting_user.id))
+            select_user_message = await self._reply(request_message, reply_text, reply_markup=reply_markup)
 
-            logger.info(f"Select user message was sent (message_id={select_user_message.message_id})")
+            logger.info("Select user message was sent (message_id=%s)", select_user_message.message_id)
 
             try:
                 session_data = {
-                    "requesting_user": requesting_user,
-                    "request_message": request_message,
-                    "request_type": request_type,
-                    "select_user_message": select_user_message,
+                    "requesting_user_id": requesting_user.id,
+                    "request_message_id": request_message.message_id,
+                    "request_type": request_type.value,
                     "reason": reason
                 }
 
                 session_id = self.session_service.create_session(
-                    id=select_user_message.message_id,
                     type=SessionType.SELECT_USER,
                     user=requesting_user,
-                    expired_callback=self._select_user_expired_callback,
+                    chat_id=select_user_message.chat_id,
+                    message_id=select_user_message.message_id,
                     data=session_data
                 )
 
-                logger.info(f"Session was created (user_id={requesting_user.id}, session_type=SessionType.SELECT_USER)")
+                logger.info("Session was created (user_id=%s, session_type=SessionType.SELECT_USER)", requesting_user.id)
             except Exception as err:
-                logger.error(f"Error creating session for user (user_id={requesting_user.id}, session_type=SessionType.SELECT_USER): {err}")
-                logger.warning(f"Select user message will be deleted (message_id={select_user_message.message_id})")
+                logger.error("Error creating session for user (user_id=%s, session_type=SessionType.SELECT_USER): %s", requesting_user.id, err)
+                logger.warning("Select user message will be deleted (message_id=%s)", select_user_message.message_id)
 
-                await select_user_message.delete()
+                self._delete_message(select_user_message.chat_id, select_user_message.message_id)
 
                 reply_text = f"\uE252 _Команда не может быть выполнена_"
-                await request_message.reply_text(text=reply_text, parse_mode=ParseMode.MARKDOWN)
+                await self._reply(request_message, reply_text)
                 
         return request_command
 
+    async def remember_user(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if update.effective_chat and await self.tenant_service.get_tenant(update.effective_chat.id):
+            self.user_profiles_service.remember(update.effective_user)
+
     @restrict_public_access()
-    async def help(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async def help(self, update: Update, context: ContextTypes.DEFAULT_TYPE, tenant):
         reply_text="\U0001F921 Я *Карма Бот*, я манипулирую кармой\n\n" \
             + "Поддерживаются следующие команды:\n\n" \
             + "  - `/help`: вывести список поддерживаемых команд\n\n" \
@@ -198,264 +387,608 @@ class BotService:
             + "  - `/down [reason]`: запросить участнику *-1 ОК* по причине `\"reason\"` (опционально)\n\n" \
             + "  - `/show [user_mention]`: показать количество *ОК* участника `\"@user_mention\"` (или всех участников, если параметр не задан)"
 
-        await update.message.reply_text(text=reply_text, parse_mode=ParseMode.MARKDOWN)
-        
-    @restrict_public_access()
-    async def show(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        logger.info(f"Update received: {update}")
+        # the commands which need the data the storage of the tenant doesn't keep are not listed
+        if tenant.karma_service.supports_window_totals():
+            reply_text += "\n\n  - `/top [day|week|month]`: показать рейтинг участников за период (по умолчанию за неделю)"
+        if tenant.karma_service.supports_history():
+            reply_text += "\n\n  - `/history [user_mention]`: показать последние изменения *ОК* участника `\"@user_mention\"` (или свои, если параметр не задан)"
+
+        await self._reply(update.message, reply_text)
+
+    async def _reply_unsupported(self, update, command):
+        logger.warning("Command is not supported by the storage (command=%s)", command)
 
+        reply_text=f"\uE252 _Команда не поддерживается хранилищем_"
+        await self._reply(update.message, reply_text)
+        
+    def _get_mentioned_user(self, update):
         mention_entity = None if len(update.message.entities) < 2 else update.message.entities[1]
-        mentioned_user = None
         if mention_entity and mention_entity.user and mention_entity.type == MessageEntity.TEXT_MENTION:
-            mentioned_user = mention_entity.user
+            return mention_entity.user
+        return None
+
+    def _get_command_argument(self, update):
+        command_entity = update.message.entities[0]
+        argument = update.message.text[command_entity.offset+command_entity.length:].strip()
+        return None if len(argument) == 0 else argument
+
+    async def _render_totals(self, title, total, tenant):
+        users = await self.user_profiles_service.get_users(
+            [record[0] for record in total],
+            lambda user_id: self._get_user_data(tenant.chat_id, user_id)
+        )
+
+        reply_text = f"{title}:\n\n"
+        for (index, record) in enumerate(total):
+            [user_id, amount] = record
+            if users[index]:
+                user = self._get_user_markup(users[index])
+            else:
+                user = tenant.users_service.get_user_name(user_id)
+            reply_text += f"  {index + 1}. {user}: *{amount} OK*\n"
+        return reply_text
+
+    async def _render_ranking(self, leaderboard, tenant):
+        version = leaderboard.version
+        total = leaderboard.get_ranking()
+
+        logger.info("Received total values for all users: %s", total)
+
+        reply_text = await self._render_totals("\uE131 Текущий рейтинг участников", total, tenant)
+
+        # the names version is taken after fetching, since fetched profiles are cached as well
+        leaderboard.set_rendered_text(reply_text, version, self.user_profiles_service.version)
+        return reply_text
+
+    @restrict_public_access()
+    async def show(self, update: Update, context: ContextTypes.DEFAULT_TYPE, tenant):
+        logger.info("Update received (%s)", LazyUpdate(update), extra={"event": "update_received"})
+
+        mentioned_user = self._get_mentioned_user(update)
 
         # show info for specific user only
         if mentioned_user:
-            logger.info(f"Found mentioned user. Getting total value for the user: {mentioned_user}")
+            logger.info("Found mentioned user. Getting total value for the user: %s", mentioned_user)
 
             try:
-                total = self.karma_service.get_total_value(mentioned_user.id)
+                leaderboard = await tenant.karma_service.get_leaderboard()
+                total = leaderboard.get_total(mentioned_user.id)
+                rank = leaderboard.get_rank(mentioned_user.id)
             except Exception as err:
-                logger.error(f"Error getting total value for the user (user_id={mentioned_user.id}): {err}")
+                logger.error("Error getting total value for the user (user_id=%s): %s", mentioned_user.id, err)
 
                 reply_text=f"\uE252 _Упомянутый участник не зарегистрирован_"
-                await update.message.reply_text(text=reply_text, parse_mode=ParseMode.MARKDOWN)
+                await self._reply(update.message, reply_text)
             else:
-                logger.info(f"Received total values for the user (user_id={mentioned_user.id}): {total}")
+                logger.info("Received total values for the user (user_id=%s): %s", mentioned_user.id, total)
 
-                reply_text=f"\U0001F50E Участник {self._get_user_markup(mentioned_user)} имеет *{total} OK*"
-                await update.message.reply_text(text=reply_text, parse_mode=ParseMode.MARKDOWN)
+                reply_text=f"\U0001F50E Участник {self._get_user_markup(mentioned_user)} имеет *{total} OK* и занимает *{rank}* место в рейтинге"
+                await self._reply(update.message, reply_text)
         
         # show info for all users
         else:
-            logger.info(f"No mentioned user found. Getting total values for all users")
+            logger.info("No mentioned user found. Getting total values for all users")
 
             try:
-                total = self.karma_service.get_total_values()
-                total = sorted(list(total.items()), key=lambda item: item[1], reverse=True)
+                leaderboard = await tenant.karma_service.get_leaderboard()
             except Exception as err:
-                logger.error(f"Error getting total values for all users: {err}")
+                logger.error("Error getting total values for all users: %s", err)
 
                 reply_text=f"\uE252 _Команда не может быть выполнена_"
-                await update.message.reply_text(text=reply_text, parse_mode=ParseMode.MARKDOWN)
+                await self._reply(update.message, reply_text)
                 return
 
-            logger.info(f"Received total values for all users: {total}")
+            reply_text = leaderboard.get_rendered_text(self.user_profiles_service.version)
+            if reply_text is None:
+                reply_text = await self._render_ranking(leaderboard, tenant)
+            else:
+                logger.info("Rendered ranking was taken from the cache (version=%s)", leaderboard.version)
 
-            users = await asyncio.gather(*[self._get_user_data(update, record[0]) for record in total])
+            await self._reply(update.message, reply_text)
 
-            reply_text = "\uE131 Текущий рейтинг участников:\n\n"
-            for (index, record) in enumerate(total):
-                [user_id, amount] = record
-                if users[index]:
-                    user = self._get_user_markup(users[index])
-                else:
-                    user = self.users_service.get_user_name(user_id)
-                reply_text += f"  {index + 1}. {user}: *{amount} OK*\n"           
-            await update.message.reply_text(text=reply_text, parse_mode=ParseMode.MARKDOWN)
+    @restrict_public_access()
+    async def top(self, update: Update, context: ContextTypes.DEFAULT_TYPE, tenant):
+        logger.info("Update received (%s)", LazyUpdate(update), extra={"event": "update_received"})
+
+        if not tenant.karma_service.supports_window_totals():
+            await self._reply_unsupported(update, 'top')
+            return
+
+        period = self._get_command_argument(update) or DEFAULT_TOP_PERIOD
+        if period not in TOP_PERIODS:
+            reply_text=f"\uE252 _Неизвестный период, используйте один из: {', '.join(TOP_PERIODS)}_"
+            await self._reply(update.message, reply_text)
+            return
+
+        [days, period_title] = TOP_PERIODS[period]
+
+        try:
+            window_totals = await tenant.karma_service.get_window_totals(days)
+        except Exception as err:
+            logger.error("Error getting windowed totals (period=%s): %s", period, err)
+
+            reply_text=f"\uE252 _Команда не может быть выполнена_"
+            await self._reply(update.message, reply_text)
+            return
+
+        logger.info("Received windowed totals (period=%s): %s", period, window_totals)
+
+        total = sorted(window_totals.items(), key=lambda record: (-record[1], record[0]))
+        reply_text = await self._render_totals(f"\uE131 Рейтинг участников {period_title}", total, tenant)
+        await self._reply(update.message, reply_text)
+
+    def _get_history_record_text(self, record, tenant):
+        amount_text = f"+{record['amount']}" if record["amount"] > 0 else f"{record['amount']}"
+        record_text = f"*{amount_text} OK*"
+
+        if record["ts"] is not None:
+            record_text = f"{datetime.utcfromtimestamp(record['ts']).strftime('%d.%m.%Y')}: {record_text}"
+        if record["reason"]:
+            record_text += f" по причине: _\"{record['reason']}\"_"
+        if record["confirming_user_id"] and tenant.users_service.user_exists(record["confirming_user_id"]):
+            record_text += f" (подтвердил(а) *{tenant.users_service.get_user_name(record['confirming_user_id'])}*)"
+        return record_text
 
     @restrict_public_access()
-    async def unknown(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async def history(self, update: Update, context: ContextTypes.DEFAULT_TYPE, tenant):
+        logger.info("Update received (%s)", LazyUpdate(update), extra={"event": "update_received"})
+
+        if not tenant.karma_service.supports_history():
+            await self._reply_unsupported(update, 'history')
+            return
+
+        user = self._get_mentioned_user(update) or update.message["from"]
+
+        try:
+            records = await tenant.karma_service.get_history(user.id, HISTORY_LIMIT)
+        except Exception as err:
+            logger.error("Error getting history for the user (user_id=%s): %s", user.id, err)
+
+            reply_text=f"\uE252 _Участник не зарегистрирован_"
+            await self._reply(update.message, reply_text)
+            return
+
+        if not records:
+            reply_text=f"\U0001F4DC У участника {self._get_user_markup(user)} пока нет изменений *OK*"
+        else:
+            reply_text=f"\U0001F4DC Последние изменения *OK* участника {self._get_user_markup(user)}:\n\n"
+            reply_text += "\n".join(f"  - {self._get_history_record_text(record, tenant)}" for record in records)
+
+        await self._reply(update.message, reply_text)
+
+    @restrict_public_access()
+    @restrict_admin_access
+    async def compact(self, update: Update, context: ContextTypes.DEFAULT_TYPE, tenant):
+        logger.info("Update received (%s)", LazyUpdate(update), extra={"event": "update_received"})
+
+        try:
+            compacted_count = await tenant.karma_service.compact()
+        except Exception as err:
+            logger.error("Error compacting the storage: %s", err)
+
+            reply_text=f"\uE252 _Команда не может быть выполнена_"
+            await self._reply(update.message, reply_text)
+            return
+
+        reply_text=f"\u2705 Контрольные точки обновлены, свёрнуто записей: *{compacted_count}*"
+        await self._reply(update.message, reply_text)
+
+    @restrict_public_access()
+    @restrict_admin_access
+    async def stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE, tenant):
+        if not self.metrics_service:
+            reply_text=f"\uE252 _Сбор статистики отключен_"
+            await self._reply(update.message, reply_text)
+            return
+
+        stats_text = self.metrics_service.format_text()[:STATS_TEXT_MAX_LENGTH]
+
+        reply_text=f"\U0001F4CA Статистика бота (время в мс):\n\n```\n{stats_text}\n```"
+        await self._reply(update.message, reply_text)
+
+    @restrict_public_access()
+    async def unknown(self, update: Update, context: ContextTypes.DEFAULT_TYPE, tenant):
         reply_text="\uE252 _Неизвестная команда, наберите /help для помощи_"
-        await update.message.reply_text(text=reply_text, parse_mode=ParseMode.MARKDOWN)
+        await self._reply(update.message, reply_text)
 
     @restrict_public_access()
-    async def select_user(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        logger.info(f"Update received: {update}")
+    async def select_user(self, update: Update, context: ContextTypes.DEFAULT_TYPE, tenant):
+        logger.info("Update received (%s)", LazyUpdate(update), extra={"event": "update_received"})
 
         select_user_message = update.callback_query.message
 
         try:
-            select_user_session = self.session_service.get_session(select_user_message.message_id)
+            select_user_session = self.session_service.get_session_by_message(select_user_message.chat_id, select_user_message.message_id)
         except Exception as err:
-            logger.error(f"Error getting session (session_id={select_user_message.message_id}): {err}")
-            logger.warning(f"Select user message will be deleted (message_id={select_user_message.message_id})")
+            logger.error("Error getting session (message_id=%s): %s", select_user_message.message_id, err)
+            logger.warning("Select user message will be deleted (message_id=%s)", select_user_message.message_id)
 
-            await select_user_message.delete()
+            self._delete_message(select_user_message.chat_id, select_user_message.message_id)
 
-            reply_text=f"\uE252 _Запрос более не актуален_"
-            await context.bot.send_message(chat_id=update.effective_chat.id, text=reply_text, parse_mode=ParseMode.MARKDOWN)
+            self._send_request_expired_notice(update.effective_chat.id, None)
             return
 
-        requesting_user = select_user_session["data"]["requesting_user"]
-        request_message = select_user_session["data"]["request_message"]
-        request_type = select_user_session["data"]["request_type"]
-        reason = select_user_session["data"]["reason"]
+        chat_id = select_user_session.chat_id
+        requesting_user_id = select_user_session.data["requesting_user_id"]
+        request_message_id = select_user_session.data["request_message_id"]
+        request_type = RequestType(select_user_session.data["request_type"])
+        reason = select_user_session.data["reason"]
         
         if self.session_service.session_is_expired(select_user_session):
-            logger.warning(f"Session is expired (session_id={select_user_session['id']}, session_type=SessionType.SELECT_USER)")
-            logger.warning(f"Session will be deleted (session_id={select_user_session['id']}, session_type=SessionType.SELECT_USER)")
-            logger.warning(f"Select user message will be deleted (message_id={select_user_message.message_id})")
+            logger.warning("Session is expired (session_id=%s, session_type=SessionType.SELECT_USER)", select_user_session.id)
+            logger.warning("Session will be deleted (session_id=%s, session_type=SessionType.SELECT_USER)", select_user_session.id)
+            logger.warning("Select user message will be deleted (message_id=%s)", select_user_message.message_id)
 
-            self.session_service.delete_session(select_user_session["id"])            
-            await select_user_message.delete()
+            self.session_service.delete_session(select_user_session.id)            
+            self._delete_message(select_user_message.chat_id, select_user_message.message_id)
 
-            reply_text=f"\uE252 _Запрос более не актуален_"
-            await request_message.reply_text(text=reply_text, parse_mode=ParseMode.MARKDOWN)
+            self._send_request_expired_notice(chat_id, request_message_id)
             return
 
-        logger.info(f"Found active session (session_id={select_user_session['id']}, session_type=SessionType.SELECT_USER)")
+        logger.info("Found active session (session_id=%s, session_type=SessionType.SELECT_USER)", select_user_session.id)
 
         selecting_user = update.callback_query["from"]
         selected_user_id = int(update.callback_query.data)
 
-        if requesting_user.id != selecting_user.id:
-            logger.error("Error selecting a user: only requesting user is able to do that (requesting_user_id={equesting_user.id}, selecting_user_id={selecting_user.id})")
+        if requesting_user_id != selecting_user.id:
+            logger.error("Error selecting a user: only requesting user is able to do that (requesting_user_id=%s, selecting_user_id=%s)", requesting_user_id, selecting_user.id)
 
             reply_text=f"\uE252 _Только инициатор запроса может указать участника_"
-            await request_message.reply_text(text=reply_text, parse_mode=ParseMode.MARKDOWN)
+            await self._reply_to_message(chat_id, request_message_id, reply_text)
+            return
+
+        try:
+            self.session_service.delete_session(select_user_session.id)
+        except Exception as err:
+            logger.error("Session was already handled (session_id=%s): %s", select_user_session.id, err)
             return
 
-        self.session_service.delete_session(select_user_session["id"])
-        await select_user_message.delete()
+        self._delete_message(select_user_message.chat_id, select_user_message.message_id)
 
-        logger.info(f"Session was deleted (session_id={select_user_session['id']}, session_type=SessionType.SELECT_USER)")
-        logger.info(f"Select user message was deleted (message_id={select_user_message.message_id})")
+        logger.info("Session was deleted (session_id=%s, session_type=SessionType.SELECT_USER)", select_user_session.id)
+        logger.info("Select user message was deleted (message_id=%s)", select_user_message.message_id)
 
         ok_amount_text = "+1" if request_type == RequestType.UP else "-1"
-        selected_user_name = self.users_service.get_user_name(selected_user_id)
+        selected_user_name = tenant.users_service.get_user_name(selected_user_id)
         reply_text = f"\U0001F4AC Участник {self._get_user_markup(selecting_user)} запрашивает *{ok_amount_text} ОК* участнику *{selected_user_name}* по причине: _\"{reason}\"_"
-        confirm_request_message = await request_message.reply_text(text=reply_text, reply_markup=self.confirm_request_reply_markup, parse_mode=ParseMode.MARKDOWN)
+        confirm_request_message = await self._reply_to_message(chat_id, request_message_id, reply_text, reply_markup=self.confirm_request_reply_markup)
 
-        logger.info(f"Confirm request message was sent (message_id={confirm_request_message.message_id})")
+        logger.info("Confirm request message was sent (message_id=%s)", confirm_request_message.message_id)
 
         try:
             confirm_request_session_data = {
-                "requesting_user": requesting_user,
-                "request_message": request_message,
-                "request_type": request_type,
+                "requesting_user_id": requesting_user_id,
+                "request_message_id": request_message_id,
+                "request_type": request_type.value,
                 "reason": reason,
-                "selected_user_id": selected_user_id,
-                "confirm_request_message": confirm_request_message
+                "selected_user_id": selected_user_id
             }
 
             confirm_request_session_id = self.session_service.create_session(
-                id=confirm_request_message.message_id,
                 type=SessionType.CONFIRM_REQUEST,
                 user=selecting_user,
-                expired_callback=self._confirm_request_expired_callback,
+                chat_id=confirm_request_message.chat_id,
+                message_id=confirm_request_message.message_id,
                 data=confirm_request_session_data
             )
 
-            logger.info(f"Session was created (session_id={confirm_request_session_id}, session_type=SessionType.CONFIRM_REQUEST)")
+            logger.info("Session was created (session_id=%s, session_type=SessionType.CONFIRM_REQUEST)", confirm_request_session_id)
         except Exception as err:
-            logger.error(f"Error creating a session for user (user_id={selecting_user.id}, session_type=SessionType.CONFIRM_REQUEST): {err}")
-            logger.warning(f"Confirm request message will be deleted (message_id={confirm_request_message.message_id})")
+            logger.error("Error creating a session for user (user_id=%s, session_type=SessionType.CONFIRM_REQUEST): %s", selecting_user.id, err)
+            logger.warning("Confirm request message will be deleted (message_id=%s)", confirm_request_message.message_id)
 
-            await confirm_request_message.delete()
+            self._delete_message(confirm_request_message.chat_id, confirm_request_message.message_id)
 
             reply_text = f"\uE252 _Команда не может быть выполнена_"
-            await request_message.reply_text(text=reply_text, parse_mode=ParseMode.MARKDOWN)
+            await self._reply_to_message(chat_id, request_message_id, reply_text)
 
     @restrict_public_access()
-    async def confirm_request(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        logger.info(f"Update received: {update}")
+    async def confirm_request(self, update: Update, context: ContextTypes.DEFAULT_TYPE, tenant):
+        logger.info("Update received (%s)", LazyUpdate(update), extra={"event": "update_received"})
 
         confirm_request_message = update.callback_query.message
 
         try:
-            confirm_request_session = self.session_service.get_session(confirm_request_message.message_id)
+            confirm_request_session = self.session_service.get_session_by_message(confirm_request_message.chat_id, confirm_request_message.message_id)
         except Exception as err:
-            logger.error(f"Error getting session (session_id={confirm_request_message.message_id}): {err}")
-            logger.warning(f"Confirm request message will be deleted: {confirm_request_message}")
+            logger.error("Error getting session (message_id=%s): %s", confirm_request_message.message_id, err)
+            logger.warning("Confirm request message will be deleted (message_id=%s)", confirm_request_message.message_id)
 
-            await confirm_request_message.delete()
+            self._delete_message(confirm_request_message.chat_id, confirm_request_message.message_id)
 
-            reply_text=f"\uE252 _Запрос более не актуален_"
-            await context.bot.send_message(chat_id=update.effective_chat.id, text=reply_text, parse_mode=ParseMode.MARKDOWN)
+            self._send_request_expired_notice(update.effective_chat.id, None)
             return
 
-        request_message = confirm_request_session["data"]["request_message"]
-        request_type = confirm_request_session["data"]["request_type"]
-        reason = confirm_request_session["data"]["reason"]
-        requesting_user = confirm_request_session["data"]["requesting_user"]
-        selected_user_id = confirm_request_session["data"]["selected_user_id"]
+        chat_id = confirm_request_session.chat_id
+        request_message_id = confirm_request_session.data["request_message_id"]
+        request_type = RequestType(confirm_request_session.data["request_type"])
+        reason = confirm_request_session.data["reason"]
+        requesting_user_id = confirm_request_session.data["requesting_user_id"]
+        selected_user_id = confirm_request_session.data["selected_user_id"]
         
         if self.session_service.session_is_expired(confirm_request_session):
-            logger.warning(f"Session is expired (session_id={confirm_request_session['id']}, session_type=SessionType.CONFIRM_REQUEST)")
-            logger.warning(f"Session will be deleted (session_id={confirm_request_session['id']}, session_type=SessionType.CONFIRM_REQUEST)")
-            logger.warning(f"Confirm request message will be deleted: {confirm_request_message}")
+            logger.warning("Session is expired (session_id=%s, session_type=SessionType.CONFIRM_REQUEST)", confirm_request_session.id)
+            logger.warning("Session will be deleted (session_id=%s, session_type=SessionType.CONFIRM_REQUEST)", confirm_request_session.id)
+            logger.warning("Confirm request message will be deleted (message_id=%s)", confirm_request_message.message_id)
 
-            self.session_service.delete_session(confirm_request_session["id"])            
-            await confirm_request_message.delete()
+            self.session_service.delete_session(confirm_request_session.id)            
+            self._delete_message(confirm_request_message.chat_id, confirm_request_message.message_id)
 
-            reply_text=f"\uE252 _Запрос более не актуален_"
-            await request_message.reply_text(text=reply_text, parse_mode=ParseMode.MARKDOWN)
+            self._send_request_expired_notice(chat_id, request_message_id)
             return
 
-        logger.info(f"Found active session (session_id={confirm_request_session['id']}, session_type=SessionType.CONFIRM_REQUEST): {confirm_request_session}")
+        logger.info("Found active session (session_id=%s, session_type=SessionType.CONFIRM_REQUEST)", confirm_request_session.id)
 
         confirming_user = update.callback_query["from"]
         confirmed_option = update.callback_query.data
 
-        if requesting_user.id == confirming_user.id and confirmed_option == ConfirmOptions.CONFIRM:
-            logger.error(f"Error confirming request: requesting user cannot confirm the request (user_id={confirming_user.id})")
+        if requesting_user_id == confirming_user.id and confirmed_option == ConfirmOptions.CONFIRM:
+            logger.error("Error confirming request: requesting user cannot confirm the request (user_id=%s)", confirming_user.id)
 
             reply_text=f"\uE252 _Запрос не может быть разрешен инициатором_"
-            await confirm_request_message.reply_text(text=reply_text, parse_mode=ParseMode.MARKDOWN)
+            await self._reply(confirm_request_message, reply_text)
             return
 
         if selected_user_id == confirming_user.id and confirmed_option == ConfirmOptions.CONFIRM:
-            logger.error(f"Error confirming request: selected user cannot confirm the request (user_id={confirming_user.id})")
+            logger.error("Error confirming request: selected user cannot confirm the request (user_id=%s)", confirming_user.id)
 
             reply_text=f"\uE252 _Запрос не может быть разрешен кандидатом_"
-            await confirm_request_message.reply_text(text=reply_text, parse_mode=ParseMode.MARKDOWN)
+            await self._reply(confirm_request_message, reply_text)
             return
 
         if selected_user_id == confirming_user.id and confirmed_option == ConfirmOptions.DECLINE:
-            logger.error(f"Error confirming request: selected user cannot decline the request (user_id={confirming_user.id})")
+            logger.error("Error confirming request: selected user cannot decline the request (user_id=%s)", confirming_user.id)
 
             reply_text=f"\uE252 _Запрос не может быть отклонен кандидатом_"
-            await confirm_request_message.reply_text(text=reply_text, parse_mode=ParseMode.MARKDOWN)
+            await self._reply(confirm_request_message, reply_text)
             return
 
-        self.session_service.delete_session(confirm_request_session["id"])
-        await confirm_request_message.delete()
+        try:
+            self.session_service.delete_session(confirm_request_session.id)
+        except Exception as err:
+            logger.error("Session was already handled (session_id=%s): %s", confirm_request_session.id, err)
+            return
+
+        self._delete_message(confirm_request_message.chat_id, confirm_request_message.message_id)
 
-        logger.info(f"Session was deleted (session_id={confirm_request_session['id']}, session_type=SessionType.CONFIRM_REQUEST)")
-        logger.info(f"Confirm request message was deleted: {confirm_request_message}")
+        logger.info("Session was deleted (session_id=%s, session_type=SessionType.CONFIRM_REQUEST)", confirm_request_session.id)
+        logger.info("Confirm request message was deleted (message_id=%s)", confirm_request_message.message_id)
         
         if confirmed_option == ConfirmOptions.CONFIRM:
-            logger.info(f"Received option from user (user_id={confirming_user.id}, confirm_option=ConfirmOptions.CONFIRM): {confirm_request_message}")
+            logger.info("Received option from user (user_id=%s, confirm_option=ConfirmOptions.CONFIRM, message_id=%s)", confirming_user.id, confirm_request_message.message_id)
 
             try:
                 if request_type == RequestType.UP:
-                    self.karma_service.up(selected_user_id, reason)
+                    await tenant.karma_service.up(selected_user_id, reason, requesting_user_id, confirming_user.id)
                 else:
-                    self.karma_service.down(selected_user_id, reason)
+                    await tenant.karma_service.down(selected_user_id, reason, requesting_user_id, confirming_user.id)
             except Exception as err:
-                logger.error(f"Error updating karma for user (user_id={selected_user_id}, reason={reason}): {err}")
+                logger.error("Error updating karma for user (user_id=%s, reason=%s): %s", selected_user_id, redact_text(reason), err)
 
                 reply_text = f"\uE252 _Команда не может быть выполнена_"
-                await request_message.reply_text(text=reply_text, parse_mode=ParseMode.MARKDOWN)
+                await self._reply_to_message(chat_id, request_message_id, reply_text)
                 return
 
             ok_amount_text = '+1' if request_type == RequestType.UP else '-1'
             emoji_text = '\uE232' if request_type == RequestType.UP else '\uE233'
-            selected_user_name = self.users_service.get_user_name(selected_user_id)
+            selected_user_name = tenant.users_service.get_user_name(selected_user_id)
 
             reply_text = f"{emoji_text} Участник *{selected_user_name}* получает *{ok_amount_text} OK* по причине: _\"{reason}\"_"
-            await request_message.reply_text(text=reply_text, parse_mode=ParseMode.MARKDOWN)
+            await self._reply_to_message(chat_id, request_message_id, reply_text)
             
             request_type_text = "RequestType.UP" if request_type == RequestType.UP else "RequestType.DOWN"
-            logger.info(f"Request was done (requesting_user_id={requesting_user.id}, confirming_user_id={confirming_user.id}, selected_user_id={selected_user_id}, request_type={request_type_text}, reason={reason})")
+            logger.info("Request was done (requesting_user_id=%s, confirming_user_id=%s, selected_user_id=%s, request_type=%s, reason=%s)", requesting_user_id, confirming_user.id, selected_user_id, request_type_text, redact_text(reason))
         else:
-            logger.info(f"Received option from user (user_id={confirming_user.id}, confirm_option=ConfirmOptions.DECLINE): {confirm_request_message}")
+            logger.info("Received option from user (user_id=%s, confirm_option=ConfirmOptions.DECLINE, message_id=%s)", confirming_user.id, confirm_request_message.message_id)
 
             reply_text="\uE333 _Запрос был отклонен_"
-            await request_message.reply_text(text=reply_text, parse_mode=ParseMode.MARKDOWN)
+            await self._reply_to_message(chat_id, request_message_id, reply_text)
 
-    async def process_update(self, update_json):
+    async def flush_pending_writes(self):
+        # a failing storage of one tenant doesn't keep the other tenants' votes from being written
+        results = await asyncio.gather(
+            *[tenant.karma_service.flush() for tenant in self.tenant_service.get_loaded_tenants()],
+            return_exceptions=True
+        )
+
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            raise errors[0]
+
+    async def handler_error(self, update, context: ContextTypes.DEFAULT_TYPE):
+        logger.error("Error handling update: %s", context.error, exc_info=context.error)
+
+        if isinstance(update, Update):
+            self.failed_updates.add(update.update_id)
+
+    async def _prepare_processing(self):
+        await self.application.initialize()
+        await self.session_service.sweep_expired_sessions()
+
+    def _count_dropped_update(self, reason):
+        self.dropped_updates[reason.value] += 1
+        if self.metrics_service:
+            self.metrics_service.increment(f"dropped_updates.{reason.value}")
+
+    async def _filter_update(self, update_json):
+        # most updates of a group are ordinary messages, they are dropped from the raw JSON without building
+        # `Update` objects, initializing the bot or loading the tenant
+        message = get_update_message(update_json)
+        if not message:
+            self._count_dropped_update(DropReason.NO_CHAT)
+            return False
+
+        chat_id = message['chat']['id']
+
+        if 'callback_query' not in update_json and not is_command_message(message):
+            # senders are still remembered, so their profiles stay up to date as before
+            tenant = self.tenant_service.get_loaded_tenant(chat_id)
+            if tenant is not None and 'from' in message:
+                self.user_profiles_service.remember(User.de_json(message['from'], self.application.bot))
+
+            self._count_dropped_update(DropReason.NOT_COMMAND)
+            return False
+
+        if await self.tenant_service.get_tenant(chat_id) is None:
+            logger.error("Received update from prohibited chat (chat_id=%s, user=%s)", chat_id, message.get('from'))
+            self._count_dropped_update(DropReason.FOREIGN_CHAT)
+
+            if 'callback_query' not in update_json:
+                reply_text = f"\uE252 _Бот не может быть использован в этом чате_"
+                await self._reply_to_message(chat_id, message['message_id'], reply_text)
+            return False
+
+        # Telegram redelivers the update if the previous delivery took too long, it must not be voted twice
+        if self.dedup_service is not None and not self.dedup_service.register(update_json):
+            self._count_dropped_update(DropReason.DUPLICATE)
+            return False
+
+        return True
+
+    def _forget_updates(self, updates_json):
+        if self.dedup_service is None:
+            return
+
+        for update_json in updates_json:
+            try:
+                self.dedup_service.forget(update_json)
+            except Exception as err:
+                logger.error("Error forgetting failed update (update_id=%s): %s", update_json.get('update_id'), err)
+
+    async def _process_update(self, update_json):
         update = Update.de_json(update_json, self.application.bot)
-        logger.info(f"Started process_update: {update}")
+        logger.debug("Started process_update (%s)", LazyUpdate(update))
+
+        await self.application.process_update(update)
+
+        if update.update_id in self.failed_updates:
+            self.failed_updates.discard(update.update_id)
+            raise Exception(f"Update handler failed (update_id={update.update_id})")
+
+        logger.debug("Finished process_update")
 
+    async def process_update(self, update_json):
+        # returns whether the update was passed to the handlers
         try:
-            await self.application.initialize()
-            await self.application.process_update(update)
+            if not await self._filter_update(update_json):
+                return False
+
+            await self._prepare_processing()
+            await self._process_update(update_json)
         except Exception as e:
             logger.error(e)
+            self._forget_updates([update_json])
+        finally:
+            await self._flush_send_queue()
+
+        return True
+
+    async def process_updates(self, updates_json):
+        # updates of one chat touch the same sessions and messages, so they are filtered and processed in order,
+        # while different chats are done concurrently, including the loads of their tenants
+        chats_updates = {}
+        for (index, update_json) in enumerate(updates_json):
+            chats_updates.setdefault(get_update_chat_id(update_json), []).append(index)
+
+        failed_indexes = []
+        dropped_count = 0
+        preparing = None
+
+        async def prepare_processing():
+            # the bot is initialized once for the batch, and only if any of its updates is handled
+            nonlocal preparing
+            if preparing is None:
+                preparing = asyncio.ensure_future(self._prepare_processing())
+            await preparing
+
+        semaphore = asyncio.Semaphore(max(self.application.concurrent_updates, 1))
+
+        async def process_chat_updates(indexes):
+            nonlocal dropped_count
+
+            for (position, index) in enumerate(indexes):
+                update_json = updates_json[index]
+                registered = False
+                try:
+                    if not await self._filter_update(update_json):
+                        dropped_count += 1
+                        continue
+
+                    registered = True
+                    await prepare_processing()
+                    # only the handlers are bounded by `concurrent_updates`, the filtering of all chats goes at once
+                    async with semaphore:
+                        await self._process_update(update_json)
+                except Exception as err:
+                    logger.error("Error processing update (index=%s): %s", index, err)
+
+                    # the rest of the chat's updates is retried as well, so the order is kept; only the failed one
+                    # was registered by the dedup, the rest is not filtered yet
+                    failed_indexes.extend(indexes[position:])
+                    if registered:
+                        self._forget_updates([update_json])
+                    return
+
+        await asyncio.gather(*[process_chat_updates(indexes) for indexes in chats_updates.values()])
+        await self._flush_send_queue()
+
+        logger.info("Processed batch of updates (count=%s, chats_count=%s, dropped_count=%s, failed_count=%s)", len(updates_json), len(chats_updates), dropped_count, len(failed_indexes))
+        return sorted(failed_indexes)
+
+    async def sweep_expired_sessions_job(self, context: ContextTypes.DEFAULT_TYPE):
+        # sessions of this process expire by their own timers, the sweep catches the ones created by other processes
+        await self.session_service.sweep_expired_sessions()
+
+    def _add_sweep_job(self, sweep_interval):
+        if sweep_interval:
+            self.application.job_queue.run_repeating(self.sweep_expired_sessions_job, interval=sweep_interval, first=0)
+
+    async def _flush_send_queue(self):
+        # the handlers have already waited for their replies, so only the calls which can be made right away are
+        # waited for; the ones held up by the limits are carried over to the next invocation of a warm container
+        # (or dropped with it), so a burst in a chat doesn't hold the response until the Lambda timeout
+        if not await self.send_queue_service.drain(wait_for_limits=False) and self.metrics_service:
+            self.metrics_service.increment("send_queue.carried_over", self.send_queue_service.get_pending_count())
+
+    async def _drain_send_queue(self):
+        # replies to the last updates are sent before shutting down, unless the queue is held up by the flood control
+        if await self.send_queue_service.drain(self.send_shutdown_timeout):
+            return
+
+        dropped_count = await self.send_queue_service.cancel()
+        logger.warning("Queued Telegram calls were dropped on shutdown (count=%s, timeout=%ss)", dropped_count, self.send_shutdown_timeout)
 
-        logger.info("Finished process_update")
+    def _shutdown(self):
+        loop = asyncio.get_event_loop()
 
-    def run(self):
-        self.application.start()
+        # the application is stopped at this point, so no new votes are journaled while flushing
+        for tenant in self.tenant_service.get_loaded_tenants():
+            try:
+                loop.run_until_complete(tenant.karma_service.close())
+            except Exception as err:
+                logger.error("Error flushing pending writes on shutdown, they will be flushed on the next start (chat_id=%s): %s", tenant.chat_id, err)
+
+        loop.close()
+
+        logger.info("BotService was shut down")
+
+    def run_polling(self, sweep_interval=None):
+        logger.info("Starting long polling (concurrent_updates=%s)", self.application.concurrent_updates)
+
+        self._add_sweep_job(sweep_interval)
+        self.application.run_polling(close_loop=False)
+        self._shutdown()
+
+    def run_webhook(self, listen, port, webhook_url, url_path='', secret_token=None, sweep_interval=None):
+        logger.info("Starting webhook server (listen=%s, port=%s, url_path=%s, concurrent_updates=%s)", listen, port, url_path, self.application.concurrent_updates)
+
+        self._add_sweep_job(sweep_interval)
+        self.application.run_webhook(
+            listen=listen,
+            port=port,
+            url_path=url_path,
+            webhook_url=webhook_url,
+            secret_token=secret_token,
+            close_loop=False
+        )
+        self._shutdown()
@@ -0,0 +1,107 @@
+from collections import OrderedDict
+from threading import Lock
+from time import time
+import sqlite3
+
+from services.logs import get_logger
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS seen_updates (
+    key TEXT PRIMARY KEY,
+    seen_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS seen_updates_seen_at ON seen_updates (seen_at);
+"""
+
+logger = get_logger(__name__)
+
+def get_update_keys(update_json):
+    keys = [f"update:{update_json.get('update_id')}"]
+
+    # the same button press is never handled twice, even if it comes within another update
+    callback_query = update_json.get('callback_query')
+    if callback_query:
+        keys.append(f"callback_query:{callback_query['id']}")
+
+    return keys
+
+
+class SQLiteDedupStore:
+    def __init__(self, database_path):
+        self.database_path = database_path
+        self.lock = Lock()
+
+        self.connection = sqlite3.connect(database_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+
+    def add(self, keys, now, ttl):
+        # the transaction holds the write lock, so only one worker adds the keys of a redelivered update
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM seen_updates WHERE seen_at < ?", (now - ttl,))
+
+            added = True
+            for key in keys:
+                cursor = self.connection.execute("INSERT OR IGNORE INTO seen_updates (key, seen_at) VALUES (?, ?)", (key, now))
+                added = added and cursor.rowcount == 1
+
+        return added
+
+    def remove(self, keys):
+        with self.lock, self.connection:
+            self.connection.executemany("DELETE FROM seen_updates WHERE key = ?", [(key,) for key in keys])
+
+
+class UpdateDedupService:
+    def __init__(self, max_size, ttl, store=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        # optional store shared by the workers, the in-memory cache answers the redeliveries to this worker
+        self.store = store
+        self.seen_keys = OrderedDict()
+        self.hits_count = 0
+
+    def _is_seen(self, key, now):
+        seen_at = self.seen_keys.get(key)
+        if seen_at is None:
+            return False
+
+        if now - seen_at > self.ttl:
+            del self.seen_keys[key]
+            return False
+
+        self.seen_keys.move_to_end(key)
+        return True
+
+    def register(self, update_json):
+        # returns False if the update was already registered, the update is registered otherwise
+        keys = get_update_keys(update_json)
+        now = time()
+
+        seen = any([self._is_seen(key, now) for key in keys])
+        if not seen and self.store is not None:
+            seen = not self.store.add(keys, now, self.ttl)
+
+        for key in keys:
+            self.seen_keys[key] = self.seen_keys.get(key, now)
+            self.seen_keys.move_to_end(key)
+
+        while len(self.seen_keys) > self.max_size:
+            self.seen_keys.popitem(last=False)
+
+        if seen:
+            self.hits_count += 1
+            logger.warning("Duplicate update was received (keys=%s, hits_count=%s)", keys, self.hits_count)
+
+        return not seen
+
+    def forget(self, update_json):
+        # failed updates are forgotten, so their redeliveries are processed again
+        keys = get_update_keys(update_json)
+
+        for key in keys:
+            self.seen_keys.pop(key, None)
+
+        if self.store is not None:
+            self.store.remove(keys)
@@ -1,36 +1,354 @@
+from google.auth.exceptions import RefreshError
+from gspread.exceptions import APIError, WorksheetNotFound
+from requests.adapters import HTTPAdapter
+from time import time
 import gspread
+import re
+
+from services.storage import StorageService, StorageException
+from services.logs import get_logger
+
+
+STALE_HANDLE_STATUS_CODES = (401, 403, 404)
+SHEETS_API_URL = "https://sheets.googleapis.com"
+CHECKPOINTS_HEADER = ["user_id", "total", "last_row"]
+
+logger = get_logger(__name__)
+
+def invalidate_on_api_error(method):
+    def _invalidate_on_api_error(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        except APIError as err:
+            if err.response.status_code in STALE_HANDLE_STATUS_CODES:
+                logger.warning("Spreadsheet handle was marked as stale (status_code=%s)", err.response.status_code)
+                self.stale = True
+            raise
+        except RefreshError as err:
+            logger.warning("Spreadsheet credentials were marked as stale: %s", err)
+            self.stale = True
+            raise
+
+    return _invalidate_on_api_error
+
+
+class RedirectAdapter(HTTPAdapter):
+    # gspread has the API URL hardcoded, so the requests are redirected by the session
+    def __init__(self, api_url):
+        super().__init__()
+        self.api_url = api_url.rstrip("/")
+
+    def send(self, request, **kwargs):
+        request.url = self.api_url + request.url[len(SHEETS_API_URL):]
+        return super().send(request, **kwargs)
+
+
+class GoogleSpreadsheetService(StorageService):
+    # the spreadsheet layout has only reason and amount columns, so there are no timestamps for windowed totals
+    supports_history = True
 
-class GoogleSpreadsheetService:
     def __init__(
         self, 
         account_dict, 
         spreadsheet_id,
         spreadsheet_user_columns,
-        spreadsheet_first_data_row
+        spreadsheet_first_data_row,
+        handle_ttl=None,
+        worksheet_title=None,
+        checkpoints_worksheet_title="checkpoints",
+        checkpoint_interval=None,
+        metrics_service=None,
+        api_url=None
     ):
-        self.client = gspread.service_account_from_dict(account_dict)
-        self.worksheet = self.client.open_by_key(spreadsheet_id).get_worksheet(0)
+        self.account_dict = account_dict
+        self.spreadsheet_id = spreadsheet_id
         self.spreadsheet_user_columns = spreadsheet_user_columns
         self.spreadsheet_first_data_row = spreadsheet_first_data_row
+        self.handle_ttl = handle_ttl
+        self.worksheet_title = worksheet_title
+        self.checkpoints_worksheet_title = checkpoints_worksheet_title
+        self.checkpoint_interval = checkpoint_interval
+        self.metrics_service = metrics_service
+        self.api_url = api_url
+        # the last known rows of the users, which bound the history reads
+        self.users_last_rows = {}
+        self.connect()
+
+    def connect(self):
+        self.client = gspread.service_account_from_dict(self.account_dict)
+        if self.metrics_service:
+            self.client.session.hooks["response"].append(self._record_response)
+        if self.api_url:
+            self.client.session.mount(SHEETS_API_URL, RedirectAdapter(self.api_url))
+        self.spreadsheet = self.client.open_by_key(self.spreadsheet_id)
+        # tenants sharing a spreadsheet keep their data in their own worksheets
+        if self.worksheet_title:
+            self.worksheet = self.spreadsheet.worksheet(self.worksheet_title)
+        else:
+            self.worksheet = self.spreadsheet.get_worksheet(0)
+        self.checkpoints_worksheet = None
+        self.checkpoints_rows_count = 0
+        self.checkpoints = None
+        self.connected_at = time()
+        self.stale = False
+
+        logger.info("Spreadsheet handle was created (spreadsheet_id=%s, worksheet=%s)", self.spreadsheet_id, self.worksheet.title)
+
+    def _record_response(self, response, *args, **kwargs):
+        # every HTTP request of gspread goes through the session, including the token refreshes
+        request_body = response.request.body or b""
+        if isinstance(request_body, str):
+            request_body = request_body.encode()
+        self.metrics_service.observe("sheets.http", response.elapsed.total_seconds())
+        self.metrics_service.increment("sheets.requests")
+        self.metrics_service.increment("sheets.bytes_sent", len(request_body))
+        self.metrics_service.increment("sheets.bytes_received", len(response.content))
+        if response.status_code >= 400:
+            self.metrics_service.increment(f"sheets.status_{response.status_code}")
+
+    def is_stale(self):
+        if self.stale:
+            return True
+
+        return self.handle_ttl is not None and time() - self.connected_at > self.handle_ttl
+
+    def refresh_if_stale(self):
+        if self.is_stale():
+            logger.warning("Spreadsheet handle is stale and will be recreated (spreadsheet_id=%s)", self.spreadsheet_id)
+            self.connect()
 
     def get_user_columns(self, user_id):
         user_id = str(user_id)
-        columns = self.spreadsheet_user_columns[user_id]
+        columns = self.spreadsheet_user_columns.get(user_id)
         if columns is None:
-            raise Exception(f"Invalid user provided (user_id={user_id})")
+            raise StorageException(f"Invalid user provided (user_id={user_id})")
         return columns
 
     def get_mapped_users(self):
         return self.spreadsheet_user_columns.keys()
 
+    @invalidate_on_api_error
     def get_column_data(self, column_name):
         data_range = f"{column_name}{self.spreadsheet_first_data_row}:{column_name}"
         return self.worksheet.get(data_range)
 
-    def get_first_non_empty_row(self, column_name):
-        return self.spreadsheet_first_data_row + len(self.get_column_data(column_name))
-    
-    def add_row_data(self, row, column_range, data):
+    @invalidate_on_api_error
+    def get_columns_data(self, column_names, first_rows=None):
+        if first_rows is None:
+            first_rows = [self.spreadsheet_first_data_row] * len(column_names)
+        data_ranges = [f"{column_name}{first_row}:{column_name}" for (column_name, first_row) in zip(column_names, first_rows)]
+        return self.worksheet.batch_get(data_ranges)
+
+    @invalidate_on_api_error
+    def load_checkpoints(self):
+        try:
+            self.checkpoints_worksheet = self.spreadsheet.worksheet(self.checkpoints_worksheet_title)
+        except WorksheetNotFound:
+            logger.info("No checkpoints worksheet found, totals will be read from the first data row (title=%s)", self.checkpoints_worksheet_title)
+            return {}
+
+        # gspread doesn't update the grid size of the handle on resize, so it's tracked apart
+        self.checkpoints_rows_count = self.checkpoints_worksheet.row_count
+
+        checkpoints = {}
+        for row in self.checkpoints_worksheet.get("A2:C"):
+            if len(row) == 3:
+                checkpoints[str(row[0])] = (int(row[1]), int(row[2]))
+
+        logger.info("Checkpoints were loaded (count=%s)", len(checkpoints))
+        return checkpoints
+
+    def get_checkpoint(self, user_id):
+        # checkpoints only change on compaction, and an outdated one still gives the right total with more rows to read,
+        # so they are read once per spreadsheet handle
+        if self.checkpoints is None:
+            self.checkpoints = self.load_checkpoints()
+
+        # a checkpoint is the total of the user's rows up to and including its last row
+        return self.checkpoints.get(str(user_id), (0, self.spreadsheet_first_data_row - 1))
+
+    @invalidate_on_api_error
+    def save_checkpoints(self, checkpoints):
+        self.checkpoints = {**(self.checkpoints or {}), **checkpoints}
+
+        rows = [CHECKPOINTS_HEADER] + [[user_id, total, last_row] for (user_id, (total, last_row)) in self.checkpoints.items()]
+        if self.checkpoints_worksheet is None:
+            self.checkpoints_worksheet = self.spreadsheet.add_worksheet(
+                self.checkpoints_worksheet_title,
+                rows=len(rows),
+                cols=len(CHECKPOINTS_HEADER)
+            )
+            self.checkpoints_rows_count = len(rows)
+        elif self.checkpoints_rows_count < len(rows):
+            # users getting their first checkpoint add rows, while writes outside of the grid are rejected by the API
+            self.checkpoints_worksheet.resize(rows=len(rows))
+            self.checkpoints_rows_count = len(rows)
+
+        # the whole table is written at once, so readers never see a half-written checkpoint
+        self.checkpoints_worksheet.update(f"A1:C{len(rows)}", rows)
+
+        logger.info("Checkpoints were saved (users=%s)", list(checkpoints.keys()))
+
+    @invalidate_on_api_error
+    def append_rows_data(self, column_range, rows):
         [column_from, column_to] = column_range
-        data_range = f"{column_from}{row}:{column_to}{row}"
-        self.worksheet.update(data_range, [data])
+        table_range = f"{column_from}{self.spreadsheet_first_data_row}:{column_to}"
+
+        # the rows are picked by the API within a single request, so concurrent appends never overwrite each other,
+        # and OVERWRITE keeps the rows of other users' columns from being shifted
+        response = self.worksheet.append_rows(
+            rows,
+            value_input_option="RAW",
+            insert_data_option="OVERWRITE",
+            table_range=table_range
+        )
+
+        updated_range = response["updates"]["updatedRange"]
+        return int(re.match(r"^(?:.*!)?[A-Z]+(\d+)", updated_range).group(1))
+
+    def append_row_data(self, column_range, data):
+        return self.append_rows_data(column_range, [data])
+
+    def _append_user_rows(self, user_id, rows):
+        first_row = self.append_rows_data(self.get_user_columns(user_id), rows)
+        self._remember_last_row(user_id, first_row + len(rows) - 1)
+
+    def _remember_last_row(self, user_id, last_row):
+        user_id = str(user_id)
+        self.users_last_rows[user_id] = max(self.users_last_rows.get(user_id, 0), last_row)
+
+    def user_exists(self, user_id):
+        return str(user_id) in self.spreadsheet_user_columns
+
+    def get_users(self):
+        return self.get_mapped_users()
+
+    # the spreadsheet layout has only reason and amount columns, so timestamps and voters are not stored
+    def add_entry(self, user_id, amount, reason, ts=None, requesting_user_id=None, confirming_user_id=None):
+        self._append_user_rows(user_id, [[reason, amount]])
+
+    def add_entries(self, entries):
+        users_rows = {}
+        for entry in entries:
+            users_rows.setdefault(str(entry["user_id"]), []).append([entry["reason"], entry["amount"]])
+
+        # appends can't address several column ranges at once, so every user gets a single multi-row append
+        for (user_id, rows) in users_rows.items():
+            self._append_user_rows(user_id, rows)
+
+    def _get_last_known_row(self, user_id):
+        # the checkpoint is the last known row if no rows were read or appended here yet
+        (_, checkpoint_last_row) = self.get_checkpoint(user_id)
+        return max(self.users_last_rows.get(str(user_id), 0), checkpoint_last_row)
+
+    def get_position(self, user_id):
+        return self._get_last_known_row(user_id)
+
+    @invalidate_on_api_error
+    def find_added_entries(self, entries):
+        # the layout has no column for the keys, but the rows of a user are appended by a single request, so they are
+        # either all in the spreadsheet or none; they are looked up as a run of the same rows after the position taken
+        # before appending them, a run appended by another process in between is taken for them, which might drop
+        # a vote but never counts one twice
+        users_entries = {}
+        for entry in entries:
+            users_entries.setdefault(str(entry["user_id"]), []).append(entry)
+
+        added_keys = set()
+        for (user_id, user_entries) in users_entries.items():
+            positions = [entry["position"] for entry in user_entries if entry.get("position") is not None]
+            first_row = (min(positions) if positions else self.spreadsheet_first_data_row - 1) + 1
+
+            [column_from, column_to] = self.get_user_columns(user_id)
+            rows = self.worksheet.get(f"{column_from}{first_row}:{column_to}")
+
+            records = [(record["reason"], record["amount"]) for record in map(self._parse_history_row, rows) if record is not None]
+            run = [(entry["reason"] or None, entry["amount"]) for entry in user_entries]
+            if any(records[index:index + len(run)] == run for index in range(len(records) - len(run) + 1)):
+                added_keys.update(entry["key"] for entry in user_entries)
+
+        return added_keys
+
+    def _sum_rows(self, rows):
+        non_empty_cells = [int(row[0]) for row in rows if row]
+        return sum(non_empty_cells)
+
+    def _read_since_checkpoints(self, user_ids):
+        amount_columns = [self.get_user_columns(user_id)[1] for user_id in user_ids]
+        checkpoints = [self.get_checkpoint(user_id) for user_id in user_ids]
+        columns_data = self.get_columns_data(amount_columns, [last_row + 1 for (_, last_row) in checkpoints])
+
+        # every returned range is a snapshot, so the rows read are exactly the ones the new checkpoint covers
+        users_checkpoints = {}
+        for (user_id, (total, last_row), rows) in zip(user_ids, checkpoints, columns_data):
+            users_checkpoints[user_id] = (total + self._sum_rows(rows), last_row + len(rows), len(rows))
+            self._remember_last_row(user_id, last_row + len(rows))
+        return users_checkpoints
+
+    def _save_long_checkpoints(self, users_checkpoints):
+        if not self.checkpoint_interval:
+            return
+
+        checkpoints = {}
+        for (user_id, (total, last_row, rows_count)) in users_checkpoints.items():
+            if rows_count >= self.checkpoint_interval:
+                checkpoints[user_id] = (total, last_row)
+
+        if checkpoints:
+            try:
+                self.save_checkpoints(checkpoints)
+            except Exception as err:
+                # the totals are already read, so a failed checkpoint only means more rows to read next time
+                logger.error("Error saving checkpoints: %s", err)
+
+    def get_total(self, user_id):
+        user_id = str(user_id)
+        users_checkpoints = self._read_since_checkpoints([user_id])
+        self._save_long_checkpoints(users_checkpoints)
+        return users_checkpoints[user_id][0]
+
+    def get_totals(self):
+        users_checkpoints = self._read_since_checkpoints(list(self.get_mapped_users()))
+        self._save_long_checkpoints(users_checkpoints)
+        return {user_id: total for (user_id, (total, _, _)) in users_checkpoints.items()}
+
+    def compact(self):
+        users_checkpoints = self._read_since_checkpoints(list(self.get_mapped_users()))
+
+        checkpoints = {}
+        for (user_id, (total, last_row, rows_count)) in users_checkpoints.items():
+            if rows_count > 0:
+                checkpoints[user_id] = (total, last_row)
+
+        if checkpoints:
+            self.save_checkpoints(checkpoints)
+
+        return sum(rows_count for (_, _, rows_count) in users_checkpoints.values())
+
+    def _get_history_first_row(self, user_id, limit):
+        if not limit:
+            return self.spreadsheet_first_data_row
+
+        # only the latest rows are read: the ones before the last known row down to the limit, and the ones appended
+        # after it by other processes; with neither a known row nor a checkpoint the end of the column can't be found
+        # without reading it, so the whole column is read, but only once per user and handle
+        return max(self.spreadsheet_first_data_row, self._get_last_known_row(user_id) - limit + 1)
+
+    def _parse_history_row(self, row):
+        # rows edited by hand might miss the amount or have a text in it
+        try:
+            return {"ts": None, "amount": int(row[1]), "reason": row[0] or None, "requesting_user_id": None, "confirming_user_id": None}
+        except (IndexError, ValueError):
+            return None
+
+    @invalidate_on_api_error
+    def get_history(self, user_id, limit):
+        [column_from, column_to] = self.get_user_columns(user_id)
+        first_row = self._get_history_first_row(user_id, limit)
+        rows = self.worksheet.get(f"{column_from}{first_row}:{column_to}")
+        self._remember_last_row(user_id, first_row + len(rows) - 1)
+
+        # the spreadsheet keeps no timestamps, so the rows order is the only history order available
+        records = [record for record in map(self._parse_history_row, rows) if record is not None]
+        latest_records = records[-limit:] if limit else records
+        return list(reversed(latest_records))
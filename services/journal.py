@@ -0,0 +1,170 @@
+from threading import Lock
+from time import time
+from uuid import uuid4
+import sqlite3
+
+from services.logs import get_logger
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pending_entries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    ts REAL NOT NULL,
+    amount INTEGER NOT NULL,
+    reason TEXT,
+    requesting_user_id TEXT,
+    confirming_user_id TEXT,
+    key TEXT,
+    flushing_at REAL,
+    flush_position INTEGER
+);
+"""
+
+# columns which were added to the pending entries table after its first version
+PENDING_ENTRIES_ADDED_COLUMNS = (
+    ("requesting_user_id", "TEXT"),
+    ("confirming_user_id", "TEXT"),
+    ("key", "TEXT"),
+    ("flushing_at", "REAL"),
+    ("flush_position", "INTEGER")
+)
+PENDING_ENTRIES_COLUMNS = "id, user_id, ts, amount, reason, requesting_user_id, confirming_user_id, key, flush_position"
+
+logger = get_logger(__name__)
+
+class JournalService:
+    def __init__(self, database_path):
+        self.database_path = database_path
+        self.lock = Lock()
+
+        self.connection = sqlite3.connect(database_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # every committed entry is fsync'd before the vote is acknowledged
+        self.connection.execute("PRAGMA synchronous=FULL")
+        self.connection.executescript(SCHEMA)
+
+        # the journal may hold unflushed entries, so it is migrated in place instead of being recreated
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(pending_entries)").fetchall()]
+        with self.connection:
+            for (column, column_type) in PENDING_ENTRIES_ADDED_COLUMNS:
+                if column not in columns:
+                    self.connection.execute(f"ALTER TABLE pending_entries ADD COLUMN {column} {column_type}")
+            # entries journaled before the keys existed get theirs, so they are found in the storage as the others
+            self.connection.execute("UPDATE pending_entries SET key = lower(hex(randomblob(16))) WHERE key IS NULL")
+
+        rows = self.connection.execute("SELECT user_id, SUM(amount) FROM pending_entries GROUP BY user_id").fetchall()
+        self.pending_totals = dict(rows)
+        rows = self.connection.execute("SELECT id FROM pending_entries WHERE flushing_at IS NOT NULL").fetchall()
+        self.flushing_ids = {id for (id,) in rows}
+
+        logger.info("Journal was opened (database_path=%s, pending_totals=%s)", database_path, self.pending_totals)
+
+    def append(self, user_id, amount, reason, requesting_user_id=None, confirming_user_id=None):
+        user_id = str(user_id)
+        requesting_user_id = None if requesting_user_id is None else str(requesting_user_id)
+        confirming_user_id = None if confirming_user_id is None else str(confirming_user_id)
+
+        # journals of different containers number their entries alike, so an entry is told apart in the storage by its key
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO pending_entries (user_id, ts, amount, reason, requesting_user_id, confirming_user_id, key) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (user_id, time(), amount, reason, requesting_user_id, confirming_user_id, uuid4().hex)
+            )
+            self.pending_totals[user_id] = self.pending_totals.get(user_id, 0) + amount
+            if self.pending_totals[user_id] == 0:
+                del self.pending_totals[user_id]
+
+        return cursor.lastrowid
+
+    def _to_entries(self, rows):
+        return [
+            {
+                "id": id,
+                "user_id": user_id,
+                "ts": ts,
+                "amount": amount,
+                "reason": reason,
+                "requesting_user_id": requesting_user_id,
+                "confirming_user_id": confirming_user_id,
+                "key": key,
+                "position": flush_position
+            }
+            for (id, user_id, ts, amount, reason, requesting_user_id, confirming_user_id, key, flush_position) in rows
+        ]
+
+    def get_pending(self, limit):
+        # entries being flushed are left out, they might be in the storage already
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT {PENDING_ENTRIES_COLUMNS} FROM pending_entries WHERE flushing_at IS NULL ORDER BY id LIMIT ?",
+                (limit,)
+            ).fetchall()
+        return self._to_entries(rows)
+
+    def get_flushing(self):
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT {PENDING_ENTRIES_COLUMNS} FROM pending_entries WHERE flushing_at IS NOT NULL ORDER BY id"
+            ).fetchall()
+        return self._to_entries(rows)
+
+    def mark_flushing(self, entries, position):
+        # committed before the entries are sent to the storage, so after a failure or a crash they are looked up there
+        # instead of being sent twice; `position` is where the storage looks them up from
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "UPDATE pending_entries SET flushing_at = ?, flush_position = ? WHERE id = ?",
+                [(time(), position, entry["id"]) for entry in entries]
+            )
+            self.flushing_ids.update(entry["id"] for entry in entries)
+
+    def unmark_flushing(self, entries):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "UPDATE pending_entries SET flushing_at = NULL, flush_position = NULL WHERE id = ?",
+                [(entry["id"],) for entry in entries]
+            )
+            self.flushing_ids.difference_update(entry["id"] for entry in entries)
+
+    def get_pending_history(self, user_id, limit):
+        # the latest entries of the user first, as the history of the storage
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT ts, amount, reason, requesting_user_id, confirming_user_id FROM pending_entries "
+                "WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+                (str(user_id), -1 if limit is None else limit)
+            ).fetchall()
+        return [
+            {
+                "ts": ts,
+                "amount": amount,
+                "reason": reason,
+                "requesting_user_id": requesting_user_id,
+                "confirming_user_id": confirming_user_id
+            }
+            for (ts, amount, reason, requesting_user_id, confirming_user_id) in rows
+        ]
+
+    def remove(self, entries):
+        with self.lock, self.connection:
+            self.connection.executemany("DELETE FROM pending_entries WHERE id = ?", [(entry["id"],) for entry in entries])
+            self.flushing_ids.difference_update(entry["id"] for entry in entries)
+
+            for entry in entries:
+                user_id = entry["user_id"]
+                self.pending_totals[user_id] = self.pending_totals.get(user_id, 0) - entry["amount"]
+                if self.pending_totals[user_id] == 0:
+                    del self.pending_totals[user_id]
+
+    def has_flushing(self):
+        with self.lock:
+            return len(self.flushing_ids) > 0
+
+    def has_pending(self):
+        with self.lock:
+            return self.connection.execute("SELECT EXISTS (SELECT 1 FROM pending_entries)").fetchone()[0] == 1
+
+    def get_pending_totals(self):
+        with self.lock:
+            return dict(self.pending_totals)
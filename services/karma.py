@@ -1,27 +1,300 @@
+from functools import partial
+from time import time
+import asyncio
+
+from services.storage import StorageException
+from services.logs import get_logger
+
+
+JOURNAL_FLUSH_RETRY_BASE_DELAY = 1
+JOURNAL_FLUSH_RETRY_MAX_DELAY = 60
+SECONDS_IN_DAY = 86400
+
+logger = get_logger(__name__)
+
 class KarmaService:
-    def __init__(self, google_spreadsheet_service):
-        self.google_spreadsheet_service = google_spreadsheet_service
-
-    def _add_value(self, user_id, amount, reason):
-        user_columns = self.google_spreadsheet_service.get_user_columns(user_id)
-        row_to_add_data_into = self.google_spreadsheet_service.get_first_non_empty_row(user_columns[1])
-        self.google_spreadsheet_service.add_row_data(row_to_add_data_into, user_columns, [reason, amount])
-
-    def up(self, user_id, reason):
-        self._add_value(user_id, 1, reason)
-
-    def down(self, user_id, reason):
-        self._add_value(user_id, -1, reason)
-
-    def get_total_value(self, user_id):
-        user_columns = self.google_spreadsheet_service.get_user_columns(user_id)
-        non_empty_rows = self.google_spreadsheet_service.get_column_data(user_columns[1])
-        non_empty_cells = [int(row[0]) for row in non_empty_rows]
-        return sum(non_empty_cells)
-
-    def get_total_values(self):
-        total = {}
-        for user_id in self.google_spreadsheet_service.get_mapped_users():
-            total[user_id] = self.get_total_value(user_id)
-        return total
-    
\ No newline at end of file
+    def __init__(
+        self,
+        storage_service,
+        executor,
+        leaderboard_service,
+        totals_ttl=None,
+        journal_service=None,
+        journal_flush_interval=1,
+        journal_flush_batch_size=100
+    ):
+        self.storage_service = storage_service
+        self.executor = executor
+        self.leaderboard_service = leaderboard_service
+        self.totals_ttl = totals_ttl
+        self.totals = None
+        self.totals_loaded_at = None
+        self.totals_lock = None
+        self.writes_count = 0
+        self.writes_in_flight = 0
+
+        self.journal_service = journal_service
+        self.journal_flush_interval = journal_flush_interval
+        self.journal_flush_batch_size = journal_flush_batch_size
+        self.journal_flush_lock = None
+        self.journal_flush_task = None
+        self.journal_flush_sleeping = False
+
+    def is_stale(self):
+        return self.storage_service.is_stale()
+
+    def refresh_if_stale(self):
+        self.storage_service.refresh_if_stale()
+
+    async def _run_in_executor(self, function, *args):
+        # storage clients are blocking, so they run in a bounded thread pool to keep the event loop free
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(function, *args))
+
+    def _get_totals_lock(self):
+        # the locks are created lazily to be bound to the loop which runs the bot
+        if self.totals_lock is None:
+            self.totals_lock = asyncio.Lock()
+        return self.totals_lock
+
+    def _apply_to_totals(self, user_id, amount):
+        if self.totals is not None:
+            user_id = str(user_id)
+            self.totals[user_id] = self.totals.get(user_id, 0) + amount
+
+    async def _add_value(self, user_id, amount, reason, requesting_user_id, confirming_user_id):
+        if not self.storage_service.user_exists(user_id):
+            raise StorageException(f"Invalid user provided (user_id={user_id})")
+
+        self.writes_count += 1
+        self.writes_in_flight += 1
+        try:
+            if self.journal_service:
+                await self._run_in_executor(self.journal_service.append, user_id, amount, reason, requesting_user_id, confirming_user_id)
+            else:
+                await self._run_in_executor(
+                    partial(
+                        self.storage_service.add_entry,
+                        user_id,
+                        amount,
+                        reason,
+                        requesting_user_id=requesting_user_id,
+                        confirming_user_id=confirming_user_id
+                    )
+                )
+        finally:
+            self.writes_in_flight -= 1
+
+        if self.journal_service:
+            self._schedule_flush()
+        else:
+            self._apply_to_totals(user_id, amount)
+
+        # flushing the journal later doesn't change the total a user sees, so the leaderboard is updated only here
+        self.leaderboard_service.add(user_id, amount)
+
+    async def up(self, user_id, reason, requesting_user_id=None, confirming_user_id=None):
+        await self._add_value(user_id, 1, reason, requesting_user_id, confirming_user_id)
+
+    async def down(self, user_id, reason, requesting_user_id=None, confirming_user_id=None):
+        await self._add_value(user_id, -1, reason, requesting_user_id, confirming_user_id)
+
+    def _schedule_flush(self):
+        if self.journal_flush_task is None or self.journal_flush_task.done():
+            self.journal_flush_task = asyncio.create_task(self._flush_with_retries())
+
+    async def _sleep_before_flush(self, delay):
+        # the task is only cancelled while sleeping, since cancelling a flush could write its entries twice
+        self.journal_flush_sleeping = True
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            self.journal_flush_sleeping = False
+
+    async def _flush_with_retries(self):
+        # waiting a bit lets the votes confirmed meanwhile to be written within the same batch
+        await self._sleep_before_flush(self.journal_flush_interval)
+
+        attempt = 0
+        while True:
+            try:
+                await self.flush()
+                return
+            except Exception as err:
+                delay = min(JOURNAL_FLUSH_RETRY_BASE_DELAY * 2 ** attempt, JOURNAL_FLUSH_RETRY_MAX_DELAY)
+                logger.error("Error flushing journal, will retry (attempt=%s, delay=%ss): %s", attempt + 1, delay, err)
+
+                attempt += 1
+                await self._sleep_before_flush(delay)
+
+    async def flush(self):
+        if not self.journal_service:
+            return
+
+        if self.journal_flush_lock is None:
+            self.journal_flush_lock = asyncio.Lock()
+
+        async with self.journal_flush_lock:
+            await self._settle_flushing()
+
+            while True:
+                entries = await self._run_in_executor(self.journal_service.get_pending, self.journal_flush_batch_size)
+                if not entries:
+                    return
+
+                users_entries = {}
+                for entry in entries:
+                    users_entries.setdefault(entry["user_id"], []).append(entry)
+
+                for (user_id, user_entries) in users_entries.items():
+                    # moving entries from the journal to the storage is not interleaved with totals reads,
+                    # so they are never counted twice
+                    async with self._get_totals_lock():
+                        position = await self._run_in_executor(self.storage_service.get_position, user_id)
+                        await self._run_in_executor(self.journal_service.mark_flushing, user_entries, position)
+                        try:
+                            await self._run_in_executor(self.storage_service.add_entries, user_entries)
+                        except Exception:
+                            # the entries might have been added before the error, so the totals are read again
+                            self.totals = None
+                            raise
+                        await self._run_in_executor(self.journal_service.remove, user_entries)
+                        self._apply_to_totals(user_id, sum(entry["amount"] for entry in user_entries))
+
+                    logger.info("Journal entries were flushed (user_id=%s, count=%s)", user_id, len(user_entries))
+
+    async def _settle_flushing(self):
+        async with self._get_totals_lock():
+            await self._settle_flushing_locked()
+
+    async def _settle_flushing_locked(self):
+        # entries left marked by a failed or cut off flush are sent again only if they are not in the storage yet,
+        # until then they might be counted both in the journal and in the storage, so they are settled before reads
+        if not self.journal_service.has_flushing():
+            return
+
+        entries = await self._run_in_executor(self.journal_service.get_flushing)
+
+        added_keys = await self._run_in_executor(self.storage_service.find_added_entries, entries)
+        added_entries = [entry for entry in entries if entry["key"] in added_keys]
+        if added_entries:
+            await self._run_in_executor(self.journal_service.remove, added_entries)
+            self.totals = None
+
+        not_added_entries = [entry for entry in entries if entry["key"] not in added_keys]
+        if not_added_entries:
+            await self._run_in_executor(self.journal_service.unmark_flushing, not_added_entries)
+
+        logger.warning("Journal entries of a failed flush were settled (added_count=%s, not_added_count=%s)", len(added_entries), len(not_added_entries))
+
+    async def _settle_flushing_before_read(self):
+        # the flush settles them as well, so a read isn't failed by the storage being unavailable for it
+        try:
+            await self._settle_flushing_locked()
+        except Exception as err:
+            logger.error("Error settling journal entries before read: %s", err)
+
+    async def close(self):
+        # the delayed flush is replaced by an immediate one, so no task is left pending on the closed loop
+        task = self.journal_flush_task
+        if task is not None and not task.done():
+            if self.journal_flush_sleeping:
+                task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+        await self.flush()
+
+    def has_pending_writes(self):
+        return self.journal_service is not None and self.journal_service.has_pending()
+
+    def _totals_are_fresh(self):
+        if self.totals is None:
+            return False
+
+        return self.totals_ttl is None or time() - self.totals_loaded_at < self.totals_ttl
+
+    async def _get_totals(self):
+        async with self._get_totals_lock():
+            if self.journal_service:
+                await self._settle_flushing_before_read()
+
+            if self._totals_are_fresh():
+                totals = dict(self.totals)
+            else:
+                writes_count = self.writes_count
+                writes_in_flight = self.writes_in_flight
+                totals = await self._run_in_executor(self.storage_service.get_totals)
+
+                # a write which overlaps with the read might be counted twice or missed, so such result is not cached
+                if writes_in_flight == 0 and writes_count == self.writes_count:
+                    self.totals = dict(totals)
+                    self.totals_loaded_at = time()
+                else:
+                    self.totals = None
+
+            # votes which are not flushed yet are included, so users never see stale numbers
+            if self.journal_service:
+                for (user_id, amount) in self.journal_service.get_pending_totals().items():
+                    totals[user_id] = totals.get(user_id, 0) + amount
+
+            # the leaderboard is built from the totals just read even if they are not cached, so it's never returned
+            # unloaded, while the next read of an uncached result rebuilds it with the overlapping write settled
+            self.leaderboard_service.load(totals)
+
+            return totals
+
+    def invalidate_totals(self):
+        self.totals = None
+
+    async def get_leaderboard(self):
+        if not self._totals_are_fresh() or not self.leaderboard_service.is_loaded():
+            await self._get_totals()
+        return self.leaderboard_service
+
+    async def get_total_value(self, user_id):
+        if not self.storage_service.user_exists(user_id):
+            raise StorageException(f"Invalid user provided (user_id={user_id})")
+
+        totals = await self._get_totals()
+        return totals[str(user_id)]
+
+    async def get_total_values(self):
+        return await self._get_totals()
+
+    async def get_window_totals(self, days):
+        # windows are made of whole UTC days, the current one included
+        since = (time() // SECONDS_IN_DAY - (days - 1)) * SECONDS_IN_DAY
+        window_totals = await self._run_in_executor(self.storage_service.get_window_totals, since)
+
+        # votes which are not flushed yet were just added, so they always fall into the window
+        if self.journal_service:
+            for (user_id, amount) in self.journal_service.get_pending_totals().items():
+                window_totals[user_id] = window_totals.get(user_id, 0) + amount
+
+        return window_totals
+
+    def supports_window_totals(self):
+        return self.storage_service.supports_window_totals
+
+    def supports_history(self):
+        return self.storage_service.supports_history
+
+    async def get_history(self, user_id, limit=None):
+        if not self.journal_service:
+            return await self._run_in_executor(self.storage_service.get_history, user_id, limit)
+
+        # flushing moves entries under the totals lock, so a vote is never found both in the journal and in the storage
+        async with self._get_totals_lock():
+            await self._settle_flushing_before_read()
+            pending_records = await self._run_in_executor(self.journal_service.get_pending_history, user_id, limit)
+            records = await self._run_in_executor(self.storage_service.get_history, user_id, limit)
+
+        # votes which are not flushed yet are the latest ones
+        records = pending_records + records
+        return records[:limit] if limit else records
+
+    async def compact(self):
+        # checkpoints don't change any total, so the cached totals stay valid
+        compacted_count = await self._run_in_executor(self.storage_service.compact)
+        logger.info("Storage was compacted (entries_count=%s)", compacted_count)
+        return compacted_count
@@ -0,0 +1,56 @@
+from bisect import bisect_left, insort
+
+
+class LeaderboardService:
+    def __init__(self):
+        self.totals = None
+        self.ranking = []
+        self.version = 0
+        self.rendered_text = None
+        self.rendered_version = None
+
+    def is_loaded(self):
+        return self.totals is not None
+
+    def load(self, totals):
+        totals = {str(user_id): total for (user_id, total) in totals.items()}
+        if totals == self.totals:
+            return
+
+        self.totals = totals
+        # ranking keys are ordered by total descending, ties are ordered by user id
+        self.ranking = sorted((-total, user_id) for (user_id, total) in totals.items())
+        self.version += 1
+
+    def add(self, user_id, amount):
+        if self.totals is None:
+            return
+
+        user_id = str(user_id)
+        total = self.totals.get(user_id, 0)
+
+        if user_id in self.totals:
+            del self.ranking[bisect_left(self.ranking, (-total, user_id))]
+
+        self.totals[user_id] = total + amount
+        insort(self.ranking, (-self.totals[user_id], user_id))
+        self.version += 1
+
+    def get_total(self, user_id):
+        return self.totals[str(user_id)]
+
+    def get_rank(self, user_id):
+        user_id = str(user_id)
+        return bisect_left(self.ranking, (-self.totals[user_id], user_id)) + 1
+
+    def get_ranking(self):
+        return [(user_id, -negative_total) for (negative_total, user_id) in self.ranking]
+
+    def get_rendered_text(self, names_version):
+        if self.rendered_version != (self.version, names_version):
+            return None
+        return self.rendered_text
+
+    def set_rendered_text(self, rendered_text, version, names_version):
+        self.rendered_text = rendered_text
+        self.rendered_version = (version, names_version)
@@ -0,0 +1,118 @@
+from random import random
+import json
+import logging
+
+from config import get_config
+
+
+# keys which hold texts written by users, `body` is the raw update in Lambda events
+REDACTED_KEYS = ('text', 'caption', 'reason', 'body')
+# warnings and errors are never sampled out
+SAMPLING_MAX_LEVEL = logging.INFO
+
+def get_log_level(name):
+    # the level of the closest configured parent logger is used, e.g. `services` for `services.bot`
+    levels = get_config().log_levels
+    while name:
+        if name in levels:
+            return levels[name]
+        name = name.rpartition('.')[0]
+    return levels.get('default', 'INFO')
+
+def redact_text(text):
+    if text is None or not get_config().log_redact_texts:
+        return text
+    return f"<redacted, {len(text)} chars>"
+
+def redact_json(value):
+    if isinstance(value, dict):
+        return {key: redact_text(item) if key in REDACTED_KEYS and isinstance(item, str) else redact_json(item) for (key, item) in value.items()}
+    if isinstance(value, list):
+        return [redact_json(item) for item in value]
+    return value
+
+
+class SamplingFilter(logging.Filter):
+    # high-volume records pass `extra={"event": ...}`, and only a share of them configured in `LOG_SAMPLE_RATES` is logged
+    def filter(self, record):
+        event = getattr(record, 'event', None)
+        if event is None or record.levelno > SAMPLING_MAX_LEVEL:
+            return True
+
+        sample_rate = get_config().log_sample_rates.get(event)
+        return sample_rate is None or random() < sample_rate
+
+
+class LazyUpdate:
+    # rendered only if the record is emitted, instead of the whole `Update` object
+    __slots__ = ('update',)
+
+    def __init__(self, update):
+        self.update = update
+
+    def __str__(self):
+        update = self.update
+        fields = [f"update_id={update.update_id}"]
+
+        if update.effective_chat:
+            fields.append(f"chat_id={update.effective_chat.id}")
+        if update.effective_user:
+            fields.append(f"user_id={update.effective_user.id}")
+
+        if update.callback_query:
+            fields.append(f"callback_data={update.callback_query.data}")
+        elif update.effective_message:
+            fields.append(f"message_id={update.effective_message.message_id}")
+            fields.append(f"text={redact_text(update.effective_message.text)}")
+
+        return ", ".join(fields)
+
+
+class LazyJson:
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return json.dumps(redact_json(self.value), ensure_ascii=False)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+
+        event = getattr(record, 'event', None)
+        if event is not None:
+            entry["event"] = event
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, ensure_ascii=False)
+
+
+sampling_filter = SamplingFilter()
+
+def get_logger(name):
+    logger = logging.getLogger(name)
+    logger.setLevel(get_log_level(name))
+    logger.addFilter(sampling_filter)
+    return logger
+
+def configure_logging():
+    config = get_config()
+
+    # the levels of third-party loggers, the bot's loggers get theirs in `get_logger`
+    for (name, level) in config.log_levels.items():
+        if name != 'default':
+            logging.getLogger(name).setLevel(level)
+
+    # Lambda installs its own handler on the root logger, so the formatter is replaced instead of adding a handler
+    if config.log_format == 'json':
+        for handler in logging.getLogger().handlers:
+            handler.setFormatter(JsonFormatter())
@@ -0,0 +1,137 @@
+from bisect import bisect_left
+from functools import wraps
+from threading import Lock
+from time import perf_counter
+
+from services.logs import get_logger
+
+
+# upper bounds of the latency histogram buckets in milliseconds, the last bucket has no bound
+LATENCY_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+logger = get_logger(__name__)
+
+class Histogram:
+    __slots__ = ('buckets', 'count', 'sum', 'max')
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.buckets[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def get_quantile(self, quantile):
+        # the upper bound of the bucket holding the quantile, observations over the last bound are reported as the maximum
+        rank = quantile * self.count
+        seen = 0
+        for (index, bucket_count) in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                return min(LATENCY_BUCKETS[index], self.max) if index < len(LATENCY_BUCKETS) else self.max
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "avg_ms": round(self.sum / self.count, 2) if self.count else 0,
+            "p50_ms": round(self.get_quantile(0.5), 2),
+            "p99_ms": round(self.get_quantile(0.99), 2),
+            "max_ms": round(self.max, 2)
+        }
+
+
+class MetricsScope:
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+
+    def to_dict(self):
+        return {
+            "latencies": {name: histogram.to_dict() for (name, histogram) in sorted(self.histograms.items())},
+            "counters": dict(sorted(self.counters.items()))
+        }
+
+
+class MetricsService:
+    def __init__(self):
+        # storage calls are recorded from the executor threads
+        self.lock = Lock()
+        # `total` is kept for the life of the process, `invocation` is reset by `pop_invocation_metrics`
+        self.total = MetricsScope()
+        self.invocation = MetricsScope()
+
+    def observe(self, name, elapsed):
+        elapsed_ms = elapsed * 1000
+        with self.lock:
+            for scope in (self.total, self.invocation):
+                histogram = scope.histograms.get(name)
+                if histogram is None:
+                    histogram = scope.histograms[name] = Histogram()
+                histogram.observe(elapsed_ms)
+
+    def increment(self, name, value=1):
+        with self.lock:
+            for scope in (self.total, self.invocation):
+                scope.counters[name] = scope.counters.get(name, 0) + value
+
+    def timed(self, name, function):
+        @wraps(function)
+        async def _timed_function(*args, **kwargs):
+            started_at = perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            except Exception:
+                self.increment(f"{name}.errors")
+                raise
+            finally:
+                self.observe(name, perf_counter() - started_at)
+
+        return _timed_function
+
+    def timed_sync(self, name, function):
+        @wraps(function)
+        def _timed_function(*args, **kwargs):
+            started_at = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                self.increment(f"{name}.errors")
+                raise
+            finally:
+                self.observe(name, perf_counter() - started_at)
+
+        return _timed_function
+
+    def instrument(self, instance, prefix, method_names):
+        # the bound methods of the instance are replaced, so the class and its other instances stay intact
+        for method_name in method_names:
+            setattr(instance, method_name, self.timed_sync(f"{prefix}.{method_name}", getattr(instance, method_name)))
+
+    def get_metrics(self):
+        with self.lock:
+            return self.total.to_dict()
+
+    def pop_invocation_metrics(self):
+        with self.lock:
+            (invocation, self.invocation) = (self.invocation, MetricsScope())
+        return invocation.to_dict()
+
+    def format_text(self):
+        metrics = self.get_metrics()
+
+        lines = [f"{'latency':<32}{'count':>7}{'p50':>7}{'p99':>7}{'max':>8}"]
+        for (name, histogram) in metrics["latencies"].items():
+            lines.append(f"{name:<32}{histogram['count']:>7}{histogram['p50_ms']:>7.1f}{histogram['p99_ms']:>7.1f}{histogram['max_ms']:>8.1f}")
+
+        lines.append("")
+        for (name, value) in metrics["counters"].items():
+            lines.append(f"{name:<32}{value:>29}")
+
+        return "\n".join(lines)
@@ -0,0 +1,82 @@
+from itertools import count
+from time import time
+import asyncio
+import heapq
+
+from services.logs import get_logger
+
+
+# keys which are due within this window are fired together
+FIRE_BATCH_WINDOW = 0.05
+
+logger = get_logger(__name__)
+
+class ExpiryScheduler:
+    def __init__(self, expired_callback):
+        self.expired_callback = expired_callback
+        self.heap = []
+        self.deadlines = {}
+        self.counter = count()
+        self.timer = None
+        self.timer_deadline = None
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def schedule(self, key, expire_time):
+        self.deadlines[key] = expire_time
+        heapq.heappush(self.heap, (expire_time, next(self.counter), key))
+
+        if self.timer_deadline is None or expire_time < self.timer_deadline:
+            self._arm_timer()
+
+    def cancel(self, key):
+        # heap entry is left in place and skipped once it pops out, which keeps cancellation O(1)
+        if self.deadlines.pop(key, None) is None:
+            return False
+
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            self._compact()
+        return True
+
+    def _compact(self):
+        self.heap = [entry for entry in self.heap if self.deadlines.get(entry[2]) == entry[0]]
+        heapq.heapify(self.heap)
+
+    def _arm_timer(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+            self.timer_deadline = None
+
+        if not self.heap:
+            return
+
+        loop = asyncio.get_event_loop()
+        self.timer_deadline = self.heap[0][0]
+        self.timer = loop.call_later(max(self.timer_deadline - time(), 0), self._fire)
+
+    def pop_due(self, now):
+        due_keys = []
+        while self.heap and self.heap[0][0] <= now:
+            (expire_time, _, key) = heapq.heappop(self.heap)
+            if self.deadlines.get(key) == expire_time:
+                del self.deadlines[key]
+                due_keys.append(key)
+        return due_keys
+
+    def _fire(self):
+        self.timer = None
+        self.timer_deadline = None
+
+        due_keys = self.pop_due(time() + FIRE_BATCH_WINDOW)
+        if due_keys:
+            asyncio.ensure_future(self._run_expired_callback(due_keys))
+
+        self._arm_timer()
+
+    async def _run_expired_callback(self, keys):
+        try:
+            await self.expired_callback(keys)
+        except Exception as err:
+            logger.error("Error executing expired callback (keys_count=%s): %s", len(keys), err)
@@ -0,0 +1,274 @@
+from enum import IntEnum
+from heapq import heapify, heappop, heappush
+from itertools import count
+from time import monotonic
+import asyncio
+
+from telegram.constants import ParseMode
+from telegram.error import RetryAfter
+
+from services.logs import get_logger
+
+
+logger = get_logger(__name__)
+
+class SendPriority(IntEnum):
+    # replies to the users of a chat go first, notices about stale requests and deletes of their keyboards wait
+    REPLY = 0
+    NOTICE = 1
+    CLEANUP = 2
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        # `rate` tokens per second are added up to `capacity`, the bucket never runs out if `rate` is not set
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = monotonic()
+        self.paused_until = 0
+
+    def get_delay(self):
+        now = monotonic()
+        pause_delay = max(0, self.paused_until - now)
+        if not self.rate:
+            return pause_delay
+
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        return max(pause_delay, 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate)
+
+    def take(self):
+        if self.rate:
+            self.tokens -= 1
+
+    def pause(self, delay):
+        # after a flood control error the next token is available only once the delay passes, even without a limit,
+        # and there's no burst right after it
+        self.paused_until = max(self.paused_until, monotonic() + delay)
+        if self.rate:
+            self.get_delay()
+            self.tokens = min(self.tokens, 1 - delay * self.rate)
+
+
+class SendQueueService:
+    def __init__(self, bot, chat_messages_per_minute=None, messages_per_second=None, max_retries=3, metrics_service=None):
+        self.bot = bot
+        self.chat_rate = chat_messages_per_minute / 60 if chat_messages_per_minute else None
+        self.chat_capacity = chat_messages_per_minute
+        self.global_bucket = TokenBucket(messages_per_second, messages_per_second)
+        self.max_retries = max_retries
+        self.metrics_service = metrics_service
+
+        # calls of a chat are made one by one in the order of their priority, the chats are served concurrently
+        self.chat_queues = {}
+        self.chat_buckets = {}
+        self.chat_tasks = {}
+        self.pending_notices = {}
+        self.sequence = count()
+        self.cancelled_count = 0
+
+        # chats which got flood control errors, mapped to the time their delays pass
+        self.flooded_chats = {}
+
+        # chats whose calls wait for the limits or the flood control, and an event set whenever that or the queue changes
+        self.held_chat_ids = set()
+        self.changed_event = None
+
+    def _increment(self, name):
+        if self.metrics_service:
+            self.metrics_service.increment(name)
+
+    def _notify_changed(self):
+        if self.changed_event is not None:
+            self.changed_event.set()
+
+    async def _hold(self, chat_id, delay):
+        self.held_chat_ids.add(chat_id)
+        self._notify_changed()
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            self.held_chat_ids.discard(chat_id)
+
+    def _enqueue(self, chat_id, priority, call, wait_result):
+        future = asyncio.get_event_loop().create_future() if wait_result else None
+        heappush(self.chat_queues.setdefault(chat_id, []), (priority, next(self.sequence), monotonic(), call, future))
+
+        if chat_id not in self.chat_tasks:
+            self.chat_tasks[chat_id] = asyncio.ensure_future(self._run_chat_queue(chat_id))
+
+        return future
+
+    async def _acquire(self, chat_id, chat_bucket):
+        # a call takes a token of its chat and a global one, both are checked at once so none is taken in vain;
+        # deletes are not messages of the chat, so they take only the global one
+        while True:
+            delay = max(chat_bucket.get_delay() if chat_bucket else 0, self.global_bucket.get_delay())
+            if delay <= 0:
+                if chat_bucket:
+                    chat_bucket.take()
+                self.global_bucket.take()
+                return
+
+            await self._hold(chat_id, delay)
+
+    async def _call(self, chat_id, call, chat_bucket, limited_bucket):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await call()
+            except RetryAfter as err:
+                if attempt == self.max_retries:
+                    raise
+
+                logger.warning("Flood control exceeded, the call will be retried (retry_after=%s, attempt=%s)", err.retry_after, attempt + 1)
+                self._increment("send_queue.retries")
+
+                self._pause_on_flood(chat_id, chat_bucket, err.retry_after)
+                await self._hold(chat_id, err.retry_after)
+                await self._acquire(chat_id, limited_bucket)
+
+    def _pause_on_flood(self, chat_id, chat_bucket, retry_after):
+        # the error doesn't tell whether the chat or the whole bot is over the limit, the latter is assumed once
+        # several chats get it at once, so the other chats don't keep sending into the flood control
+        now = monotonic()
+        self.flooded_chats = {id: until for (id, until) in self.flooded_chats.items() if until > now}
+        self.flooded_chats[chat_id] = now + retry_after
+
+        chat_bucket.pause(retry_after)
+        if len(self.flooded_chats) > 1:
+            logger.warning("Flood control exceeded in several chats, all chats are paused (chats_count=%s, retry_after=%s)", len(self.flooded_chats), retry_after)
+            self.global_bucket.pause(retry_after)
+
+    def _pop_next(self, queue, chat_bucket):
+        # while the chat is out of tokens its deletes don't wait behind its messages, as they don't take the chat's tokens
+        if queue[0][0] != SendPriority.CLEANUP and chat_bucket.get_delay() > 0:
+            cleanup_entries = [entry for entry in queue if entry[0] == SendPriority.CLEANUP]
+            if cleanup_entries:
+                entry = min(cleanup_entries)
+                queue.remove(entry)
+                heapify(queue)
+                return entry
+
+        return heappop(queue)
+
+    async def _run_chat_queue(self, chat_id):
+        queue = self.chat_queues[chat_id]
+        chat_bucket = self.chat_buckets.get(chat_id)
+        if chat_bucket is None:
+            chat_bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_capacity)
+
+        try:
+            while queue:
+                (priority, _, enqueued_at, call, future) = self._pop_next(queue, chat_bucket)
+                limited_bucket = None if priority == SendPriority.CLEANUP else chat_bucket
+
+                try:
+                    await self._acquire(chat_id, limited_bucket)
+                    if self.metrics_service:
+                        self.metrics_service.observe("send_queue.wait", monotonic() - enqueued_at)
+
+                    result = await self._call(chat_id, call, chat_bucket, limited_bucket)
+                except asyncio.CancelledError:
+                    # the call taken from the queue is dropped as well
+                    self.cancelled_count += 1
+                    if future is not None:
+                        future.cancel()
+                    raise
+                except Exception as err:
+                    self._increment("send_queue.errors")
+                    if future is None:
+                        logger.error("Error sending queued call (chat_id=%s): %s", chat_id, err)
+                    elif not future.cancelled():
+                        future.set_exception(err)
+                    continue
+
+                if future is not None and not future.cancelled():
+                    future.set_result(result)
+        finally:
+            del self.chat_tasks[chat_id]
+            if not queue:
+                del self.chat_queues[chat_id]
+            self._notify_changed()
+
+    def send_message(self, chat_id, text, reply_to_message_id=None, reply_markup=None):
+        # returns a future of the sent message, replies are sent before the other calls waiting in the chat
+        call = lambda: self.bot.send_message(
+            chat_id=chat_id,
+            text=text,
+            reply_to_message_id=reply_to_message_id,
+            reply_markup=reply_markup,
+            parse_mode=ParseMode.MARKDOWN
+        )
+        return self._enqueue(chat_id, SendPriority.REPLY, call, wait_result=True)
+
+    def delete_message(self, chat_id, message_id):
+        # nobody waits for the deletes of stale keyboards, their errors are only logged
+        call = lambda: self.bot.delete_message(chat_id=chat_id, message_id=message_id)
+        self._enqueue(chat_id, SendPriority.CLEANUP, call, wait_result=False)
+
+    def send_notice(self, chat_id, text, reply_to_message_id, coalesced_text):
+        # the same notices queued in a chat before the first one is sent are sent as one message,
+        # which doesn't reply to any of the requests, e.g. when many sessions expire at once
+        key = (chat_id, text)
+        reply_to_message_ids = self.pending_notices.get(key)
+        if reply_to_message_ids is not None:
+            reply_to_message_ids.append(reply_to_message_id)
+            self._increment("send_queue.coalesced")
+            return
+
+        reply_to_message_ids = self.pending_notices[key] = [reply_to_message_id]
+
+        async def call():
+            self.pending_notices.pop(key, None)
+
+            if len(reply_to_message_ids) == 1:
+                return await self.bot.send_message(chat_id=chat_id, text=text, reply_to_message_id=reply_to_message_ids[0], parse_mode=ParseMode.MARKDOWN)
+
+            logger.info("Notices were coalesced (chat_id=%s, count=%s)", chat_id, len(reply_to_message_ids))
+            return await self.bot.send_message(chat_id=chat_id, text=coalesced_text.format(count=len(reply_to_message_ids)), parse_mode=ParseMode.MARKDOWN)
+
+        self._enqueue(chat_id, SendPriority.NOTICE, call, wait_result=False)
+
+    def get_pending_count(self):
+        # every running chat task holds a call taken from its queue
+        return sum(len(queue) for queue in self.chat_queues.values()) + len(self.chat_tasks)
+
+    async def drain(self, timeout=None, wait_for_limits=True):
+        # returns whether all the queued calls were made, the rest stays queued if the timeout passes;
+        # without `wait_for_limits` it returns as soon as every chat left waits for the limits or the flood control
+        if self.changed_event is None:
+            self.changed_event = asyncio.Event()
+
+        deadline = None if timeout is None else monotonic() + timeout
+        while self.chat_tasks:
+            if not wait_for_limits and self.held_chat_ids.issuperset(self.chat_tasks):
+                return False
+
+            remaining = None if deadline is None else deadline - monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+
+            self.changed_event.clear()
+            try:
+                await asyncio.wait_for(self.changed_event.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    async def cancel(self):
+        # the calls left queued are dropped, returns their number
+        self.cancelled_count = 0
+        tasks = list(self.chat_tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        dropped_count = self.get_pending_count() + self.cancelled_count
+        for queue in self.chat_queues.values():
+            for (_, _, _, _, future) in queue:
+                if future is not None:
+                    future.cancel()
+        self.chat_queues.clear()
+        self.pending_notices.clear()
+        return dropped_count
@@ -1,8 +1,11 @@
 import asyncio
+import logging
 from enum import Enum
 from uuid import uuid4
 from time import time
-import logging
+
+from services.scheduler import ExpiryScheduler
+from services.logs import get_logger
 
 
 class SessionType(Enum):
@@ -18,14 +21,39 @@ class SessionTypeException(Exception):
     pass
 
 
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
+class Session:
+    __slots__ = ("id", "type", "user_id", "chat_id", "message_id", "expire_time", "data")
+
+    def __init__(self, id, type, user_id, chat_id, message_id, expire_time, data):
+        self.id = id
+        self.type = type
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.expire_time = expire_time
+        self.data = data
+
+    def __repr__(self):
+        return f"Session(id={self.id}, type={self.type}, user_id={self.user_id}, chat_id={self.chat_id}, message_id={self.message_id})"
+
+    def to_dict(self):
+        record = {name: getattr(self, name) for name in self.__slots__}
+        record["type"] = self.type.value
+        return record
+
+    @classmethod
+    def from_dict(cls, record):
+        return cls(**{**record, "type": SessionType(record["type"])})
+
+
+logger = get_logger(__name__)
 
 class SessionService:
-    def __init__(self, session_ttls):
-        self.storage = {}
-        self.users_sessions = {}
+    def __init__(self, session_ttls, store):
+        self.store = store
         self.session_ttls = session_ttls
+        self.expired_callbacks = {}
+        self.scheduler = ExpiryScheduler(self._expire_sessions)
 
     def _get_session_ttl(self, session_type):
         if session_type not in SessionType:
@@ -37,89 +65,112 @@ class SessionService:
         return self.session_ttls[session_type]
 
     def _log_active_sessions(self):
-        logger.info(f"Session storage: {self.storage.keys()}")
-        logger.info(f"Users sessions storage: {self.users_sessions}")
+        # counting the sessions queries the store, so it's done only if the record is emitted
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Active sessions count: %s", self.store.count())
 
-    async def _expired_callback(self, id, session_ttl, expired_callback):
-        logger.info(f"Expired callback was registered (session_id={id}, session_ttl={session_ttl})")
-        
-        await asyncio.sleep(session_ttl)
+    def register_expired_callback(self, session_type, expired_callback):
+        # callbacks can't be stored along with the sessions, so they are registered per session type
+        self.expired_callbacks[session_type] = expired_callback
 
-        logger.info(f"Executing registered callback (session_id={id})")
+    async def _run_expired_callback(self, session):
+        logger.info("Executing registered callback (session_id=%s)", session.id)
         try:
-            await expired_callback(self.storage[id])
+            await self.expired_callbacks[session.type](session)
         except Exception as err:
-            logger.error(f"Error executing registered callback (session_id={id}): {err}")
+            logger.error("Error executing registered callback (session_id=%s): %s", session.id, err)
+
+    async def _expire_sessions(self, ids):
+        # the sessions might have been already handled by another worker sharing the store
+        expired_sessions = [session for session in map(self.store.delete, ids) if session is not None]
+
+        await asyncio.gather(*[self._run_expired_callback(session) for session in expired_sessions])
+
+        if expired_sessions:
+            logger.warning("Expired sessions were deleted (count=%s)", len(expired_sessions))
+            self._log_active_sessions()
 
-        logger.warning(f"Session will be deleted (session_id={id})")
-        self.delete_session(id, cancel_task=False)
+    async def sweep_expired_sessions(self):
+        expired_sessions = self.store.pop_expired(time())
+
+        for session in expired_sessions:
+            self.scheduler.cancel(session.id)
+
+        await asyncio.gather(*[self._run_expired_callback(session) for session in expired_sessions])
+
+        if expired_sessions:
+            logger.warning("Expired sessions were swept (count=%s)", len(expired_sessions))
 
     def create_session(
         self,
         type,
         user,
-        expired_callback,
+        chat_id,
+        message_id,
         data,
-        id = uuid4()
+        id = None
     ):
-        if id in self.storage:
+        id = id if id is not None else str(uuid4())
+
+        if self.store.get(id) is not None:
             raise SessionException(f"Session with id={id} already exists")
 
+        if self.store.get_by_message(chat_id, message_id) is not None:
+            raise SessionException(f"Session for message (chat_id={chat_id}, message_id={message_id}) already exists")
+
         session_ttl = self._get_session_ttl(type)
         expire_time = time() + session_ttl
-        expire_task = asyncio.create_task(self._expired_callback(id, session_ttl, expired_callback))
-
-        self.storage[id] = {
-            "id": id,
-            "type": type,
-            "user": user,
-            "expire_time": expire_time,
-            "expire_task": expire_task,
-            "data": data
-        }
-
-        if user.id not in self.users_sessions:
-            self.users_sessions[user.id] = set()
-        self.users_sessions[user.id].add(id)
-
-        logger.info(f"Session was created (session_id={id})")
+
+        self.store.put(Session(
+            id=id,
+            type=type,
+            user_id=user.id,
+            chat_id=chat_id,
+            message_id=message_id,
+            expire_time=expire_time,
+            data=data
+        ))
+        self.scheduler.schedule(id, expire_time)
+
+        logger.info("Session was created (session_id=%s)", id)
         self._log_active_sessions()
 
         return id
 
-    def delete_session(self, id, cancel_task=True):
-        if id not in self.storage:
+    def delete_session(self, id):
+        session = self.store.delete(id)
+        if session is None:
             raise SessionException(f"Session with id={id} does not exist")
 
-        if cancel_task:
-            self.storage[id]["expire_task"].cancel()
-            logger.info(f"Expire task was canceled (session_id={id})")
+        if self.scheduler.cancel(id):
+            logger.info("Session expiry was canceled (session_id=%s)", id)
 
-        session = self.storage.pop(id)
-
-        self.users_sessions[session["user"].id].remove(session["id"])
-        if len(self.users_sessions[session["user"].id]) == 0:
-            del self.users_sessions[session["user"].id]
-
-        logger.info(f"Session was deleted (session_id={session['id']})")
+        logger.info("Session was deleted (session_id=%s)", session.id)
         self._log_active_sessions()
 
     def session_is_expired(self, session):
-        return time() > session["expire_time"]
+        return time() > session.expire_time
 
     def get_session(self, id):
-        if id not in self.storage:
+        session = self.store.get(id)
+        if session is None:
             raise SessionException(f"Session with id={id} does not exist")
 
-        return self.storage[id]
+        return session
 
-    def user_has_session(self, user_id, filter_by_type = None):
-        if user_id not in self.users_sessions:
-            return False
+    def get_session_by_message(self, chat_id, message_id):
+        session = self.store.get_by_message(chat_id, message_id)
+        if session is None:
+            raise SessionException(f"Session for message (chat_id={chat_id}, message_id={message_id}) does not exist")
 
-        if filter_by_type:
-            sessions = list(self.users_sessions[user_id])
-            sessions_of_type = list(filter(lambda session_id: self.storage[session_id]["type"] == filter_by_type, sessions))
-            return len(sessions_of_type) > 0
-        
-        return len(self.users_sessions[user_id]) > 0
+        return session
+
+    def get_sessions_of_type(self, session_type):
+        return self.store.get_sessions_of_type(session_type)
+
+    # sessions are namespaced by chat, so a user's session in one chat doesn't affect the other chats
+    def user_has_session(self, chat_id, user_id, filter_by_type = None):
+        session_types = [filter_by_type] if filter_by_type else list(SessionType)
+        now = time()
+
+        return any(self.store.has_user_session(chat_id, user_id, session_type, now) for session_type in session_types)
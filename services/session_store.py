@@ -0,0 +1,196 @@
+from abc import ABC, abstractmethod
+from threading import Lock
+import json
+import sqlite3
+
+from services.session import Session
+
+
+# sessions are short-lived, so the table is recreated instead of being migrated when the version changes
+SCHEMA_VERSION = 3
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    type INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    expire_time REAL NOT NULL,
+    record TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_chat_id_user_id_type ON sessions (chat_id, user_id, type, expire_time);
+CREATE UNIQUE INDEX IF NOT EXISTS sessions_chat_id_message_id ON sessions (chat_id, message_id);
+CREATE INDEX IF NOT EXISTS sessions_type ON sessions (type);
+CREATE INDEX IF NOT EXISTS sessions_expire_time ON sessions (expire_time);
+"""
+
+class SessionStore(ABC):
+    @abstractmethod
+    def put(self, session):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get(self, id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_by_message(self, chat_id, message_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def has_user_session(self, chat_id, user_id, session_type, now):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_sessions_of_type(self, session_type):
+        raise NotImplementedError
+
+    @abstractmethod
+    def pop_expired(self, now):
+        raise NotImplementedError
+
+    @abstractmethod
+    def count(self):
+        raise NotImplementedError
+
+
+class MemorySessionStore(SessionStore):
+    def __init__(self):
+        self.sessions = {}
+        self.users_sessions = {}
+        self.messages_sessions = {}
+        # all sessions of a type share the same TTL, so creation order is also expiration order
+        self.types_sessions = {}
+
+    def put(self, session):
+        self.sessions[session.id] = session
+        self.users_sessions.setdefault((session.chat_id, session.user_id, session.type), set()).add(session.id)
+        self.messages_sessions[(session.chat_id, session.message_id)] = session.id
+        self.types_sessions.setdefault(session.type, {})[session.id] = None
+
+    def get(self, id):
+        return self.sessions.get(id)
+
+    def get_by_message(self, chat_id, message_id):
+        id = self.messages_sessions.get((chat_id, message_id))
+        return None if id is None else self.sessions[id]
+
+    def delete(self, id):
+        session = self.sessions.pop(id, None)
+        if session is None:
+            return None
+
+        user_key = (session.chat_id, session.user_id, session.type)
+        self.users_sessions[user_key].remove(id)
+        if len(self.users_sessions[user_key]) == 0:
+            del self.users_sessions[user_key]
+
+        del self.messages_sessions[(session.chat_id, session.message_id)]
+        del self.types_sessions[session.type][id]
+
+        return session
+
+    def has_user_session(self, chat_id, user_id, session_type, now):
+        ids = self.users_sessions.get((chat_id, user_id, session_type), ())
+        return any(self.sessions[id].expire_time >= now for id in ids)
+
+    def get_sessions_of_type(self, session_type):
+        return [self.sessions[id] for id in self.types_sessions.get(session_type, {})]
+
+    def pop_expired(self, now):
+        expired_sessions = []
+
+        for type_sessions in self.types_sessions.values():
+            expired_ids = []
+            for id in type_sessions:
+                if self.sessions[id].expire_time > now:
+                    break
+                expired_ids.append(id)
+
+            expired_sessions += [self.delete(id) for id in expired_ids]
+
+        return expired_sessions
+
+    def count(self):
+        return len(self.sessions)
+
+
+class SQLiteSessionStore(SessionStore):
+    def __init__(self, database_path):
+        self.database_path = database_path
+        self.lock = Lock()
+
+        self.connection = sqlite3.connect(database_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            self.connection.execute("DROP TABLE IF EXISTS sessions")
+            self.connection.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+        self.connection.executescript(SCHEMA)
+
+    def _fetch_sessions(self, query, parameters):
+        with self.lock:
+            rows = self.connection.execute(query, parameters).fetchall()
+        return [Session.from_dict(json.loads(row[0])) for row in rows]
+
+    def put(self, session):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO sessions (id, type, user_id, chat_id, message_id, expire_time, record) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    str(session.id),
+                    session.type.value,
+                    session.user_id,
+                    session.chat_id,
+                    session.message_id,
+                    session.expire_time,
+                    json.dumps(session.to_dict())
+                )
+            )
+
+    def get(self, id):
+        sessions = self._fetch_sessions("SELECT record FROM sessions WHERE id = ?", (str(id),))
+        return sessions[0] if sessions else None
+
+    def get_by_message(self, chat_id, message_id):
+        sessions = self._fetch_sessions("SELECT record FROM sessions WHERE chat_id = ? AND message_id = ?", (chat_id, message_id))
+        return sessions[0] if sessions else None
+
+    def delete(self, id):
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT record FROM sessions WHERE id = ?", (str(id),)).fetchone()
+            if row is None:
+                return None
+
+            # only the process which actually removed the row owns the session, so other workers can't handle it twice
+            cursor = self.connection.execute("DELETE FROM sessions WHERE id = ?", (str(id),))
+            if cursor.rowcount == 0:
+                return None
+
+        return Session.from_dict(json.loads(row[0]))
+
+    def has_user_session(self, chat_id, user_id, session_type, now):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT EXISTS (SELECT 1 FROM sessions WHERE chat_id = ? AND user_id = ? AND type = ? AND expire_time >= ?)",
+                (chat_id, user_id, session_type.value, now)
+            ).fetchone()
+        return row[0] == 1
+
+    def get_sessions_of_type(self, session_type):
+        return self._fetch_sessions("SELECT record FROM sessions WHERE type = ?", (session_type.value,))
+
+    def pop_expired(self, now):
+        with self.lock:
+            rows = self.connection.execute("SELECT id FROM sessions WHERE expire_time <= ?", (now,)).fetchall()
+
+        expired_sessions = [self.delete(row[0]) for row in rows]
+        return [session for session in expired_sessions if session is not None]
+
+    def count(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
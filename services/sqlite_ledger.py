@@ -0,0 +1,192 @@
+from threading import Lock
+from time import time
+import sqlite3
+
+from services.storage import StorageService, StorageException
+from services.logs import get_logger
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    ts REAL NOT NULL,
+    amount INTEGER NOT NULL,
+    reason TEXT,
+    requesting_user_id TEXT,
+    confirming_user_id TEXT,
+    key TEXT
+);
+CREATE INDEX IF NOT EXISTS entries_user_id_ts ON entries (user_id, ts);
+CREATE TABLE IF NOT EXISTS totals (
+    user_id TEXT PRIMARY KEY,
+    total INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS daily_totals (
+    day INTEGER NOT NULL,
+    user_id TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    PRIMARY KEY (day, user_id)
+);
+"""
+
+# columns which were added to the entries table after its first version
+ENTRIES_ADDED_COLUMNS = ("requesting_user_id", "confirming_user_id", "key")
+
+SECONDS_IN_DAY = 86400
+
+logger = get_logger(__name__)
+
+class SQLiteLedgerService(StorageService):
+    supports_window_totals = True
+    supports_history = True
+
+    def __init__(self, database_path, users):
+        self.database_path = database_path
+        self.users = users
+        self.lock = Lock()
+
+        self.connection = sqlite3.connect(database_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+        self._migrate()
+
+        logger.info("SQLite ledger was opened (database_path=%s)", database_path)
+
+    def _migrate(self):
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(entries)").fetchall()]
+
+        with self.connection:
+            for column in ENTRIES_ADDED_COLUMNS:
+                if column not in columns:
+                    self.connection.execute(f"ALTER TABLE entries ADD COLUMN {column} TEXT")
+                    logger.warning("Column was added to the ledger (column=%s)", column)
+
+            # keys of the journaled entries, an entry sent again after a failed flush is not added twice
+            self.connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS entries_key ON entries (key)")
+
+            # ledgers created before the rollup existed get it built from their entries once
+            has_daily_totals = self.connection.execute("SELECT EXISTS (SELECT 1 FROM daily_totals)").fetchone()[0] == 1
+            if not has_daily_totals:
+                self.connection.execute(
+                    "INSERT INTO daily_totals (day, user_id, total) "
+                    "SELECT CAST(ts / ? AS INTEGER), user_id, SUM(amount) FROM entries GROUP BY 1, 2",
+                    (SECONDS_IN_DAY,)
+                )
+
+    def _validate_user(self, user_id):
+        user_id = str(user_id)
+        if user_id not in self.users:
+            raise StorageException(f"Invalid user provided (user_id={user_id})")
+        return user_id
+
+    def user_exists(self, user_id):
+        return str(user_id) in self.users
+
+    def get_users(self):
+        return self.users.keys()
+
+    def _insert_entry(self, user_id, ts, amount, reason, requesting_user_id, confirming_user_id, key=None):
+        if key is not None and self.connection.execute("SELECT EXISTS (SELECT 1 FROM entries WHERE key = ?)", (key,)).fetchone()[0] == 1:
+            logger.warning("Entry was added already and is skipped (key=%s)", key)
+            return
+
+        self.connection.execute(
+            "INSERT INTO entries (user_id, ts, amount, reason, requesting_user_id, confirming_user_id, key) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (user_id, ts, amount, reason, requesting_user_id, confirming_user_id, key)
+        )
+        # UPSERT is not available in the SQLite version shipped with the Lambda runtime
+        self.connection.execute("INSERT OR IGNORE INTO totals (user_id, total) VALUES (?, 0)", (user_id,))
+        self.connection.execute("UPDATE totals SET total = total + ? WHERE user_id = ?", (amount, user_id))
+
+        # windowed totals are summed from per-day buckets, so their cost depends on the window and not on the history
+        day = int(ts // SECONDS_IN_DAY)
+        self.connection.execute("INSERT OR IGNORE INTO daily_totals (day, user_id, total) VALUES (?, ?, 0)", (day, user_id))
+        self.connection.execute("UPDATE daily_totals SET total = total + ? WHERE day = ? AND user_id = ?", (amount, day, user_id))
+
+    def _to_row(self, user_id, amount, reason, ts, requesting_user_id, confirming_user_id):
+        return (
+            self._validate_user(user_id),
+            ts or time(),
+            amount,
+            reason,
+            None if requesting_user_id is None else str(requesting_user_id),
+            None if confirming_user_id is None else str(confirming_user_id)
+        )
+
+    def add_entry(self, user_id, amount, reason, ts=None, requesting_user_id=None, confirming_user_id=None):
+        row = self._to_row(user_id, amount, reason, ts, requesting_user_id, confirming_user_id)
+
+        with self.lock, self.connection:
+            self._insert_entry(*row)
+
+    def add_entries(self, entries):
+        entries = [
+            self._to_row(
+                entry["user_id"],
+                entry["amount"],
+                entry["reason"],
+                entry.get("ts"),
+                entry.get("requesting_user_id"),
+                entry.get("confirming_user_id")
+            ) + (entry.get("key"),)
+            for entry in entries
+        ]
+
+        with self.lock, self.connection:
+            for entry in entries:
+                self._insert_entry(*entry)
+
+    def find_added_entries(self, entries):
+        keys = [entry["key"] for entry in entries if entry.get("key") is not None]
+
+        added_keys = set()
+        with self.lock:
+            for key in keys:
+                if self.connection.execute("SELECT EXISTS (SELECT 1 FROM entries WHERE key = ?)", (key,)).fetchone()[0] == 1:
+                    added_keys.add(key)
+        return added_keys
+
+    def get_total(self, user_id):
+        user_id = self._validate_user(user_id)
+
+        with self.lock:
+            row = self.connection.execute("SELECT total FROM totals WHERE user_id = ?", (user_id,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def get_totals(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT user_id, total FROM totals").fetchall()
+
+        stored_totals = dict(rows)
+        return {user_id: stored_totals.get(user_id, 0) for user_id in self.get_users()}
+
+    def get_window_totals(self, since):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT user_id, SUM(total) FROM daily_totals WHERE day >= ? GROUP BY user_id",
+                (int(since // SECONDS_IN_DAY),)
+            ).fetchall()
+
+        window_totals = dict(rows)
+        return {user_id: window_totals.get(user_id, 0) for user_id in self.get_users()}
+
+    def get_history(self, user_id, limit):
+        user_id = self._validate_user(user_id)
+
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT ts, amount, reason, requesting_user_id, confirming_user_id FROM entries "
+                "WHERE user_id = ? ORDER BY ts DESC LIMIT ?",
+                (user_id, -1 if limit is None else limit)
+            ).fetchall()
+        return [
+            {
+                "ts": ts,
+                "amount": amount,
+                "reason": reason,
+                "requesting_user_id": requesting_user_id,
+                "confirming_user_id": confirming_user_id
+            }
+            for (ts, amount, reason, requesting_user_id, confirming_user_id) in rows
+        ]
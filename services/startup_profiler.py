@@ -0,0 +1,109 @@
+from time import perf_counter
+import logging
+import os
+import sys
+
+
+DEFAULT_TOP_MODULES_COUNT = 20
+
+class StartupProfiler:
+    def __init__(self):
+        self.started_at = perf_counter()
+        # module name -> [inclusive time, self time]
+        self.modules = {}
+        self.stack = []
+        self.finding = False
+        self.first_update_reported = False
+
+    def find_spec(self, fullname, path, target=None):
+        if self.finding:
+            return None
+
+        # the spec is found by the rest of the finders, only the way it is executed is changed
+        self.finding = True
+        try:
+            for finder in sys.meta_path:
+                if finder is self or not hasattr(finder, "find_spec"):
+                    continue
+
+                spec = finder.find_spec(fullname, path, target)
+                if spec is not None:
+                    break
+            else:
+                return None
+        finally:
+            self.finding = False
+
+        # built-in and frozen importers are classes shared by all their modules, so they are left as is
+        loader = spec.loader
+        if loader is not None and not isinstance(loader, type) and hasattr(loader, "exec_module"):
+            loader.exec_module = self._wrap_exec_module(fullname, loader.exec_module)
+
+        return spec
+
+    def _wrap_exec_module(self, fullname, exec_module):
+        def timed_exec_module(module):
+            self.stack.append(0)
+            started_at = perf_counter()
+            try:
+                exec_module(module)
+            finally:
+                elapsed = perf_counter() - started_at
+                children_elapsed = self.stack.pop()
+                if self.stack:
+                    self.stack[-1] += elapsed
+                self.modules[fullname] = [elapsed, elapsed - children_elapsed]
+
+        return timed_exec_module
+
+    def get_top_modules(self, count=DEFAULT_TOP_MODULES_COUNT):
+        modules = sorted(self.modules.items(), key=lambda item: item[1][1], reverse=True)
+        return [(name, inclusive, self_elapsed) for (name, (inclusive, self_elapsed)) in modules[:count]]
+
+    def get_imports_elapsed(self):
+        return sum(self_elapsed for (_, self_elapsed) in self.modules.values())
+
+    def format_report(self, count=DEFAULT_TOP_MODULES_COUNT):
+        lines = [f"{'module':<50}{'self, ms':>10}{'total, ms':>11}"]
+        for (name, inclusive, self_elapsed) in self.get_top_modules(count):
+            lines.append(f"{name:<50}{self_elapsed * 1000:>10.1f}{inclusive * 1000:>11.1f}")
+        return "\n".join(lines)
+
+    def report_first_update(self):
+        if self.first_update_reported:
+            return
+        self.first_update_reported = True
+
+        # the logger is created on use, so the config read by it is imported after the profiler is installed
+        from services.logs import get_logger
+        logger = get_logger(__name__)
+
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(
+                "Startup profile (modules_count=%s, imports_elapsed=%.3fs, first_update_elapsed=%.3fs):\n%s",
+                len(self.modules),
+                self.get_imports_elapsed(),
+                perf_counter() - self.started_at,
+                self.format_report()
+            )
+
+
+profiler = None
+
+def install():
+    global profiler
+
+    # should be installed before the rest of the imports, modules imported earlier are not profiled
+    if profiler is None:
+        profiler = StartupProfiler()
+        sys.meta_path.insert(0, profiler)
+    return profiler
+
+def install_if_enabled():
+    # read from the environment directly, since the config might not be imported yet
+    if os.environ.get('STARTUP_PROFILE', 'false').lower() == 'true':
+        install()
+
+def report_first_update():
+    if profiler is not None:
+        profiler.report_first_update()
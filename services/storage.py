@@ -0,0 +1,69 @@
+from abc import ABC, abstractmethod
+
+
+# methods which do the storage I/O, they are timed by the metrics
+STORAGE_IO_METHODS = ("add_entry", "add_entries", "get_total", "get_totals", "get_window_totals", "get_history", "compact")
+
+
+class StorageException(Exception):
+    pass
+
+
+class StorageService(ABC):
+    # commands which need the data a backend doesn't store are not offered by the bot (see `/help`),
+    # so their methods are the only ones a backend might leave out
+    supports_window_totals = False
+    supports_history = False
+
+    def is_stale(self):
+        return False
+
+    def refresh_if_stale(self):
+        pass
+
+    @abstractmethod
+    def user_exists(self, user_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_users(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_entry(self, user_id, amount, reason, ts=None, requesting_user_id=None, confirming_user_id=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_entries(self, entries):
+        # journaled entries carry their `key`, which `find_added_entries` looks them up by
+        raise NotImplementedError
+
+    def get_position(self, user_id):
+        # where the entries of the user added from now on are looked up by `find_added_entries`, if a backend needs it
+        return None
+
+    @abstractmethod
+    def find_added_entries(self, entries):
+        # returns the keys of the given entries which are in the storage already, entries carry their `key` and
+        # the `position` taken before they were added; used to settle the entries whose adding failed or was cut off
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_total(self, user_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_totals(self):
+        raise NotImplementedError
+
+    def get_window_totals(self, since):
+        # totals of the entries added since the given timestamp, only called if `supports_window_totals` is set
+        raise NotImplementedError
+
+    def get_history(self, user_id, limit):
+        # only called if `supports_history` is set
+        raise NotImplementedError
+
+    def compact(self):
+        # returns the number of entries folded into checkpoints
+        return 0
@@ -0,0 +1,124 @@
+from time import time
+import asyncio
+
+from services.logs import get_logger
+
+
+TENANT_REFRESH_RETRY_BASE_DELAY = 5
+TENANT_REFRESH_RETRY_MAX_DELAY = 300
+
+logger = get_logger(__name__)
+
+class Tenant:
+    def __init__(self, chat_id, users_service, karma_service, admin_users=()):
+        self.chat_id = chat_id
+        self.users_service = users_service
+        self.karma_service = karma_service
+        # users allowed to run admin commands in the chat of the tenant
+        self.admin_users = admin_users
+
+    def __repr__(self):
+        return f"Tenant(chat_id={self.chat_id}, users={list(self.users_service.get_all_users().keys())})"
+
+
+class TenantService:
+    def __init__(self, load_tenant, missing_tenant_ttl=None):
+        # blocking function which builds a tenant of the chat or returns None if the chat is not served
+        self.load_tenant = load_tenant
+        self.missing_tenant_ttl = missing_tenant_ttl
+        self.tenants = {}
+        self.missing_tenants = {}
+        self.loading_tasks = {}
+        self.refreshing_tasks = {}
+        # chat id -> (failed refreshes count, time of the next refresh attempt)
+        self.refresh_failures = {}
+
+    def get_loaded_tenants(self):
+        return list(self.tenants.values())
+
+    def get_loaded_tenant(self, chat_id):
+        # unlike `get_tenant`, never loads or refreshes the tenant, so it can be used on the hot path of dropped updates
+        return self.tenants.get(chat_id)
+
+    def _is_known_missing(self, chat_id):
+        checked_at = self.missing_tenants.get(chat_id)
+        if checked_at is None:
+            return False
+
+        return self.missing_tenant_ttl is None or time() - checked_at < self.missing_tenant_ttl
+
+    async def get_tenant(self, chat_id):
+        tenant = self.tenants.get(chat_id)
+        if tenant is not None:
+            # only the tenant an update belongs to is refreshed, and only when it's used
+            if tenant.karma_service.is_stale() and self._can_refresh(chat_id):
+                await self._refresh_tenant(tenant)
+            return tenant
+
+        if chat_id is None or self._is_known_missing(chat_id):
+            return None
+
+        # concurrent updates of a chat which is not loaded yet wait for the same load
+        task = self.loading_tasks.get(chat_id)
+        if task is None:
+            task = asyncio.ensure_future(self._load_tenant(chat_id))
+            self.loading_tasks[chat_id] = task
+
+        return await asyncio.shield(task)
+
+    async def _load_tenant(self, chat_id):
+        started_at = time()
+        loop = asyncio.get_running_loop()
+
+        try:
+            # loading connects to the tenant's storage, so it runs in a thread and doesn't hold up other tenants
+            tenant = await loop.run_in_executor(None, self.load_tenant, chat_id)
+        except Exception as err:
+            logger.error("Error loading tenant (chat_id=%s): %s", chat_id, err)
+            raise
+        finally:
+            del self.loading_tasks[chat_id]
+
+        if tenant is None:
+            logger.warning("No tenant is configured for the chat (chat_id=%s)", chat_id)
+            self.missing_tenants[chat_id] = time()
+            return None
+
+        self.missing_tenants.pop(chat_id, None)
+        self.tenants[chat_id] = tenant
+
+        logger.info("Tenant was loaded (chat_id=%s, elapsed=%.3fs): %s", chat_id, time() - started_at, tenant)
+        return tenant
+
+    def _can_refresh(self, chat_id):
+        failure = self.refresh_failures.get(chat_id)
+        return failure is None or time() >= failure[1]
+
+    async def _refresh_tenant(self, tenant):
+        # concurrent updates of the chat wait for the same refresh
+        task = self.refreshing_tasks.get(tenant.chat_id)
+        if task is None:
+            task = asyncio.ensure_future(self._refresh(tenant))
+            self.refreshing_tasks[tenant.chat_id] = task
+
+        await asyncio.shield(task)
+
+    async def _refresh(self, tenant):
+        chat_id = tenant.chat_id
+        loop = asyncio.get_running_loop()
+
+        try:
+            # refreshing reconnects to the tenant's storage, so it runs in a thread as loading does
+            await loop.run_in_executor(None, tenant.karma_service.refresh_if_stale)
+        except Exception as err:
+            # the tenant keeps its stale handle, which fails only this tenant's commands, and is refreshed again after a delay
+            (attempts, _) = self.refresh_failures.get(chat_id, (0, None))
+            delay = min(TENANT_REFRESH_RETRY_BASE_DELAY * 2 ** attempts, TENANT_REFRESH_RETRY_MAX_DELAY)
+            self.refresh_failures[chat_id] = (attempts + 1, time() + delay)
+
+            logger.error("Error refreshing tenant, will retry (chat_id=%s, attempt=%s, delay=%ss): %s", chat_id, attempts + 1, delay, err)
+            return
+        finally:
+            del self.refreshing_tasks[chat_id]
+
+        self.refresh_failures.pop(chat_id, None)
@@ -0,0 +1,88 @@
+from collections import OrderedDict
+from time import time
+import asyncio
+
+from services.logs import get_logger
+
+
+logger = get_logger(__name__)
+
+class UserProfilesService:
+    def __init__(self, max_size, ttl, refresh_after):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.refresh_after = refresh_after
+        self.profiles = OrderedDict()
+        self.refreshing = set()
+        # changes whenever a cached display name changes, so anything rendered from the names can be invalidated
+        self.version = 0
+
+    def remember(self, user):
+        if user is None or user.is_bot:
+            return
+
+        user_id = str(user.id)
+        if user_id not in self.profiles or self._get_display_name(self.profiles[user_id][0]) != self._get_display_name(user):
+            self.version += 1
+
+        self.profiles[user_id] = (user, time())
+        self.profiles.move_to_end(user_id)
+
+        while len(self.profiles) > self.max_size:
+            self.profiles.popitem(last=False)
+
+    def _get_display_name(self, user):
+        return (user.first_name, user.last_name)
+
+    def get(self, user_id):
+        user_id = str(user_id)
+        if user_id not in self.profiles:
+            return None
+
+        (user, cached_at) = self.profiles[user_id]
+        if time() - cached_at > self.ttl:
+            del self.profiles[user_id]
+            return None
+
+        self.profiles.move_to_end(user_id)
+        return user
+
+    def _needs_refresh(self, user_id):
+        (_, cached_at) = self.profiles[str(user_id)]
+        return time() - cached_at > self.refresh_after
+
+    async def _fetch(self, user_id, fetch_user):
+        user = await fetch_user(user_id)
+        self.remember(user)
+        return user
+
+    async def _refresh(self, user_id, fetch_user):
+        try:
+            await self._fetch(user_id, fetch_user)
+        finally:
+            self.refreshing.discard(user_id)
+
+    async def get_users(self, user_ids, fetch_user):
+        users = {}
+        missing_user_ids = []
+
+        for user_id in user_ids:
+            user = self.get(user_id)
+            if user is None:
+                missing_user_ids.append(user_id)
+                continue
+
+            users[user_id] = user
+
+            # stale profiles are served right away and refreshed in the background
+            if self._needs_refresh(user_id) and user_id not in self.refreshing:
+                self.refreshing.add(user_id)
+                asyncio.ensure_future(self._refresh(user_id, fetch_user))
+
+        if missing_user_ids:
+            logger.info("Fetching user profiles which are not cached (user_ids=%s)", missing_user_ids)
+
+            fetched_users = await asyncio.gather(*[self._fetch(user_id, fetch_user) for user_id in missing_user_ids])
+            users.update(zip(missing_user_ids, fetched_users))
+
+        return [users[user_id] for user_id in user_ids]
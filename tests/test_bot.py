@@ -0,0 +1,183 @@
+from itertools import count
+from threading import Barrier
+import json
+import unittest
+
+from benchmarks.fakes import StubRequest
+from benchmarks.replay import _load_tenant
+from services.bot import BotService
+from services.dedup import UpdateDedupService
+from services.metrics import MetricsService
+from services.session import SessionService, SessionType
+from services.session_store import MemorySessionStore
+from services.tenant import TenantService
+from services.user_profiles import UserProfilesService
+import handler
+
+
+def build_bot_service(load_tenant=None):
+    metrics_service = MetricsService()
+    return BotService(
+        token="123456:test",
+        tenant_service=TenantService(load_tenant=load_tenant or (lambda chat_id: _load_tenant(chat_id, metrics_service))),
+        session_service=SessionService(
+            session_ttls={SessionType.SELECT_USER: 3600, SessionType.CONFIRM_REQUEST: 3600},
+            store=MemorySessionStore()
+        ),
+        user_profiles_service=UserProfilesService(max_size=100, ttl=3600, refresh_after=600),
+        dedup_service=UpdateDedupService(max_size=100, ttl=3600),
+        metrics_service=metrics_service,
+        request=StubRequest()
+    )
+
+
+class UpdatesFactory:
+    def __init__(self):
+        self.update_ids = count(1)
+        self.message_ids = count(1)
+
+    def message(self, chat_id, text, user_id=1):
+        message = {
+            "message_id": next(self.message_ids),
+            "date": 0,
+            "chat": {"id": chat_id, "type": "group"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"},
+            "text": text
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": next(self.update_ids), "message": message}
+
+
+def record_processed_updates(bot_service, failing_update_ids=()):
+    # the updates passed to the handlers are recorded, the given ones fail as if their handler raised
+    processed_updates = []
+    process_update = bot_service._process_update
+
+    async def recorded_process_update(update_json):
+        processed_updates.append((update_json["message"]["chat"]["id"], update_json["update_id"]))
+        if update_json["update_id"] in failing_update_ids:
+            raise Exception("Handler failed")
+        await process_update(update_json)
+
+    bot_service._process_update = recorded_process_update
+    return processed_updates
+
+
+class ProcessUpdatesTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.updates = UpdatesFactory()
+
+    async def test_tenants_of_different_chats_are_loaded_concurrently(self):
+        # each load waits for the other one, so loading the chats one by one would break the barrier
+        barrier = Barrier(2, timeout=5)
+        metrics_service = MetricsService()
+        def load_tenant(chat_id):
+            barrier.wait()
+            return _load_tenant(chat_id, metrics_service)
+
+        bot_service = build_bot_service(load_tenant)
+        updates_json = [self.updates.message(-100, "/show"), self.updates.message(-200, "/show")]
+
+        self.assertEqual(await bot_service.process_updates(updates_json), [])
+        self.assertEqual(sorted(bot_service.tenant_service.tenants), [-200, -100])
+
+    async def test_updates_of_chat_are_processed_in_order(self):
+        bot_service = build_bot_service()
+        processed_updates = record_processed_updates(bot_service)
+        updates_json = [
+            self.updates.message(-100, "/show"),
+            self.updates.message(-200, "/show"),
+            self.updates.message(-100, "/help"),
+            self.updates.message(-100, "just chatting"),
+            self.updates.message(-100, "/show")
+        ]
+
+        self.assertEqual(await bot_service.process_updates(updates_json), [])
+        self.assertEqual([update_id for (chat_id, update_id) in processed_updates if chat_id == -100], [1, 3, 5])
+        self.assertEqual(bot_service.dropped_updates["not_command"], 1)
+
+    async def test_failed_update_fails_rest_of_its_chat_only(self):
+        bot_service = build_bot_service()
+        failing_update_ids = {2}
+        processed_updates = record_processed_updates(bot_service, failing_update_ids)
+        updates_json = [
+            self.updates.message(-100, "/show"),
+            self.updates.message(-100, "/show"),
+            self.updates.message(-200, "/show"),
+            self.updates.message(-100, "/show"),
+            self.updates.message(-999, "/show")
+        ]
+
+        self.assertEqual(await bot_service.process_updates(updates_json), [1, 3])
+        self.assertNotIn((-100, 4), processed_updates)
+        self.assertIn((-200, 3), processed_updates)
+        self.assertEqual(bot_service.dropped_updates["foreign_chat"], 1)
+
+        # the failed updates are redelivered and processed, while the processed one is still a duplicate
+        failing_update_ids.clear()
+        self.assertEqual(await bot_service.process_updates([updates_json[0], updates_json[1], updates_json[3]]), [])
+        self.assertEqual(bot_service.dropped_updates["duplicate"], 1)
+        self.assertIn((-100, 4), processed_updates)
+
+
+class FilterUpdateTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.updates = UpdatesFactory()
+        self.bot_service = build_bot_service()
+        self.sent_messages = []
+
+        send_message = self.bot_service.send_queue_service.send_message
+        def recorded_send_message(chat_id, text, **kwargs):
+            self.sent_messages.append((chat_id, text))
+            return send_message(chat_id, text, **kwargs)
+        self.bot_service.send_queue_service.send_message = recorded_send_message
+
+    async def _assert_dropped(self, update_json, reason):
+        self.assertFalse(await self.bot_service.process_update(update_json))
+        self.assertEqual(dict(self.bot_service.dropped_updates), {reason: 1})
+        self.assertFalse(self.bot_service.application._initialized)
+
+    async def test_plain_message_is_dropped(self):
+        await self._assert_dropped(self.updates.message(-100, "just chatting"), "not_command")
+        self.assertEqual(self.bot_service.tenant_service.get_loaded_tenants(), [])
+
+    async def test_foreign_chat_is_dropped_with_reply(self):
+        await self._assert_dropped(self.updates.message(-999, "/show"), "foreign_chat")
+        self.assertEqual([chat_id for (chat_id, _) in self.sent_messages], [-999])
+
+    async def test_update_without_chat_is_dropped(self):
+        update_json = {"update_id": 1, "poll": {"id": "1", "question": "?", "options": [], "total_voter_count": 0}}
+        await self._assert_dropped(update_json, "no_chat")
+        self.assertEqual(self.sent_messages, [])
+
+
+class ProcessRecordsTest(unittest.TestCase):
+    def setUp(self):
+        self.updates = UpdatesFactory()
+        self.bot_service = build_bot_service()
+        handler.bot_service = self.bot_service
+
+    def tearDown(self):
+        handler.bot_service = None
+
+    def test_only_failed_records_are_reported(self):
+        record_processed_updates(self.bot_service, failing_update_ids={2})
+        updates_json = [
+            self.updates.message(-100, "/show"),
+            self.updates.message(-200, "/show"),
+            self.updates.message(-200, "/help"),
+            self.updates.message(-300, "just chatting")
+        ]
+        records = [{"messageId": f"message-{index}", "body": json.dumps(update_json)} for (index, update_json) in enumerate(updates_json)]
+        records.append({"messageId": "malformed", "body": "{"})
+
+        response = handler.process_records(records)
+        self.assertEqual(
+            response,
+            {"batchItemFailures": [{"itemIdentifier": "malformed"}, {"itemIdentifier": "message-1"}, {"itemIdentifier": "message-2"}]}
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+import os
+import unittest
+
+from services.dedup import SQLiteDedupStore, UpdateDedupService
+
+
+def message_update(update_id):
+    return {"update_id": update_id, "message": {"message_id": update_id, "chat": {"id": -1}, "text": "/show"}}
+
+def callback_query_update(update_id, callback_query_id):
+    return {"update_id": update_id, "callback_query": {"id": callback_query_id, "data": "CONFIRM"}}
+
+
+class UpdateDedupServiceTest(unittest.TestCase):
+    def test_redelivered_update_is_registered_once(self):
+        dedup_service = UpdateDedupService(max_size=10, ttl=60)
+
+        self.assertTrue(dedup_service.register(message_update(1)))
+        self.assertFalse(dedup_service.register(message_update(1)))
+        self.assertTrue(dedup_service.register(message_update(2)))
+        self.assertEqual(dedup_service.hits_count, 1)
+
+    def test_forgotten_update_is_registered_again(self):
+        dedup_service = UpdateDedupService(max_size=10, ttl=60)
+        dedup_service.register(message_update(1))
+
+        dedup_service.forget(message_update(1))
+        self.assertTrue(dedup_service.register(message_update(1)))
+
+    def test_button_press_is_registered_once_across_updates(self):
+        dedup_service = UpdateDedupService(max_size=10, ttl=60)
+
+        self.assertTrue(dedup_service.register(callback_query_update(1, "press")))
+        self.assertFalse(dedup_service.register(callback_query_update(2, "press")))
+        self.assertTrue(dedup_service.register(callback_query_update(3, "other press")))
+
+    def test_least_recently_seen_keys_are_evicted(self):
+        dedup_service = UpdateDedupService(max_size=2, ttl=60)
+        dedup_service.register(message_update(1))
+        dedup_service.register(message_update(2))
+
+        # the redelivery makes the first update the most recently seen one
+        self.assertFalse(dedup_service.register(message_update(1)))
+        dedup_service.register(message_update(3))
+
+        self.assertEqual(list(dedup_service.seen_keys), ["update:1", "update:3"])
+        self.assertFalse(dedup_service.register(message_update(1)))
+        self.assertTrue(dedup_service.register(message_update(2)))
+
+    def test_keys_expire_after_ttl(self):
+        dedup_service = UpdateDedupService(max_size=10, ttl=60)
+
+        with patch("services.dedup.time", return_value=1000):
+            dedup_service.register(message_update(1))
+        with patch("services.dedup.time", return_value=1059):
+            self.assertFalse(dedup_service.register(message_update(1)))
+        with patch("services.dedup.time", return_value=1061):
+            self.assertTrue(dedup_service.register(message_update(1)))
+
+
+class SQLiteDedupStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.database_path = os.path.join(self.directory.name, "dedup.sqlite3")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _create_dedup_service(self):
+        return UpdateDedupService(max_size=10, ttl=60, store=SQLiteDedupStore(self.database_path))
+
+    def test_updates_are_shared_by_workers_and_restarts(self):
+        dedup_service = self._create_dedup_service()
+        self.assertTrue(dedup_service.register(message_update(1)))
+        self.assertTrue(dedup_service.register(callback_query_update(2, "press")))
+
+        # a new instance has an empty cache, so it's answered by the store
+        other_dedup_service = self._create_dedup_service()
+        self.assertFalse(other_dedup_service.register(message_update(1)))
+        self.assertFalse(other_dedup_service.register(callback_query_update(3, "press")))
+        self.assertTrue(other_dedup_service.register(message_update(4)))
+
+    def test_forgotten_update_is_removed_from_store(self):
+        dedup_service = self._create_dedup_service()
+        dedup_service.register(message_update(1))
+        dedup_service.forget(message_update(1))
+
+        self.assertTrue(self._create_dedup_service().register(message_update(1)))
+
+    def test_expired_keys_are_removed_from_store(self):
+        store = SQLiteDedupStore(self.database_path)
+
+        self.assertTrue(store.add(["update:1"], 1000, 60))
+        self.assertFalse(store.add(["update:1"], 1059, 60))
+        self.assertTrue(store.add(["update:2"], 1070, 60))
+        self.assertTrue(store.add(["update:1"], 1070, 60))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+import unittest
+
+from benchmarks.fakes import MemorySpreadsheetService
+
+
+class GoogleSpreadsheetCheckpointsTest(unittest.TestCase):
+    def setUp(self):
+        self.service = MemorySpreadsheetService(
+            account_dict=None,
+            spreadsheet_id=None,
+            spreadsheet_user_columns={"1": ["A", "B"], "2": ["C", "D"], "3": ["E", "F"]},
+            spreadsheet_first_data_row=2,
+            checkpoints_worksheet_title="checkpoints",
+            checkpoint_interval=3
+        )
+        self.read_ranges = []
+
+        batch_get = self.service.worksheet.batch_get
+        def recorded_batch_get(data_ranges):
+            self.read_ranges.append(data_ranges)
+            return batch_get(data_ranges)
+        self.service.worksheet.batch_get = recorded_batch_get
+
+    def _add(self, user_id, *amounts):
+        for amount in amounts:
+            self.service.add_entry(user_id, amount, "reason")
+
+    def _get_checkpoints_rows(self):
+        return self.service.spreadsheet.worksheet("checkpoints").get("A2:C")
+
+    def test_totals_are_read_from_first_row_without_checkpoints(self):
+        self._add("1", 1, 1)
+        self._add("2", -1)
+
+        self.assertEqual(self.service.get_totals(), {"1": 2, "2": -1, "3": 0})
+        self.assertEqual(self.read_ranges, [["B2:B", "D2:D", "F2:F"]])
+        self.assertNotIn("checkpoints", self.service.spreadsheet.worksheets)
+
+    def test_checkpoint_is_saved_after_interval_and_rows_after_it_are_read(self):
+        self._add("1", 1, 1, -1)
+        self._add("2", 1)
+
+        self.assertEqual(self.service.get_totals(), {"1": 1, "2": 1, "3": 0})
+        self.assertEqual(self._get_checkpoints_rows(), [["1", "1", "4"]])
+
+        self._add("1", 1)
+        self.assertEqual(self.service.get_totals(), {"1": 2, "2": 1, "3": 0})
+        self.assertEqual(self.read_ranges[-1], ["B5:B", "D2:D", "F2:F"])
+        self.assertEqual(self.service.get_total("1"), 2)
+
+    def test_checkpoints_worksheet_grows_with_new_users(self):
+        self._add("1", 1, 1, 1)
+        self.service.get_totals()
+        self.assertEqual(self.service.spreadsheet.worksheet("checkpoints").row_count, 2)
+
+        # the second user's checkpoint doesn't fit the grid created for the first one
+        self._add("2", -1, -1, -1)
+        self.assertEqual(self.service.get_totals(), {"1": 3, "2": -3, "3": 0})
+        self.assertEqual(self._get_checkpoints_rows(), [["1", "3", "4"], ["2", "-3", "4"]])
+        self.assertEqual(self.service.spreadsheet.worksheet("checkpoints").row_count, 3)
+
+    def test_compact_folds_all_rows_and_keeps_totals(self):
+        self._add("1", 1, 1)
+        self._add("2", -1)
+
+        self.assertEqual(self.service.compact(), 3)
+        self.assertEqual(self._get_checkpoints_rows(), [["1", "2", "3"], ["2", "-1", "2"]])
+        self.assertEqual(self.service.get_totals(), {"1": 2, "2": -1, "3": 0})
+        self.assertEqual(self.read_ranges[-1], ["B4:B", "D3:D", "F2:F"])
+
+        self._add("3", 1)
+        self.assertEqual(self.service.compact(), 1)
+        self.assertEqual(self.service.compact(), 0)
+        self.assertEqual(len(self._get_checkpoints_rows()), 3)
+
+    def test_checkpoints_are_loaded_by_new_handle(self):
+        self._add("1", 1, 1)
+        self._add("2", 1)
+        self.service.compact()
+
+        # a malformed row is skipped, so the user's total is read from the first row
+        checkpoints_worksheet = self.service.spreadsheet.worksheet("checkpoints")
+        checkpoints_worksheet.resize(rows=4)
+        checkpoints_worksheet.update("A4:C4", [["3", "", ""]])
+
+        self.service.connect()
+        self.assertEqual(self.service.load_checkpoints(), {"1": (2, 3), "2": (1, 2)})
+        self.assertEqual(self.service.checkpoints_rows_count, 4)
+        self.assertEqual(self.service.get_totals(), {"1": 2, "2": 1, "3": 0})
+        self.assertEqual(self.read_ranges[-1], ["B4:B", "D3:D", "F2:F"])
+
+
+
+class GoogleSpreadsheetHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.service = MemorySpreadsheetService(
+            account_dict=None,
+            spreadsheet_id=None,
+            spreadsheet_user_columns={"1": ["A", "B"], "2": ["C", "D"]},
+            spreadsheet_first_data_row=2,
+            checkpoints_worksheet_title="checkpoints",
+            checkpoint_interval=0
+        )
+        self.read_ranges = []
+
+        get = self.service.worksheet.get
+        def recorded_get(data_range):
+            self.read_ranges.append(data_range)
+            return get(data_range)
+        self.service.worksheet.get = recorded_get
+
+    def test_history_reads_only_latest_rows(self):
+        for index in range(10):
+            self.service.add_entry("1", 1 if index % 2 else -1, f"reason {index}")
+
+        records = self.service.get_history("1", 3)
+        self.assertEqual([record["reason"] for record in records], ["reason 9", "reason 8", "reason 7"])
+        self.assertEqual([record["amount"] for record in records], [1, -1, 1])
+        self.assertEqual(self.read_ranges[-1], "A9:B")
+
+    def test_history_starts_from_checkpoint_on_new_handle(self):
+        for index in range(10):
+            self.service.add_entry("1", 1, f"reason {index}")
+        self.service.compact()
+
+        # rows appended by another process after the checkpoint are read as well
+        self.service.connect()
+        self.service.users_last_rows.clear()
+        self.service.worksheet.append_rows([["late", 1]], table_range="A2:B")
+
+        records = self.service.get_history("1", 2)
+        self.assertEqual([record["reason"] for record in records], ["late", "reason 9"])
+        self.assertEqual(self.read_ranges[-1], "A10:B")
+
+    def test_cold_history_reads_whole_column_once(self):
+        for index in range(10):
+            self.service.add_entry("1", 1, f"reason {index}")
+        self.service.users_last_rows.clear()
+
+        self.assertEqual(len(self.service.get_history("1", 2)), 2)
+        self.assertEqual(self.read_ranges[-1], "A2:B")
+
+        self.service.worksheet.append_rows([["late", 1]], table_range="A2:B")
+        records = self.service.get_history("1", 2)
+        self.assertEqual([record["reason"] for record in records], ["late", "reason 9"])
+        self.assertEqual(self.read_ranges[-1], "A10:B")
+
+    def test_history_skips_malformed_rows(self):
+        self.service.add_entry("2", 1, "first")
+        self.service.worksheet.append_rows([["no amount", ""], ["text amount", "one"], ["", -1]], table_range="C2:D")
+
+        records = self.service.get_history("2", 10)
+        self.assertEqual([(record["reason"], record["amount"]) for record in records], [(None, -1), ("first", 1)])
+
+    def test_added_entries_are_found_after_position(self):
+        self.service.add_entry("1", 1, "vote")
+        position = self.service.get_position("1")
+        entries = [
+            {"user_id": "1", "amount": 1, "reason": "vote", "key": "a", "position": position},
+            {"user_id": "1", "amount": -1, "reason": None, "key": "b", "position": position}
+        ]
+        # the same row before the position is not taken for the entries
+        self.assertEqual(self.service.find_added_entries(entries[:1]), set())
+
+        self.service.add_entries(entries)
+        self.assertEqual(self.service.find_added_entries(entries), {"a", "b"})
+        self.assertEqual(self.service.find_added_entries([{**entries[0], "reason": "other"}]), set())
+
+
+if __name__ == '__main__':
+    unittest.main()
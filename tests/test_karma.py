@@ -0,0 +1,281 @@
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import TemporaryDirectory
+from threading import Event
+import asyncio
+import os
+import unittest
+
+from services.journal import JournalService
+from services.karma import KarmaService
+from services.leaderboard import LeaderboardService
+from services.sqlite_ledger import SQLiteLedgerService
+from services.storage import StorageService
+
+
+class MemoryStorage(StorageService):
+    def __init__(self, users):
+        self.users = {user_id: f"User {user_id}" for user_id in users}
+        self.entries = []
+
+    def user_exists(self, user_id):
+        return str(user_id) in self.users
+
+    def get_users(self):
+        return self.users.keys()
+
+    def add_entry(self, user_id, amount, reason, ts=None, requesting_user_id=None, confirming_user_id=None):
+        self.add_entries([{"user_id": str(user_id), "amount": amount, "reason": reason}])
+
+    def add_entries(self, entries):
+        self.entries.extend(entries)
+
+    def find_added_entries(self, entries):
+        keys = {entry.get("key") for entry in self.entries}
+        return {entry["key"] for entry in entries if entry["key"] in keys}
+
+    def get_total(self, user_id):
+        return self.get_totals()[str(user_id)]
+
+    def get_totals(self):
+        totals = {user_id: 0 for user_id in self.users}
+        for entry in self.entries:
+            totals[str(entry["user_id"])] += entry["amount"]
+        return totals
+
+
+class BlockingStorage(MemoryStorage):
+    # `get_totals` waits until it's released, so a write can be made while the totals are being read
+    def __init__(self, users):
+        super().__init__(users)
+        self.reads_count = 0
+        self.read_started = Event()
+        self.read_released = Event()
+        self.read_released.set()
+
+    def get_totals(self):
+        self.reads_count += 1
+        self.read_started.set()
+        self.read_released.wait()
+        return super().get_totals()
+
+
+class KarmaServiceLeaderboardTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.storage_service = BlockingStorage(["1", "2"])
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        self.karma_service = KarmaService(
+            storage_service=self.storage_service,
+            executor=self.executor,
+            leaderboard_service=LeaderboardService()
+        )
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    async def _wait_for_read(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.storage_service.read_started.wait)
+
+    async def test_leaderboard_is_loaded_when_write_overlaps_read(self):
+        self.storage_service.read_released.clear()
+        leaderboard_task = asyncio.ensure_future(self.karma_service.get_leaderboard())
+        await self._wait_for_read()
+
+        await self.karma_service.up("1", "overlapping vote")
+        self.storage_service.read_released.set()
+        leaderboard = await leaderboard_task
+
+        self.assertTrue(leaderboard.is_loaded())
+        self.assertEqual([user_id for (user_id, _) in leaderboard.get_ranking()], ["1", "2"])
+        self.assertEqual(leaderboard.get_rank("2"), 2)
+        self.assertIsNone(self.karma_service.totals)
+
+        # the overlapping read is not cached, so the next one rebuilds the leaderboard from the settled totals
+        leaderboard = await self.karma_service.get_leaderboard()
+        self.assertEqual(self.storage_service.reads_count, 2)
+        self.assertEqual(leaderboard.get_total("1"), 1)
+        self.assertEqual(leaderboard.get_total("2"), 0)
+
+    async def test_leaderboard_is_updated_by_writes_after_read(self):
+        leaderboard = await self.karma_service.get_leaderboard()
+        await self.karma_service.down("2", "vote")
+        await self.karma_service.up("1", "vote")
+
+        self.assertEqual(leaderboard.get_ranking(), [("1", 1), ("2", -1)])
+        self.assertEqual(await self.karma_service.get_total_value("2"), -1)
+        self.assertEqual(self.storage_service.reads_count, 1)
+
+
+class HistoryStorage(MemoryStorage):
+    supports_history = True
+
+    def get_history(self, user_id, limit):
+        records = [entry for entry in reversed(self.entries) if entry["user_id"] == str(user_id)]
+        return records[:limit]
+
+
+class KarmaServiceHistoryTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.storage_service = HistoryStorage(["1", "2"])
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.karma_service = KarmaService(
+            storage_service=self.storage_service,
+            executor=self.executor,
+            leaderboard_service=LeaderboardService(),
+            journal_service=JournalService(database_path=os.path.join(self.directory.name, "journal.sqlite3")),
+            journal_flush_interval=3600
+        )
+
+    async def asyncTearDown(self):
+        await self.karma_service.close()
+        self.executor.shutdown()
+        self.directory.cleanup()
+
+    async def test_history_includes_pending_journal_entries(self):
+        await self.karma_service.up("1", "flushed")
+        await self.karma_service.flush()
+        await self.karma_service.down("1", "pending")
+        await self.karma_service.up("2", "other user")
+
+        records = await self.karma_service.get_history("1", 10)
+        self.assertEqual([(record["reason"], record["amount"]) for record in records], [("pending", -1), ("flushed", 1)])
+
+        records = await self.karma_service.get_history("1", 1)
+        self.assertEqual([record["reason"] for record in records], ["pending"])
+
+
+class FlakyLedger(SQLiteLedgerService):
+    # fails the next adds, either before the entries are written or after, as a timed out request which went through
+    def __init__(self, database_path, users):
+        super().__init__(database_path, users)
+        self.failures = []
+
+    def add_entries(self, entries):
+        failure = self.failures.pop(0) if self.failures else None
+        if failure == "before":
+            raise Exception("Storage is not available")
+
+        super().add_entries(entries)
+        if failure == "after":
+            raise Exception("Storage request timed out")
+
+    def get_entries_count(self):
+        return self.connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+
+class KarmaServiceJournalTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.journal_path = os.path.join(self.directory.name, "journal.sqlite3")
+        self.storage_service = FlakyLedger(os.path.join(self.directory.name, "ledger.sqlite3"), {"1": "User 1", "2": "User 2"})
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.karma_service = self._create_karma_service(JournalService(database_path=self.journal_path))
+
+    async def asyncTearDown(self):
+        task = self.karma_service.journal_flush_task
+        if task is not None and not task.done():
+            task.cancel()
+        self.executor.shutdown()
+        self.directory.cleanup()
+
+    def _create_karma_service(self, journal_service):
+        return KarmaService(
+            storage_service=self.storage_service,
+            executor=self.executor,
+            leaderboard_service=LeaderboardService(),
+            journal_service=journal_service,
+            journal_flush_interval=3600
+        )
+
+    async def test_flush_moves_entries_to_storage(self):
+        await self.karma_service.up("1", "first")
+        await self.karma_service.up("1", "second")
+        await self.karma_service.down("2", "third")
+        self.assertEqual(self.storage_service.get_entries_count(), 0)
+        self.assertEqual(await self.karma_service.get_total_values(), {"1": 2, "2": -1})
+
+        await self.karma_service.flush()
+        self.assertFalse(self.karma_service.has_pending_writes())
+        self.assertEqual(self.storage_service.get_totals(), {"1": 2, "2": -1})
+        self.assertEqual(await self.karma_service.get_total_values(), {"1": 2, "2": -1})
+
+    async def test_flush_retries_with_growing_delays(self):
+        delays = []
+        async def sleep_before_flush(delay):
+            delays.append(delay)
+        self.karma_service._sleep_before_flush = sleep_before_flush
+        self.storage_service.failures = ["before", "before", "before"]
+
+        await self.karma_service.up("1", "vote")
+        await self.karma_service.journal_flush_task
+
+        self.assertEqual(delays, [3600, 1, 2, 4])
+        self.assertFalse(self.karma_service.has_pending_writes())
+        self.assertEqual(self.storage_service.get_entries_count(), 1)
+
+    async def test_entries_added_before_failure_are_not_added_again(self):
+        await self.karma_service.up("1", "vote")
+        await self.karma_service.down("2", "vote")
+        self.storage_service.failures = ["after"]
+
+        with self.assertRaises(Exception):
+            await self.karma_service.flush()
+        self.assertTrue(self.karma_service.has_pending_writes())
+
+        await self.karma_service.flush()
+        self.assertFalse(self.karma_service.has_pending_writes())
+        self.assertEqual(self.storage_service.get_entries_count(), 2)
+        self.assertEqual(await self.karma_service.get_total_values(), {"1": 1, "2": -1})
+
+    async def test_entries_are_not_added_again_when_journal_remove_fails(self):
+        await self.karma_service.up("1", "vote")
+
+        remove = self.karma_service.journal_service.remove
+        def failing_remove(entries):
+            self.karma_service.journal_service.remove = remove
+            raise Exception("Journal is not available")
+        self.karma_service.journal_service.remove = failing_remove
+
+        with self.assertRaises(Exception):
+            await self.karma_service.flush()
+        await self.karma_service.flush()
+
+        self.assertFalse(self.karma_service.has_pending_writes())
+        self.assertEqual(self.storage_service.get_totals(), {"1": 1, "2": 0})
+
+    async def test_flush_cut_off_by_crash_is_replayed_once(self):
+        await self.karma_service.up("1", "added before crash")
+        await self.karma_service.up("1", "not added before crash")
+
+        # the process dies after the first entry reached the storage and before the journal was updated
+        journal_service = self.karma_service.journal_service
+        entries = journal_service.get_pending(10)
+        journal_service.mark_flushing(entries, None)
+        self.storage_service.add_entries(entries[:1])
+        journal_service.connection.close()
+
+        # the entries are settled before the totals are read, so the added one isn't counted in the journal as well
+        karma_service = self._create_karma_service(JournalService(database_path=self.journal_path))
+        self.assertEqual(await karma_service.get_total_value("1"), 2)
+        self.assertEqual(self.storage_service.get_entries_count(), 1)
+
+        await karma_service.flush()
+        self.assertFalse(karma_service.has_pending_writes())
+        self.assertEqual(self.storage_service.get_entries_count(), 2)
+        self.assertEqual(await karma_service.get_total_value("1"), 2)
+
+
+class StorageServiceTest(unittest.TestCase):
+    def test_backend_missing_required_method_is_not_created(self):
+        class IncompleteStorage(MemoryStorage):
+            add_entries = StorageService.add_entries
+
+        with self.assertRaises(TypeError):
+            IncompleteStorage(["1"])
+
+        # the methods of the commands a backend doesn't support are not required
+        self.assertFalse(MemoryStorage(["1"]).supports_window_totals)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+from time import time
+import asyncio
+import unittest
+
+from services.scheduler import FIRE_BATCH_WINDOW, ExpiryScheduler
+
+
+class ExpirySchedulerTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.fired_batches = []
+        self.scheduler = ExpiryScheduler(self._expired_callback)
+
+    async def _expired_callback(self, keys):
+        self.fired_batches.append(keys)
+
+    async def _wait_for_fire(self, delay):
+        await asyncio.sleep(delay)
+        # the callback runs in a task created by the timer
+        await asyncio.sleep(0)
+
+    async def test_cancelled_key_is_not_fired(self):
+        now = time()
+        self.scheduler.schedule("a", now + 0.05)
+        self.scheduler.schedule("b", now + 0.05)
+
+        self.assertTrue(self.scheduler.cancel("a"))
+        self.assertFalse(self.scheduler.cancel("a"))
+        self.assertEqual(len(self.scheduler), 1)
+
+        await self._wait_for_fire(0.1)
+        self.assertEqual(self.fired_batches, [["b"]])
+
+    async def test_rescheduled_key_fires_once_at_new_time(self):
+        now = time()
+        self.scheduler.schedule("a", now + 0.05)
+        self.scheduler.schedule("a", now + 0.3)
+
+        await self._wait_for_fire(0.15)
+        self.assertEqual(self.fired_batches, [])
+
+        await self._wait_for_fire(0.25)
+        self.assertEqual(self.fired_batches, [["a"]])
+        self.assertEqual(len(self.scheduler), 0)
+
+    async def test_keys_due_within_window_fire_together(self):
+        now = time()
+        self.scheduler.schedule("a", now + 0.05)
+        self.scheduler.schedule("b", now + 0.05 + FIRE_BATCH_WINDOW / 2)
+        self.scheduler.schedule("c", now + 0.05 + FIRE_BATCH_WINDOW * 4)
+
+        await self._wait_for_fire(0.05 + FIRE_BATCH_WINDOW)
+        self.assertEqual(self.fired_batches, [["a", "b"]])
+
+        await self._wait_for_fire(FIRE_BATCH_WINDOW * 6)
+        self.assertEqual(self.fired_batches, [["a", "b"], ["c"]])
+
+    def test_compaction_drops_cancelled_entries_and_keeps_order(self):
+        # keys far in the future, so no timer fires while the heap is checked
+        now = time() + 3600
+        for index in range(200):
+            self.scheduler.schedule(index, now + (index * 7) % 200)
+        for index in range(200):
+            if index % 4 != 3:
+                self.scheduler.cancel(index)
+        self.scheduler.schedule(3, now + 500)
+
+        self.assertLess(len(self.scheduler.heap), 150)
+        self.assertEqual(len(self.scheduler), 50)
+
+        expected_keys = sorted(range(7, 200, 4), key=lambda index: (index * 7) % 200) + [3]
+        self.assertEqual(self.scheduler.pop_due(now + 1000), expected_keys)
+        self.assertEqual(len(self.scheduler), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
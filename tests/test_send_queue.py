@@ -0,0 +1,94 @@
+from time import monotonic
+import asyncio
+import unittest
+
+from telegram.error import RetryAfter
+
+from services.send_queue import SendQueueService
+
+
+class RecordingBot:
+    def __init__(self):
+        self.calls = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls.append(("send_message", chat_id, text))
+        return text
+
+    async def delete_message(self, chat_id, message_id):
+        self.calls.append(("delete_message", chat_id, message_id))
+        return True
+
+
+class FloodedBot(RecordingBot):
+    # the first message sent to each of the flooded chats is rejected by the flood control
+    def __init__(self, flooded_chat_ids):
+        super().__init__()
+        self.flooded_chat_ids = set(flooded_chat_ids)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if chat_id in self.flooded_chat_ids:
+            self.flooded_chat_ids.discard(chat_id)
+            raise RetryAfter(1)
+
+        self.calls.append(("send_message", chat_id, text, monotonic()))
+        return text
+
+
+class SendQueueServiceTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.bot = RecordingBot()
+        self.send_queue_service = SendQueueService(self.bot, chat_messages_per_minute=2, messages_per_second=100)
+
+    async def asyncTearDown(self):
+        await self.send_queue_service.cancel()
+
+    async def test_deletes_are_not_limited_per_chat(self):
+        await self.send_queue_service.send_message(-1, "first")
+        await self.send_queue_service.send_message(-1, "second")
+        for message_id in range(5):
+            self.send_queue_service.delete_message(-1, message_id)
+
+        self.assertTrue(await self.send_queue_service.drain(timeout=1))
+        self.assertEqual(len([call for call in self.bot.calls if call[0] == "delete_message"]), 5)
+
+    async def test_drain_without_limits_leaves_held_calls_queued(self):
+        await self.send_queue_service.send_message(-1, "first")
+        await self.send_queue_service.send_message(-1, "second")
+        self.send_queue_service.send_notice(-1, "expired", 1, "{count} expired")
+        self.send_queue_service.delete_message(-1, 1)
+        self.send_queue_service.delete_message(-2, 2)
+
+        # the notice waits for a token of its chat, while the deletes are made right away
+        self.assertFalse(await asyncio.wait_for(self.send_queue_service.drain(wait_for_limits=False), 1))
+        self.assertEqual(self.bot.calls[2:], [("delete_message", -1, 1), ("delete_message", -2, 2)])
+        self.assertEqual(self.send_queue_service.get_pending_count(), 1)
+
+        # a held call doesn't delay the next drain either
+        self.assertFalse(await asyncio.wait_for(self.send_queue_service.drain(wait_for_limits=False), 1))
+        self.assertFalse(await self.send_queue_service.drain(timeout=0.1))
+
+
+class SendQueueServiceFloodTest(unittest.IsolatedAsyncioTestCase):
+    async def _send_after_flood(self, flooded_chat_ids):
+        bot = FloodedBot(flooded_chat_ids)
+        send_queue_service = SendQueueService(bot, max_retries=1)
+
+        started_at = monotonic()
+        futures = [send_queue_service.send_message(chat_id, "flooded") for chat_id in flooded_chat_ids]
+        # the other chat sends once the flooded ones got their errors
+        await asyncio.sleep(0.1)
+        await send_queue_service.send_message(-3, "other")
+        await asyncio.gather(*futures)
+
+        return next(sent_at for (_, chat_id, _, sent_at) in bot.calls if chat_id == -3) - started_at
+
+    async def test_other_chats_are_not_paused_by_flood_in_one_chat(self):
+        self.assertLess(await self._send_after_flood([-1]), 0.5)
+
+    async def test_all_chats_are_paused_by_flood_in_several_chats(self):
+        self.assertGreaterEqual(await self._send_after_flood([-1, -2]), 0.9)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+from tempfile import TemporaryDirectory
+import os
+import sqlite3
+import unittest
+
+from services.session import Session, SessionType
+from services.session_store import SCHEMA_VERSION, MemorySessionStore, SQLiteSessionStore
+
+
+def create_session(id, expire_time, type=SessionType.SELECT_USER, user_id=1, chat_id=-1, message_id=None):
+    return Session(
+        id=id,
+        type=type,
+        user_id=user_id,
+        chat_id=chat_id,
+        message_id=message_id if message_id is not None else hash(id) % 100000,
+        expire_time=expire_time,
+        data={"request_type": "up", "reason": id}
+    )
+
+
+class SessionStoreTests:
+    # the stores are used interchangeably by SessionService, so both run the same tests
+    def create_store(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.store = self.create_store()
+
+    def test_put_get_and_delete(self):
+        session = create_session("a", 100, message_id=10)
+        self.store.put(session)
+
+        self.assertEqual(self.store.get("a").to_dict(), session.to_dict())
+        self.assertEqual(self.store.get_by_message(-1, 10).id, "a")
+        self.assertIsNone(self.store.get_by_message(-2, 10))
+        self.assertEqual(self.store.count(), 1)
+
+        self.assertEqual(self.store.delete("a").to_dict(), session.to_dict())
+        self.assertIsNone(self.store.get("a"))
+        self.assertIsNone(self.store.get_by_message(-1, 10))
+        self.assertIsNone(self.store.delete("a"))
+        self.assertEqual(self.store.count(), 0)
+
+    def test_user_sessions_are_indexed_by_chat_and_type(self):
+        self.store.put(create_session("a", 100, user_id=1, chat_id=-1))
+        self.store.put(create_session("b", 100, type=SessionType.CONFIRM_REQUEST, user_id=2, chat_id=-1))
+
+        self.assertTrue(self.store.has_user_session(-1, 1, SessionType.SELECT_USER, 50))
+        self.assertFalse(self.store.has_user_session(-2, 1, SessionType.SELECT_USER, 50))
+        self.assertFalse(self.store.has_user_session(-1, 1, SessionType.CONFIRM_REQUEST, 50))
+        self.assertEqual([session.id for session in self.store.get_sessions_of_type(SessionType.CONFIRM_REQUEST)], ["b"])
+
+        self.store.delete("a")
+        self.assertFalse(self.store.has_user_session(-1, 1, SessionType.SELECT_USER, 50))
+        self.assertEqual(self.store.get_sessions_of_type(SessionType.SELECT_USER), [])
+
+    def test_expired_sessions_are_filtered_and_popped(self):
+        self.store.put(create_session("a", 10, user_id=1))
+        self.store.put(create_session("b", 20, user_id=2))
+        self.store.put(create_session("c", 15, type=SessionType.CONFIRM_REQUEST, user_id=1))
+
+        # an expired session which is not swept yet doesn't block the user
+        self.assertFalse(self.store.has_user_session(-1, 1, SessionType.SELECT_USER, 12))
+        self.assertTrue(self.store.has_user_session(-1, 2, SessionType.SELECT_USER, 12))
+
+        self.assertEqual(sorted(session.id for session in self.store.pop_expired(15)), ["a", "c"])
+        self.assertEqual(self.store.pop_expired(15), [])
+        self.assertEqual(self.store.count(), 1)
+        self.assertEqual(self.store.get("b").expire_time, 20)
+
+
+class MemorySessionStoreTest(SessionStoreTests, unittest.TestCase):
+    def create_store(self):
+        return MemorySessionStore()
+
+
+class SQLiteSessionStoreTest(SessionStoreTests, unittest.TestCase):
+    def create_store(self):
+        self.directory = TemporaryDirectory()
+        self.database_path = os.path.join(self.directory.name, "sessions.sqlite3")
+        return SQLiteSessionStore(self.database_path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_session_is_deleted_by_one_store_only(self):
+        self.store.put(create_session("a", 100))
+        other_store = SQLiteSessionStore(self.database_path)
+
+        # workers sharing the database can't both handle the same session
+        self.assertEqual(other_store.delete("a").id, "a")
+        self.assertIsNone(self.store.delete("a"))
+        self.assertEqual(self.store.pop_expired(200), [])
+
+    def test_sessions_are_dropped_on_schema_version_change(self):
+        self.store.put(create_session("a", 100))
+        self.assertEqual(SQLiteSessionStore(self.database_path).count(), 1)
+
+        connection = sqlite3.connect(self.database_path)
+        connection.execute(f"PRAGMA user_version={SCHEMA_VERSION - 1}")
+        connection.close()
+
+        store = SQLiteSessionStore(self.database_path)
+        self.assertEqual(store.count(), 0)
+        store.put(create_session("b", 100))
+        self.assertEqual(store.get("b").id, "b")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+from unittest.mock import patch
+import unittest
+
+from services.tenant import Tenant, TenantService, TENANT_REFRESH_RETRY_BASE_DELAY
+from services.users import UsersService
+
+
+class StaleKarmaService:
+    def __init__(self, failing):
+        self.failing = failing
+        self.stale = True
+        self.refreshes_count = 0
+
+    def is_stale(self):
+        return self.stale
+
+    def refresh_if_stale(self):
+        self.refreshes_count += 1
+        if self.failing:
+            raise Exception("Requested entity was not found")
+        self.stale = False
+
+
+class TenantServiceRefreshTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tenants = {
+            chat_id: Tenant(chat_id=chat_id, users_service=UsersService(users={}), karma_service=StaleKarmaService(failing=chat_id == -1))
+            for chat_id in (-1, -2)
+        }
+        self.tenant_service = TenantService(load_tenant=self.tenants.get)
+
+    async def test_stale_tenant_is_refreshed_when_used(self):
+        self.assertIs(await self.tenant_service.get_tenant(-2), self.tenants[-2])
+        self.assertEqual(self.tenants[-2].karma_service.refreshes_count, 0)
+
+        await self.tenant_service.get_tenant(-2)
+        await self.tenant_service.get_tenant(-2)
+        self.assertEqual(self.tenants[-2].karma_service.refreshes_count, 1)
+        self.assertEqual(self.tenants[-1].karma_service.refreshes_count, 0)
+
+    async def test_failed_refresh_is_isolated_and_retried_after_delay(self):
+        await self.tenant_service.get_tenant(-1)
+        await self.tenant_service.get_tenant(-2)
+
+        with patch("services.tenant.time", return_value=1000):
+            self.assertIs(await self.tenant_service.get_tenant(-1), self.tenants[-1])
+            self.assertIs(await self.tenant_service.get_tenant(-1), self.tenants[-1])
+            self.assertIs(await self.tenant_service.get_tenant(-2), self.tenants[-2])
+        self.assertEqual(self.tenants[-1].karma_service.refreshes_count, 1)
+        self.assertEqual(self.tenants[-2].karma_service.refreshes_count, 1)
+
+        with patch("services.tenant.time", return_value=1000 + TENANT_REFRESH_RETRY_BASE_DELAY):
+            await self.tenant_service.get_tenant(-1)
+        self.assertEqual(self.tenants[-1].karma_service.refreshes_count, 2)
+        self.assertEqual(self.tenant_service.refresh_failures[-1][0], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()